@@ -0,0 +1,92 @@
+"""
+Micro-benchmark for the per-job HTTP overhead of the handler against ComfyUI.
+
+It replays the requests that a single job sends to ComfyUI (server check,
+image upload, queuing the workflow and reading the history) against the fake
+ComfyUI of the tests, once with a new connection per request (how the handler
+used to talk to ComfyUI) and once with the shared, pooled session.
+
+Usage (from the root of the repository):
+
+    python -m benchmarks.bench_comfy_http --jobs 200
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+import urllib.request
+
+import requests
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+from src import rp_handler
+from tests.fake_comfyui import FakeComfyUI
+
+IMAGE = b"\x89PNG\r\n\x1a\n" + b"\x00" * 64 * 1024
+WORKFLOW = {"9": {"inputs": {}, "class_type": "PreviewImage"}}
+
+
+def job_without_session(host, history_reads):
+    requests.get(f"http://{host}")
+    requests.post(
+        f"http://{host}/upload/image",
+        files={"image": ("input.png", IMAGE, "image/png"), "overwrite": (None, "true")},
+    )
+    data = json.dumps({"prompt": WORKFLOW}).encode("utf-8")
+    req = urllib.request.Request(f"http://{host}/prompt", data=data)
+    prompt_id = json.loads(urllib.request.urlopen(req).read())["prompt_id"]
+    for _ in range(history_reads):
+        with urllib.request.urlopen(f"http://{host}/history/{prompt_id}") as response:
+            json.loads(response.read())
+
+
+def job_with_session(host, history_reads):
+    rp_handler.comfy_request("GET", "/")
+    rp_handler.comfy_request(
+        "POST",
+        "/upload/image",
+        files={"image": ("input.png", IMAGE, "image/png"), "overwrite": (None, "true")},
+    )
+    prompt_id = rp_handler.queue_workflow(WORKFLOW)["prompt_id"]
+    for _ in range(history_reads):
+        rp_handler.get_history(prompt_id)
+
+
+def measure(job, jobs, history_reads):
+    with FakeComfyUI(render_time=0) as fake:
+        rp_handler.COMFY_HOST = fake.host
+        # Warm up
+        job(fake.host, history_reads)
+        start = time.perf_counter()
+        for _ in range(jobs):
+            job(fake.host, history_reads)
+        duration = time.perf_counter() - start
+        connections = fake.connections
+    return {
+        "per_job_ms": duration / jobs * 1000,
+        "requests_per_job": 3 + history_reads,
+        "connections": connections,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--jobs", type=int, default=200)
+    parser.add_argument("--history-reads", type=int, default=4)
+    args = parser.parse_args()
+
+    results = {
+        "before": measure(job_without_session, args.jobs, args.history_reads),
+        "after": measure(job_with_session, args.jobs, args.history_reads),
+    }
+    print(json.dumps(results, indent=2))
+    print(
+        "per job: %.2f ms -> %.2f ms"
+        % (results["before"]["per_job_ms"], results["after"]["per_job_ms"])
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+Benchmark for the throughput of a worker that runs several jobs at the same time.
+
+Every job renders on the fake ComfyUI of the tests (the "GPU" phase) and then
+spends some time delivering its outputs (the I/O phase, e.g. an upload to
+AWS S3). The jobs are started like the JobScaler of runpod 1.6 does it with
+the concurrency modifier, once with MAX_CONCURRENCY=1 (one job at a time) and
+once with the given concurrency.
+
+Usage (from the root of the repository):
+
+    python -m benchmarks.bench_concurrency --jobs 20 --render-ms 200 --io-ms 150
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from unittest.mock import patch
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+from src import rp_handler
+from tests.fake_comfyui import FakeComfyUI
+
+WORKFLOW = {"9": {"inputs": {}, "class_type": "SaveImage"}}
+
+
+def jobs_to_start(concurrency, running):
+    """
+    How many jobs runpod 1.6 takes at once, see JobScaler.get_jobs.
+
+    Args:
+        concurrency (int): The result of the concurrency modifier
+        running (int): The jobs that the worker runs
+
+    Returns:
+        int: One job for an idle worker, the concurrency while it has room, else 0
+    """
+    if running >= concurrency:
+        return 0
+    return concurrency if running else 1
+
+
+async def run_worker(jobs):
+    """Start jobs like runpod does, whenever the concurrency modifier allows more"""
+    tasks = []
+    concurrency = 1
+    while len(tasks) < jobs:
+        running = rp_handler.concurrency_state["running"]
+        concurrency = rp_handler.concurrency_modifier(concurrency)
+        count = min(jobs_to_start(concurrency, running), jobs - len(tasks))
+        if not count:
+            await asyncio.sleep(0.01)
+            continue
+        for _ in range(count):
+            job = {"id": str(len(tasks)), "input": {"workflow": WORKFLOW}}
+            tasks.append(asyncio.create_task(rp_handler.async_handler(job)))
+        # Give the jobs a chance to start before asking again
+        await asyncio.sleep(0)
+    return await asyncio.gather(*tasks)
+
+
+def measure(max_concurrency, jobs, render_ms, io_ms):
+    def process_output_images(outputs, job_id, inline_budget=None):
+        time.sleep(io_ms / 1000)
+        return {"status": "success", "message": job_id}
+
+    with FakeComfyUI(render_time=render_ms / 1000) as fake, patch.object(
+        rp_handler, "COMFY_HOST", fake.host
+    ), patch.object(rp_handler, "MAX_CONCURRENCY", max_concurrency), patch.object(
+        rp_handler, "CONCURRENCY_CHECK_INTERVAL_MS", 0
+    ), patch.object(
+        rp_handler, "process_output_images", side_effect=process_output_images
+    ):
+        start = time.perf_counter()
+        results = asyncio.run(run_worker(jobs))
+        duration = time.perf_counter() - start
+
+    failed = sum(1 for result in results if result.get("status") != "success")
+    return {
+        "max_concurrency": max_concurrency,
+        "duration_s": duration,
+        "jobs_per_hour": jobs / duration * 3600,
+        "failed": failed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--jobs", type=int, default=20)
+    parser.add_argument("--render-ms", type=int, default=200)
+    parser.add_argument("--io-ms", type=int, default=150)
+    parser.add_argument("--concurrency", type=int, default=2)
+    args = parser.parse_args()
+
+    results = {
+        "before": measure(1, args.jobs, args.render_ms, args.io_ms),
+        "after": measure(args.concurrency, args.jobs, args.render_ms, args.io_ms),
+    }
+    print(json.dumps(results, indent=2))
+    print(
+        "jobs per hour: %.0f -> %.0f"
+        % (results["before"]["jobs_per_hour"], results["after"]["jobs_per_hour"])
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,224 @@
+"""
+Peak memory of the handler for jobs with large inline input images.
+
+Every run starts a fresh process, which builds a job with --images base64
+encoded images of --image-mb megabytes each and runs it through the handler
+against the fake ComfyUI of the tests (in its own process). The resident
+memory of the process is sampled while the handler runs, so the result is the
+memory that the handler needs on top of the payload that runpod hands it.
+
+The results can be saved as JSON and compared with an earlier run, e.g. of
+the previous commit.
+
+Usage (from the root of the repository):
+
+    python -m benchmarks.bench_input_memory --images 10 --image-mb 8 \\
+        --output memory.json --baseline memory_before.json
+"""
+
+import argparse
+import base64
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.append(ROOT)
+sys.path.append(os.path.join(ROOT, "src"))
+from tests.fake_comfyui import FakeComfyUI
+
+
+def serve_fake_comfyui(connection, options):
+    """Run the fake ComfyUI in a child process until the parent asks it to stop"""
+    with FakeComfyUI(**options) as fake:
+        connection.send(fake.host)
+        connection.recv()
+
+
+def rss_bytes():
+    """The current resident memory of the process, None if it is unknown"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+def max_rss_bytes():
+    """The peak resident memory since the start of the process"""
+    if resource is None:
+        return None
+    # Kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class RssSampler(threading.Thread):
+    """Samples the resident memory every millisecond and keeps the peak"""
+
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.peak = rss_bytes() or 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(0.001):
+            self.peak = max(self.peak, rss_bytes() or 0)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        return self.peak
+
+
+def run_job(connection, host, environ, images, image_mb):
+    """Build a job with inline images and run it through the handler, in a fresh process"""
+    os.environ.update(environ)
+    from src import rp_handler
+
+    with open(os.path.join(ROOT, "test_input.json")) as f:
+        job_input = json.load(f)["input"]
+    job_input["images"] = [
+        {
+            "name": f"bench_{index}.png",
+            "image": base64.b64encode(os.urandom(int(image_mb * 1024**2))).decode(
+                "ascii"
+            ),
+        }
+        for index in range(images)
+    ]
+    job = {"id": "bench", "input": job_input}
+    payload_bytes = sum(len(image["image"]) for image in job_input["images"])
+
+    rp_handler.COMFY_HOST = host
+    # Only the upload is measured, not the rendering
+    rp_handler.process_output_images = lambda outputs, job_id, inline_budget=None: {
+        "status": "success",
+        "message": "",
+    }
+    rss_before = rss_bytes()
+    sampler = RssSampler()
+    sampler.start()
+    start = time.perf_counter()
+    result = rp_handler.handler(job)
+    duration = time.perf_counter() - start
+    peak = sampler.stop()
+    if not peak:
+        peak = max_rss_bytes()
+
+    connection.send(
+        {
+            "status": result.get("status", result.get("error")),
+            "payload_mb": round(payload_bytes / 1024**2, 1),
+            "rss_before_mb": round((rss_before or 0) / 1024**2, 1),
+            "peak_rss_mb": round(peak / 1024**2, 1),
+            "handler_peak_mb": round((peak - (rss_before or 0)) / 1024**2, 1),
+            "duration_ms": round(duration * 1000, 1),
+        }
+    )
+
+
+def measure(host, environ, images, image_mb):
+    # A fresh interpreter, so that the peak of one run doesn't hide the next one
+    context = multiprocessing.get_context("spawn")
+    parent, child = context.Pipe()
+    process = context.Process(
+        target=run_job, args=(child, host, environ, images, image_mb)
+    )
+    process.start()
+    # The child only sends a result when the job ran, a crash would block recv forever
+    while not parent.poll(0.5):
+        if not process.is_alive():
+            raise RuntimeError(
+                f"the benchmark process stopped with exit code {process.exitcode}"
+            )
+    result = parent.recv()
+    process.join()
+    return result
+
+
+def compare(results, baseline):
+    """Print the change of the peak memory and the duration"""
+    old, new = baseline["summary"], results["summary"]
+    print(
+        "handler peak %.1f -> %.1f MB, peak RSS %.1f -> %.1f MB, %.1f -> %.1f ms"
+        % (
+            old["handler_peak_mb"],
+            new["handler_peak_mb"],
+            old["peak_rss_mb"],
+            new["peak_rss_mb"],
+            old["duration_ms"],
+            new["duration_ms"],
+        )
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--images", type=int, default=10, help="Images per job")
+    parser.add_argument(
+        "--image-mb", type=float, default=8, help="Size of every image in MB"
+    )
+    parser.add_argument("--runs", type=int, default=3, help="Runs, the median is kept")
+    parser.add_argument("--output", help="Save the results as JSON")
+    parser.add_argument("--baseline", help="Compare with the JSON of an earlier run")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        folders = {}
+        for name in ("output_dir", "temp_dir", "input_dir", "input_cache"):
+            folders[name] = os.path.join(root, name)
+            os.mkdir(folders[name])
+        environ = {
+            "COMFY_OUTPUT_PATH": folders["output_dir"],
+            "COMFY_TEMP_PATH": folders["temp_dir"],
+            "COMFY_INPUT_PATH": folders["input_dir"],
+            "INPUT_CACHE_PATH": folders["input_cache"],
+            "METRICS_LOG": "false",
+        }
+
+        parent, child = multiprocessing.Pipe()
+        options = {"render_time": 0, "input_dir": folders["input_dir"]}
+        server = multiprocessing.Process(
+            target=serve_fake_comfyui, args=(child, options), daemon=True
+        )
+        server.start()
+        host = parent.recv()
+        try:
+            runs = [
+                measure(host, environ, args.images, args.image_mb)
+                for _ in range(args.runs)
+            ]
+        finally:
+            parent.send("stop")
+            server.join()
+
+    summary = sorted(runs, key=lambda run: run["handler_peak_mb"])[len(runs) // 2]
+    results = {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "options": vars(args),
+        "runs": runs,
+        "summary": summary,
+    }
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,266 @@
+"""
+Load test of the handler against the fake ComfyUI of the tests.
+
+The jobs of test_input.json and test_resources/workflows/ are replayed at
+several concurrency levels. The fake ComfyUI runs in its own process and
+really writes the output images, so the CPU time and memory of this process
+are the overhead of the handler alone (validation, uploads, waiting for
+ComfyUI and delivering the outputs).
+
+Per concurrency level, it reports the latency of the jobs (p50, p95, p99),
+the jobs per second, the overhead per job (the time the job did not wait for
+ComfyUI), the CPU time per job and the peak memory. The results can be saved
+as JSON and compared with an earlier run.
+
+Usage (from the root of the repository):
+
+    python -m benchmarks.bench_load --jobs 50 --concurrency 1,2,4 --node-ms 20 \\
+        --image-size 512x512 --output bench.json --baseline bench_before.json
+"""
+
+import argparse
+import asyncio
+import base64
+import glob
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from unittest.mock import patch
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+from src import rp_handler
+from benchmarks.bench_concurrency import jobs_to_start
+from tests.fake_comfyui import FakeComfyUI, png_image
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+JOB_FILES = [os.path.join(ROOT, "test_input.json")] + sorted(
+    glob.glob(os.path.join(ROOT, "test_resources", "workflows", "*.json"))
+)
+
+
+def serve_fake_comfyui(connection, options):
+    """Run the fake ComfyUI in a child process until the parent asks it to stop"""
+    with FakeComfyUI(**options) as fake:
+        connection.send(fake.host)
+        connection.recv()
+
+
+def load_jobs(input_images, image_size):
+    """
+    Returns:
+        list: The input of every job file, with input_images images added to each
+    """
+    jobs = []
+    for path in JOB_FILES:
+        with open(path) as f:
+            job_input = json.load(f)["input"]
+        if input_images:
+            image = base64.b64encode(png_image(*image_size)).decode("utf-8")
+            job_input["images"] = [
+                {"name": f"bench_{index}.png", "image": image}
+                for index in range(input_images)
+            ]
+        jobs.append(job_input)
+    return jobs
+
+
+def percentile(values, percent):
+    """The value below which percent of the sorted values are (nearest rank)"""
+    index = max(0, min(len(values) - 1, round(percent / 100 * len(values)) - 1))
+    return sorted(values)[index]
+
+
+def overhead_ms(timings):
+    """The time of a job that was not spent waiting for ComfyUI to run its prompts"""
+    comfy_ms = sum(
+        prompt.get("queue_wait_ms", 0) + prompt.get("execution_ms", 0)
+        for prompt in timings["prompts"].values()
+    )
+    return timings["total_ms"] - comfy_ms
+
+
+async def run_worker(job_inputs, jobs):
+    """Start jobs whenever the concurrency modifier allows more, like runpod 1.6"""
+
+    async def run_job(index):
+        job_input = {**job_inputs[index % len(job_inputs)], "metrics": True}
+        start = time.perf_counter()
+        result = await rp_handler.async_handler({"id": str(index), "input": job_input})
+        return time.perf_counter() - start, result
+
+    tasks = []
+    concurrency = 1
+    while len(tasks) < jobs:
+        running = rp_handler.concurrency_state["running"]
+        concurrency = rp_handler.concurrency_modifier(concurrency)
+        count = min(jobs_to_start(concurrency, running), jobs - len(tasks))
+        if not count:
+            await asyncio.sleep(0.001)
+            continue
+        for _ in range(count):
+            tasks.append(asyncio.create_task(run_job(len(tasks))))
+        # Give the jobs a chance to start before asking again
+        await asyncio.sleep(0)
+    return await asyncio.gather(*tasks)
+
+
+def measure(host, folders, concurrency, job_inputs, jobs, trace_memory):
+    environ = {
+        "COMFY_OUTPUT_PATH": folders["output_dir"],
+        "COMFY_TEMP_PATH": folders["temp_dir"],
+        "COMFY_INPUT_PATH": folders["input_dir"],
+    }
+    with patch.object(rp_handler, "COMFY_HOST", host), patch.object(
+        rp_handler, "MAX_CONCURRENCY", concurrency
+    ), patch.object(rp_handler, "CONCURRENCY_CHECK_INTERVAL_MS", 0), patch.dict(
+        os.environ, environ
+    ):
+        if trace_memory:
+            tracemalloc.start()
+        cpu_start = time.process_time()
+        start = time.perf_counter()
+        results = asyncio.run(run_worker(job_inputs, jobs))
+        duration = time.perf_counter() - start
+        cpu_s = time.process_time() - cpu_start
+        if trace_memory:
+            _, peak_bytes = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+    latencies = [latency * 1000 for latency, _ in results]
+    overheads = [overhead_ms(result["metrics"]) for _, result in results]
+    failed = sum(1 for _, result in results if result.get("status") != "success")
+    summary = {
+        "concurrency": concurrency,
+        "jobs": jobs,
+        "failed": failed,
+        "duration_s": round(duration, 3),
+        "jobs_per_s": round(jobs / duration, 2),
+        "latency_ms": {
+            name: round(percentile(latencies, percent), 1)
+            for name, percent in (("p50", 50), ("p95", 95), ("p99", 99))
+        },
+        "overhead_ms": {
+            name: round(percentile(overheads, percent), 1)
+            for name, percent in (("p50", 50), ("p95", 95), ("p99", 99))
+        },
+        "cpu_ms_per_job": round(cpu_s / jobs * 1000, 1),
+    }
+    if trace_memory:
+        summary["peak_traced_mb"] = round(peak_bytes / 1024**2, 1)
+    if resource is not None:
+        # Kilobytes on Linux, the peak since the start of the process
+        summary["max_rss_mb"] = round(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1
+        )
+    return summary
+
+
+def compare(results, baseline):
+    """Print the change of the throughput and the latency per concurrency level"""
+    before = {level["concurrency"]: level for level in baseline["levels"]}
+    for level in results["levels"]:
+        old = before.get(level["concurrency"])
+        if old is None:
+            continue
+        print(
+            "concurrency %d: %.2f -> %.2f jobs/s, p95 %.1f -> %.1f ms, "
+            "overhead p95 %.1f -> %.1f ms, CPU %.1f -> %.1f ms/job"
+            % (
+                level["concurrency"],
+                old["jobs_per_s"],
+                level["jobs_per_s"],
+                old["latency_ms"]["p95"],
+                level["latency_ms"]["p95"],
+                old["overhead_ms"]["p95"],
+                level["overhead_ms"]["p95"],
+                old["cpu_ms_per_job"],
+                level["cpu_ms_per_job"],
+            )
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--jobs", type=int, default=50)
+    parser.add_argument(
+        "--concurrency", default="1,2,4", help="Comma-separated concurrency levels"
+    )
+    parser.add_argument(
+        "--node-ms", type=float, default=20, help="Render time of every node"
+    )
+    parser.add_argument(
+        "--image-size", default="512x512", help="Size of the output images"
+    )
+    parser.add_argument(
+        "--input-images", type=int, default=0, help="Images to upload with every job"
+    )
+    parser.add_argument(
+        "--trace-memory",
+        action="store_true",
+        help="Measure the peak memory of Python objects, slows the handler down",
+    )
+    parser.add_argument("--output", help="Save the results as JSON")
+    parser.add_argument("--baseline", help="Compare with the JSON of an earlier run")
+    args = parser.parse_args()
+
+    image_size = tuple(int(value) for value in args.image_size.split("x"))
+    levels = [int(value) for value in args.concurrency.split(",")]
+    job_inputs = load_jobs(args.input_images, image_size)
+
+    with tempfile.TemporaryDirectory() as root:
+        folders = {}
+        for name in ("output_dir", "temp_dir", "input_dir"):
+            folders[name] = os.path.join(root, name)
+            os.mkdir(folders[name])
+
+        parent, child = multiprocessing.Pipe()
+        options = {
+            "render_time": args.node_ms / 1000,
+            "image_size": image_size,
+            **folders,
+        }
+        server = multiprocessing.Process(
+            target=serve_fake_comfyui, args=(child, options), daemon=True
+        )
+        server.start()
+        host = parent.recv()
+        try:
+            # Warm up the connections and the imports of the handler
+            measure(host, folders, 1, job_inputs, 1, False)
+            results = {
+                "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "python": platform.python_version(),
+                "options": vars(args),
+                "levels": [
+                    measure(
+                        host, folders, level, job_inputs, args.jobs, args.trace_memory
+                    )
+                    for level in levels
+                ],
+            }
+        finally:
+            parent.send("stop")
+            server.join()
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
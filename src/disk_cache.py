@@ -0,0 +1,207 @@
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+# Keys are used as filenames, so only allow hex digests
+KEY_PATTERN = re.compile(r"^[0-9a-f]{16,128}$")
+# Temporary files that weren't written for this long (in seconds) are left over
+# from a crash, younger ones might still be written by another worker
+TEMPORARY_FILE_MAX_AGE_S = 3600
+
+
+class DiskCache:
+    """
+    Key-value store on the local disk (or the network volume) of the worker.
+
+    Every value is stored as a file named by its key. The least recently used
+    values are evicted once the cache is bigger than max_bytes, and values that
+    are older than ttl_s are treated as missing.
+
+    Args:
+        path (str): The folder of the cache
+        max_bytes (int): The maximum size of all values, 0 disables the cache
+        ttl_s (float, optional): The time in seconds after which a value expires
+    """
+
+    def __init__(self, path, max_bytes, ttl_s=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl_s = ttl_s
+        self.lock = threading.Lock()
+        # key => (size, time when it was stored), from least to most recently used
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._load()
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def _load(self):
+        """Pick up the values that are already on disk, e.g. from a previous run"""
+        if not self.enabled or not os.path.isdir(self.path):
+            return
+        files = []
+        for entry in os.scandir(self.path):
+            if entry.name.endswith(".tmp") and entry.is_file():
+                self._remove_stale(entry)
+            elif entry.is_file() and KEY_PATTERN.match(entry.name):
+                stat = entry.stat()
+                files.append((stat.st_atime, entry.name, stat.st_size, stat.st_mtime))
+        with self.lock:
+            for _, key, size, stored_at in sorted(files):
+                self.entries[key] = (size, stored_at)
+                self.size += size
+            self._evict()
+
+    @staticmethod
+    def _remove_stale(entry):
+        """Remove a temporary file of a write that never finished"""
+        try:
+            if time.time() - entry.stat().st_mtime > TEMPORARY_FILE_MAX_AGE_S:
+                os.remove(entry.path)
+        except OSError:
+            pass
+
+    def _file(self, key):
+        return os.path.join(self.path, key)
+
+    def _remove(self, key):
+        """Remove a value, the lock has to be held"""
+        size, _ = self.entries.pop(key, (0, 0))
+        self.size -= size
+        try:
+            os.remove(self._file(key))
+        except OSError:
+            pass
+
+    def _evict(self):
+        while self.size > self.max_bytes and self.entries:
+            key = next(iter(self.entries))
+            self._remove(key)
+            self.evictions += 1
+
+    def _expired(self, stored_at):
+        return self.ttl_s is not None and time.time() - stored_at > self.ttl_s
+
+    def get(self, key):
+        """
+        Return the value of a key.
+
+        Args:
+            key (str): The key, a hex digest
+
+        Returns:
+            bytes: The value or None if it is missing or expired
+        """
+        f = self.open(key)
+        if f is None:
+            return None
+        with f:
+            return f.read()
+
+    def open(self, key):
+        """
+        Open the value of a key, without reading it into memory.
+
+        The file stays readable when the value is evicted in the meantime.
+
+        Args:
+            key (str): The key, a hex digest
+
+        Returns:
+            file: The value as open binary file or None if it is missing or expired
+        """
+        key = key.lower()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or self._expired(entry[1]):
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+        try:
+            f = open(self._file(key), "rb")
+            # The atime is the last use, so that the order survives a restart
+            os.utime(self._file(key), (time.time(), entry[1]))
+        except OSError:
+            with self.lock:
+                self._remove(key)
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return f
+
+    def put(self, key, value):
+        """
+        Store a value.
+
+        Args:
+            key (str): The key, a hex digest
+            value (bytes): The value
+        """
+        key = key.lower()
+        if not KEY_PATTERN.match(key):
+            raise ValueError(f"Invalid cache key: {key}")
+        if not self.enabled or len(value) > self.max_bytes:
+            return
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and not self._expired(entry[1]):
+                self.entries.move_to_end(key)
+                return
+
+        os.makedirs(self.path, exist_ok=True)
+        # Write to a temporary file first, so that a crash never leaves a partial value
+        temporary_file = f"{self._file(key)}.{threading.get_ident()}.tmp"
+        with open(temporary_file, "wb") as f:
+            f.write(value)
+        self.put_file(key, temporary_file)
+
+    def put_file(self, key, temporary_file):
+        """
+        Store a value that was written to a file, which is moved into the cache.
+
+        The file is removed if the cache is disabled or the value is too big.
+        Files that are open stay readable either way.
+
+        Args:
+            key (str): The key, a hex digest
+            temporary_file (str): The file, in the folder of the cache
+        """
+        key = key.lower()
+        if not KEY_PATTERN.match(key):
+            raise ValueError(f"Invalid cache key: {key}")
+        size = os.path.getsize(temporary_file)
+        if not self.enabled or size > self.max_bytes:
+            os.remove(temporary_file)
+            return
+        os.replace(temporary_file, self._file(key))
+
+        with self.lock:
+            self.size -= self.entries.pop(key, (0, 0))[0]
+            self.entries[key] = (size, time.time())
+            self.size += size
+            self._evict()
+
+    def stats(self):
+        """
+        Returns:
+            dict: The hits, misses and evictions since the start and the current size
+        """
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+                "bytes": self.size,
+            }
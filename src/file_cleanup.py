@@ -0,0 +1,222 @@
+import heapq
+import os
+import shutil
+import threading
+import time
+
+
+class FileCleanup:
+    """
+    Removes the files that jobs leave in the folders of ComfyUI.
+
+    The files of a job are removed once they were delivered, or retention_s
+    later to keep them around for debugging. Independently, when the disk of
+    a folder is fuller than high_water_percent, the oldest files in the
+    folders are removed until it is at low_water_percent. Only files that
+    were registered as written by the worker (uploaded input images and
+    outputs) are ever removed, never the files that came with the image or
+    were put there by the user. Files that a job might still need are never
+    removed either: protected files (e.g. the input images of running jobs)
+    and files that are newer than the oldest running job.
+
+    Args:
+        folders (list): The folders whose files can be evicted
+        retention_s (float): Time in seconds that files are kept after delivery
+        high_water_percent (float): Disk usage above which files are evicted, 0 disables it
+        low_water_percent (float): Disk usage at which the eviction stops
+    """
+
+    def __init__(self, folders, retention_s, high_water_percent, low_water_percent):
+        self.folders = folders
+        self.retention_s = retention_s
+        self.high_water_percent = high_water_percent
+        self.low_water_percent = low_water_percent
+        self.lock = threading.Lock()
+        # (time to remove it, path, (size, mtime) when it was delivered)
+        self.scheduled = []
+        # path => number of jobs that use the file
+        self.protected = {}
+        # job_id => time.time() when the job started
+        self.jobs = {}
+        # Paths of the files that the worker wrote, the only ones that are removed
+        self.written = set()
+        self.removed_files = 0
+        self.removed_bytes = 0
+
+    def job_started(self, job_id):
+        with self.lock:
+            self.jobs[job_id] = time.time()
+
+    def job_finished(self, job_id):
+        with self.lock:
+            self.jobs.pop(job_id, None)
+
+    def register(self, paths):
+        """
+        Register files that the worker wrote, so that they can be removed.
+
+        Args:
+            paths (iterable): The paths of the files
+        """
+        with self.lock:
+            self.written.update(paths)
+
+    def protect(self, paths):
+        with self.lock:
+            for path in paths:
+                self.protected[path] = self.protected.get(path, 0) + 1
+
+    def unprotect(self, paths):
+        with self.lock:
+            for path in paths:
+                count = self.protected.pop(path, 0)
+                if count > 1:
+                    self.protected[path] = count - 1
+
+    def _remove_file(self, path, signature=None):
+        """
+        Remove a registered file, unless it is protected or changed since it was delivered.
+
+        Returns:
+            int: The size of the removed file, None if it was not removed
+        """
+        with self.lock:
+            if path in self.protected or path not in self.written:
+                return None
+        try:
+            stat = os.stat(path)
+            if signature is not None and signature != (stat.st_size, stat.st_mtime_ns):
+                return None
+            os.remove(path)
+        except FileNotFoundError:
+            with self.lock:
+                self.written.discard(path)
+            return None
+        except OSError:
+            return None
+        with self.lock:
+            self.written.discard(path)
+            self.removed_files += 1
+            self.removed_bytes += stat.st_size
+        return stat.st_size
+
+    def remove(self, paths):
+        """
+        Remove the registered files of a job that were delivered, now or after retention_s.
+
+        Args:
+            paths (iterable): The paths of the files
+        """
+        if not self.retention_s:
+            for path in paths:
+                self._remove_file(path)
+            return
+
+        remove_at = time.time() + self.retention_s
+        for path in paths:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            with self.lock:
+                heapq.heappush(
+                    self.scheduled,
+                    (remove_at, path, (stat.st_size, stat.st_mtime_ns)),
+                )
+
+    def remove_expired(self):
+        """
+        Remove the files whose retention window is over.
+
+        Returns:
+            int: The number of removed files
+        """
+        removed = 0
+        while True:
+            with self.lock:
+                if not self.scheduled or self.scheduled[0][0] > time.time():
+                    return removed
+                _, path, signature = heapq.heappop(self.scheduled)
+            if self._remove_file(path, signature) is not None:
+                removed += 1
+
+    def _evictable_files(self, folders):
+        """The registered files in the folders, from the oldest to the newest"""
+        prefixes = tuple(
+            os.path.join(os.path.normpath(folder), "") for folder in folders
+        )
+        with self.lock:
+            # Files of running jobs are newer than the job itself
+            cutoff = min(self.jobs.values(), default=time.time())
+            paths = [
+                path
+                for path in self.written
+                if os.path.normpath(path).startswith(prefixes)
+            ]
+        files = []
+        for path in paths:
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                with self.lock:
+                    self.written.discard(path)
+                continue
+            except OSError:
+                continue
+            if stat.st_mtime < cutoff:
+                files.append((stat.st_mtime, path))
+        return [path for _, path in sorted(files)]
+
+    def evict(self):
+        """
+        Remove the oldest registered files while the disk of a folder is above the high-water mark.
+
+        Returns:
+            int: The number of removed files
+        """
+        if not self.high_water_percent:
+            return 0
+
+        # Folders on the same disk share its space
+        disks = {}
+        for folder in self.folders:
+            try:
+                disks.setdefault(os.stat(folder).st_dev, []).append(folder)
+            except OSError:
+                continue
+
+        removed = 0
+        for folders in disks.values():
+            usage = shutil.disk_usage(folders[0])
+            if usage.used / usage.total * 100 <= self.high_water_percent:
+                continue
+            target_bytes = usage.total * self.low_water_percent / 100
+            used_bytes = usage.used
+            for path in self._evictable_files(folders):
+                if used_bytes <= target_bytes:
+                    break
+                size = self._remove_file(path)
+                if size is not None:
+                    used_bytes -= size
+                    removed += 1
+        return removed
+
+    def run_once(self):
+        """
+        Returns:
+            int: The number of files that were removed because their retention
+                 window is over or the disk was too full
+        """
+        return self.remove_expired() + self.evict()
+
+    def stats(self):
+        """
+        Returns:
+            dict: The removed files and bytes since the start and the scheduled files
+        """
+        with self.lock:
+            return {
+                "removed_files": self.removed_files,
+                "removed_bytes": self.removed_bytes,
+                "scheduled": len(self.scheduled),
+            }
@@ -0,0 +1,63 @@
+import hashlib
+import os
+import tempfile
+
+from disk_cache import DiskCache
+from input_stream import decode_base64_to_file
+
+
+class InputCache(DiskCache):
+    """
+    Content-addressed store for input images on the local disk of the worker.
+
+    Every image is stored by its SHA-256, so that jobs on a warm worker can
+    reference an image by its hash instead of sending it again.
+
+    Args:
+        path (str): The folder of the store
+        max_bytes (int): The maximum size of all images, 0 disables the store
+    """
+
+    def add(self, blob):
+        """
+        Add an image to the store.
+
+        Args:
+            blob (bytes): The image
+
+        Returns:
+            str: The SHA-256 of the image
+        """
+        sha256 = hashlib.sha256(blob).hexdigest()
+        self.put(sha256, blob)
+        return sha256
+
+    def add_base64(self, data):
+        """
+        Decode a base64 encoded image into the store, without holding the decoded image in memory.
+
+        Args:
+            data (str): The base64 encoded image, optionally as data URI
+
+        Returns:
+            tuple: (file, sha256) with the image as open binary file, which
+                   stays readable when the image is evicted or not stored
+
+        Raises:
+            binascii.Error: If the data is not valid base64
+            TypeError: If the data is not a string
+        """
+        os.makedirs(self.path, exist_ok=True)
+        descriptor, temporary_file = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        f = os.fdopen(descriptor, "w+b")
+        try:
+            _, sha256 = decode_base64_to_file(data, f)
+            f.flush()
+            self.put_file(sha256, temporary_file)
+        except BaseException:
+            f.close()
+            if os.path.exists(temporary_file):
+                os.remove(temporary_file)
+            raise
+        f.seek(0)
+        return f, sha256
@@ -0,0 +1,145 @@
+import base64
+import hashlib
+import io
+import os
+import uuid
+
+# Number of base64 characters that are decoded at once, a multiple of 4
+DECODE_CHUNK_CHARS = 4 * 1024 * 1024
+
+
+def base64_size(data):
+    """
+    Args:
+        data (str): A base64 encoded image, optionally as data URI
+
+    Returns:
+        int: The size of the decoded image in bytes, at most
+    """
+    return len(data) // 4 * 3
+
+
+def decode_base64_to_file(data, f):
+    """
+    Decode a base64 encoded image into a file, a part at a time.
+
+    Only DECODE_CHUNK_CHARS of the image are held in memory twice, instead of
+    the whole image. Whitespace is skipped, so line-wrapped (MIME) base64 works.
+
+    Args:
+        data (str): The base64 encoded image, optionally as data URI (data:image/png;base64,...)
+        f (file): The binary file that the image is written to
+
+    Returns:
+        tuple: (size, sha256) of the decoded image
+
+    Raises:
+        binascii.Error: If the data is not valid base64
+        TypeError: If the data is not a string
+    """
+    if not isinstance(data, str):
+        raise TypeError("The image must be a base64 encoded string")
+    start = 0
+    # Skip the "data:image/png;base64," prefix of data URIs
+    if data.startswith("data:") and "," in data:
+        start = data.index(",") + 1
+    digest = hashlib.sha256()
+    size = 0
+    # Characters without whitespace that don't fill a group of 4 yet
+    rest = ""
+    for offset in range(start, len(data), DECODE_CHUNK_CHARS):
+        chunk = rest + "".join(data[offset : offset + DECODE_CHUNK_CHARS].split())
+        end = len(chunk) // 4 * 4
+        rest = chunk[end:]
+        decoded = base64.b64decode(chunk[:end], validate=True)
+        digest.update(decoded)
+        f.write(decoded)
+        size += len(decoded)
+    if rest:
+        # Raises for the incomplete group
+        base64.b64decode(rest, validate=True)
+    return size, digest.hexdigest()
+
+
+class MultipartFile:
+    """
+    A multipart/form-data body with a file that is read from disk while it is sent.
+
+    requests reads files of a multipart upload into memory at once. This body
+    has a length, so it is sent with a Content-Length instead of chunked, and
+    only holds the part that is sent right now. It can be rewound, so that
+    urllib3 can send it again when a request is retried.
+
+    Args:
+        field (str): The name of the form field of the file
+        filename (str): The name of the file
+        f (file): The open binary file, from its current position to its end
+        content_type (str): The MIME type of the file
+        fields (dict, optional): More form fields, name => value
+    """
+
+    def __init__(self, field, filename, f, content_type, fields=None):
+        self.boundary = uuid.uuid4().hex
+        header = b""
+        for name, value in (fields or {}).items():
+            header += (
+                f"--{self.boundary}\r\n"
+                f'Content-Disposition: form-data; name="{name}"\r\n\r\n'
+                f"{value}\r\n"
+            ).encode("utf-8")
+        # Quotes would end the filename early, browsers escape them the same way
+        filename = filename.replace('"', "%22")
+        header += (
+            f"--{self.boundary}\r\n"
+            f'Content-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+            f"Content-Type: {content_type}\r\n\r\n"
+        ).encode("utf-8")
+        footer = f"\r\n--{self.boundary}--\r\n".encode("utf-8")
+        start = f.tell()
+        # (stream, start in the stream, length) of the parts of the body
+        self.parts = [
+            (io.BytesIO(header), 0, len(header)),
+            (f, start, os.fstat(f.fileno()).st_size - start),
+            (io.BytesIO(footer), 0, len(footer)),
+        ]
+        self.length = sum(length for _, _, length in self.parts)
+        self.position = 0
+
+    @property
+    def content_type(self):
+        return f"multipart/form-data; boundary={self.boundary}"
+
+    def __len__(self):
+        return self.length
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.length
+        self.position = max(0, min(offset, self.length))
+        return self.position
+
+    def read(self, size=-1):
+        remaining = self.length - self.position
+        if size is not None and size >= 0:
+            remaining = min(size, remaining)
+        chunks = []
+        while remaining > 0:
+            # The part at the current position
+            offset = self.position
+            for stream, start, length in self.parts:
+                if offset < length:
+                    break
+                offset -= length
+            stream.seek(start + offset)
+            chunk = stream.read(min(remaining, length - offset))
+            if not chunk:
+                break
+            chunks.append(chunk)
+            self.position += len(chunk)
+            remaining -= len(chunk)
+        return b"".join(chunks)
@@ -0,0 +1,371 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds in seconds of the buckets of every histogram
+HISTOGRAM_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _ms(seconds):
+    return round(seconds * 1000, 1)
+
+
+class JobMetrics:
+    """
+    Timings of a single job, measured with a monotonic clock.
+
+    The phases of the handler (e.g. "upload" or "outputs") are measured with
+    phase(). The time a prompt waited in the queue of ComfyUI, its execution
+    time and the time of every node come from the WebSocket events of ComfyUI.
+
+    Args:
+        job_id (str): The unique identifier for the job
+    """
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.requested = False
+        self.lock = threading.Lock()
+        self.started_at = time.monotonic()
+        self.finished_at = None
+        # name => seconds, phases that run more than once are added up
+        self.phases = {}
+        # prompt_id => timestamps and nodes of the prompt
+        self.prompts = {}
+        # The models of the job and the models that were loaded before it
+        self.models = None
+        # cache name => "hits" and "misses" of the lookups of the job
+        self.caches = {}
+
+    @contextmanager
+    def phase(self, name):
+        """Measure the time of a phase, can be used from several threads at once"""
+        started_at = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add_phase(name, time.monotonic() - started_at)
+
+    def add_phase(self, name, seconds):
+        with self.lock:
+            self.phases[name] = self.phases.get(name, 0) + seconds
+
+    def cache_lookup(self, name, hit):
+        """
+        Count a lookup of the job in one of the caches of the worker.
+
+        Args:
+            name (str): The cache, e.g. "input_cache" or "url_cache"
+            hit (bool): Whether the cache had the value
+        """
+        with self.lock:
+            counts = self.caches.setdefault(name, {"hits": 0, "misses": 0})
+            counts["hits" if hit else "misses"] += 1
+
+    def prompt_queued(self, prompt_id, workflow):
+        """
+        Args:
+            prompt_id (str): The ID of the prompt as returned by ComfyUI
+            workflow (dict): The workflow of the prompt, to know the class of every node
+        """
+        with self.lock:
+            self.prompts[prompt_id] = {
+                "workflow": workflow,
+                "queued": time.monotonic(),
+                "started": None,
+                "finished": None,
+                "done": None,
+                "current_node": None,
+                "nodes": {},
+            }
+
+    def prompt_done(self, prompt_id):
+        """The worker noticed that the prompt is done, with or without WebSocket events"""
+        with self.lock:
+            prompt = self.prompts.get(prompt_id)
+            if prompt is not None and prompt["done"] is None:
+                prompt["done"] = time.monotonic()
+
+    def observe_event(self, event):
+        """
+        Update the timings of a prompt from a WebSocket event of ComfyUI.
+
+        Args:
+            event (dict): The parsed event
+        """
+        data = event.get("data") or {}
+        now = time.monotonic()
+        with self.lock:
+            prompt = self.prompts.get(data.get("prompt_id"))
+            if prompt is None:
+                return
+
+            if event["type"] == "execution_start":
+                prompt["started"] = now
+            elif event["type"] == "execution_cached":
+                for node_id in data.get("nodes") or []:
+                    self._node(prompt, node_id)["cached"] = True
+            elif event["type"] == "executing":
+                self._finish_node(prompt, now)
+                if data.get("node") is None:
+                    prompt["finished"] = now
+                else:
+                    prompt["current_node"] = (str(data["node"]), now)
+            elif event["type"] in ("execution_error", "execution_interrupted"):
+                self._finish_node(prompt, now)
+                prompt["finished"] = now
+
+    def _node(self, prompt, node_id):
+        node_id = str(node_id)
+        if node_id not in prompt["nodes"]:
+            node = prompt["workflow"].get(node_id) or {}
+            prompt["nodes"][node_id] = {"class_type": node.get("class_type"), "ms": 0}
+        return prompt["nodes"][node_id]
+
+    def _finish_node(self, prompt, now):
+        if prompt["current_node"] is not None:
+            node_id, started_at = prompt["current_node"]
+            self._node(prompt, node_id)["ms"] += _ms(now - started_at)
+            prompt["current_node"] = None
+
+    def finish(self):
+        """Stop the clock of the job"""
+        if self.finished_at is None:
+            self.finished_at = time.monotonic()
+
+    def to_dict(self):
+        """
+        Returns:
+            dict: The total time, the phases and the prompts of the job in milliseconds,
+                  the models of the job, if they are known, and its cache lookups
+        """
+        with self.lock:
+            finished_at = self.finished_at or time.monotonic()
+            prompts = {}
+            for prompt_id, prompt in self.prompts.items():
+                timings = {}
+                if prompt["started"] is not None:
+                    timings["queue_wait_ms"] = _ms(prompt["started"] - prompt["queued"])
+                    if prompt["finished"] is not None:
+                        timings["execution_ms"] = _ms(
+                            prompt["finished"] - prompt["started"]
+                        )
+                if prompt["done"] is not None:
+                    timings["wait_ms"] = _ms(prompt["done"] - prompt["queued"])
+                timings["nodes"] = {
+                    node_id: dict(node) for node_id, node in prompt["nodes"].items()
+                }
+                prompts[prompt_id] = timings
+
+            result = {
+                "job_id": self.job_id,
+                "total_ms": _ms(finished_at - self.started_at),
+                "phases": {name: _ms(seconds) for name, seconds in self.phases.items()},
+                "prompts": prompts,
+            }
+            if self.models is not None:
+                result["models"] = self.models
+            if self.caches:
+                result["caches"] = {
+                    name: dict(counts) for name, counts in self.caches.items()
+                }
+            return result
+
+
+def _labels(labels):
+    escaped = (
+        (
+            name,
+            str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"),
+        )
+        for name, value in sorted(labels.items())
+    )
+    return ",".join(f'{name}="{value}"' for name, value in escaped)
+
+
+class PrometheusTextFile:
+    """
+    Histograms of the job metrics, written as a text file in the Prometheus format.
+
+    The file can be picked up by the textfile collector of the node exporter.
+    It is replaced atomically after every job, so a scrape never sees half a file.
+
+    Args:
+        path (str): The file to write, empty to only collect the metrics
+    """
+
+    HELP = {
+        "runpod_worker_comfy_job_seconds": "Total time of a job",
+        "runpod_worker_comfy_phase_seconds": "Time spent in a phase of a job",
+        "runpod_worker_comfy_queue_wait_seconds": "Time a prompt waited in the queue of ComfyUI",
+        "runpod_worker_comfy_execution_seconds": "Time ComfyUI spent executing a prompt",
+        "runpod_worker_comfy_node_seconds": "Time ComfyUI spent executing a node",
+    }
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        # (metric, labels) => [count per bucket, sum, count]
+        self.histograms = {}
+        # status => number of jobs
+        self.jobs = {}
+        # (duration in seconds, status) of the warm-up workflow
+        self.warmup = None
+        # "hit", "miss" or "free" => number of jobs, see observe
+        self.model_residency = {}
+        # (cache, "hit" or "miss") => number of lookups
+        self.cache_lookups = {}
+
+    @property
+    def enabled(self):
+        return bool(self.path)
+
+    def _observe(self, metric, labels, seconds):
+        key = (metric, _labels(labels))
+        histogram = self.histograms.setdefault(
+            key, [[0] * len(HISTOGRAM_BUCKETS), 0.0, 0]
+        )
+        for index, bound in enumerate(HISTOGRAM_BUCKETS):
+            if seconds <= bound:
+                histogram[0][index] += 1
+        histogram[1] += seconds
+        histogram[2] += 1
+
+    def observe(self, metrics, status):
+        """
+        Add the timings of a finished job.
+
+        Args:
+            metrics (dict): The job metrics as returned by JobMetrics.to_dict
+            status (str): The status of the job, e.g. "success" or "error"
+        """
+        with self.lock:
+            self.jobs[status] = self.jobs.get(status, 0) + 1
+            models = metrics.get("models")
+            if models and models["required"]:
+                # Were the models of the job loaded already, or had others to be unloaded?
+                if models["freed"]:
+                    result = "free"
+                elif set(models["required"]) <= set(models["resident"]):
+                    result = "hit"
+                else:
+                    result = "miss"
+                self.model_residency[result] = self.model_residency.get(result, 0) + 1
+            for name, counts in (metrics.get("caches") or {}).items():
+                for result, key in (("hit", "hits"), ("miss", "misses")):
+                    self.cache_lookups[(name, result)] = (
+                        self.cache_lookups.get((name, result), 0) + counts[key]
+                    )
+            self._observe(
+                "runpod_worker_comfy_job_seconds", {}, metrics["total_ms"] / 1000
+            )
+            for name, ms in metrics["phases"].items():
+                self._observe(
+                    "runpod_worker_comfy_phase_seconds", {"phase": name}, ms / 1000
+                )
+            for prompt in metrics["prompts"].values():
+                if "queue_wait_ms" in prompt:
+                    self._observe(
+                        "runpod_worker_comfy_queue_wait_seconds",
+                        {},
+                        prompt["queue_wait_ms"] / 1000,
+                    )
+                if "execution_ms" in prompt:
+                    self._observe(
+                        "runpod_worker_comfy_execution_seconds",
+                        {},
+                        prompt["execution_ms"] / 1000,
+                    )
+                for node in prompt["nodes"].values():
+                    if not node.get("cached"):
+                        self._observe(
+                            "runpod_worker_comfy_node_seconds",
+                            {"class_type": node["class_type"]},
+                            node["ms"] / 1000,
+                        )
+
+    def set_warmup(self, seconds, status):
+        """
+        Args:
+            seconds (float): The duration of the warm-up workflow
+            status (str): "success" or "error"
+        """
+        with self.lock:
+            self.warmup = (seconds, status)
+
+    def render(self):
+        """
+        Returns:
+            str: All metrics in the text format of Prometheus
+        """
+        lines = [
+            "# HELP runpod_worker_comfy_jobs_total Number of finished jobs",
+            "# TYPE runpod_worker_comfy_jobs_total counter",
+        ]
+        with self.lock:
+            if self.warmup is not None:
+                seconds, status = self.warmup
+                lines = [
+                    "# HELP runpod_worker_comfy_warmup_seconds Duration of the warm-up workflow",
+                    "# TYPE runpod_worker_comfy_warmup_seconds gauge",
+                    f"runpod_worker_comfy_warmup_seconds{{{_labels({'status': status})}}} {seconds}",
+                ] + lines
+            for status, count in sorted(self.jobs.items()):
+                lines.append(
+                    f"runpod_worker_comfy_jobs_total{{{_labels({'status': status})}}} {count}"
+                )
+            if self.model_residency:
+                lines.append(
+                    "# HELP runpod_worker_comfy_model_residency_total Number of jobs "
+                    "whose models were loaded (hit), not loaded (miss) or had to make room (free)"
+                )
+                lines.append("# TYPE runpod_worker_comfy_model_residency_total counter")
+                for result, count in sorted(self.model_residency.items()):
+                    lines.append(
+                        f"runpod_worker_comfy_model_residency_total{{{_labels({'result': result})}}} {count}"
+                    )
+            if self.cache_lookups:
+                lines.append(
+                    "# HELP runpod_worker_comfy_cache_lookups_total Number of input "
+                    "images that jobs found in a cache of the worker (hit) or not (miss)"
+                )
+                lines.append("# TYPE runpod_worker_comfy_cache_lookups_total counter")
+                for (name, result), count in sorted(self.cache_lookups.items()):
+                    labels = _labels({"cache": name, "result": result})
+                    lines.append(
+                        f"runpod_worker_comfy_cache_lookups_total{{{labels}}} {count}"
+                    )
+            for metric, help_text in self.HELP.items():
+                histograms = sorted(
+                    (labels, values)
+                    for (name, labels), values in self.histograms.items()
+                    if name == metric
+                )
+                if not histograms:
+                    continue
+                lines.append(f"# HELP {metric} {help_text}")
+                lines.append(f"# TYPE {metric} histogram")
+                for labels, (buckets, total, count) in histograms:
+                    prefix = f"{labels}," if labels else ""
+                    for bound, bucket_count in zip(HISTOGRAM_BUCKETS, buckets):
+                        lines.append(
+                            f'{metric}_bucket{{{prefix}le="{bound}"}} {bucket_count}'
+                        )
+                    lines.append(f'{metric}_bucket{{{prefix}le="+Inf"}} {count}')
+                    suffix = f"{{{labels}}}" if labels else ""
+                    lines.append(f"{metric}_sum{suffix} {total}")
+                    lines.append(f"{metric}_count{suffix} {count}")
+        return "\n".join(lines) + "\n"
+
+    def write(self):
+        """Replace the file with the current metrics"""
+        if not self.enabled:
+            return
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temporary_file = f"{self.path}.{threading.get_ident()}.tmp"
+        with open(temporary_file, "w") as f:
+            f.write(self.render())
+        os.replace(temporary_file, self.path)
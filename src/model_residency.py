@@ -0,0 +1,193 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# Extensions of the model files that workflows reference by name
+MODEL_EXTENSIONS = (".safetensors", ".sft", ".ckpt", ".pt", ".pth", ".bin", ".gguf")
+
+
+def workflow_models(workflow):
+    """
+    Args:
+        workflow (dict): A workflow in the API format
+
+    Returns:
+        list: The model files that the nodes of the workflow load, e.g. checkpoints,
+              UNETs, CLIPs, VAEs and LoRAs, sorted by name
+    """
+    models = set()
+    for node in workflow.values():
+        if not isinstance(node, dict):
+            continue
+        for value in (node.get("inputs") or {}).values():
+            if isinstance(value, str) and value.lower().endswith(MODEL_EXTENSIONS):
+                models.add(value)
+    return sorted(models)
+
+
+class ModelResidency:
+    """
+    Keeps track of the models that ComfyUI holds in memory, least recently used first.
+
+    ComfyUI decides on its own which models it keeps loaded, which makes
+    workers with mixed traffic (e.g. SDXL, then Flux, then SD3) load models
+    over and over or run out of memory. The models of every job are noted
+    here, and before a job runs, needs_free() decides if the models of earlier
+    jobs have to be unloaded: when they would exceed max_models or when the
+    models that the job still has to load don't fit into the free memory.
+
+    The size of a model is the size of its file in one of model_paths, which
+    is about the memory it needs once it is loaded.
+
+    Args:
+        model_paths (list): The folders with the models of ComfyUI, e.g. /comfyui/models
+        max_models (int): Maximum number of resident models, 0 for no limit
+        reserve_bytes (int): Memory that a job needs on top of its models
+        min_index_interval_s (float): Minimum time between two scans of model_paths
+    """
+
+    def __init__(self, model_paths, max_models, reserve_bytes, min_index_interval_s=60):
+        self.model_paths = model_paths
+        self.max_models = max_models
+        self.reserve_bytes = reserve_bytes
+        self.min_index_interval_s = min_index_interval_s
+        self.lock = threading.Lock()
+        # Held while model_paths are scanned, which must never block self.lock
+        self.index_lock = threading.Lock()
+        # name => size in bytes, the least recently used model first
+        self.resident = OrderedDict()
+        # job_id => models of the jobs that are running
+        self.jobs = {}
+        # name => size in bytes of every model file in model_paths
+        self.sizes = None
+        self.indexed_at = None
+        self.frees = 0
+
+    def _index(self):
+        """Find the size of every model file, by its name relative to the folder of its type"""
+        sizes = {}
+        for model_path in self.model_paths:
+            if not os.path.isdir(model_path):
+                continue
+            for model_type in os.listdir(model_path):
+                type_path = os.path.join(model_path, model_type)
+                for directory, _, names in os.walk(type_path, followlinks=True):
+                    for name in names:
+                        path = os.path.join(directory, name)
+                        try:
+                            size = os.path.getsize(path)
+                        except OSError:
+                            continue
+                        # Workflows use "/" as separator, also on Windows
+                        relative = os.path.relpath(path, type_path).replace(os.sep, "/")
+                        sizes.setdefault(relative, size)
+        return sizes
+
+    def model_sizes(self, names):
+        """
+        Look up the sizes of model files, scanning model_paths if one is unknown.
+
+        Must not be called while holding self.lock, as the scan can take a while.
+
+        Args:
+            names (list): The names of the models
+
+        Returns:
+            dict: name => size of the model file in bytes, 0 if it is unknown
+        """
+        with self.index_lock:
+            stale = self.indexed_at is None or (
+                any(name not in self.sizes for name in names)
+                and time.monotonic() - self.indexed_at >= self.min_index_interval_s
+            )
+            if stale:
+                self.sizes = self._index()
+                self.indexed_at = time.monotonic()
+            return {name: self.sizes.get(name, 0) for name in names}
+
+    def size(self, name):
+        """
+        Returns:
+            int: The size of the model file in bytes, 0 if it is unknown
+        """
+        return self.model_sizes([name])[name]
+
+    def needs_free(self, models, free_memory, job_id=None):
+        """
+        Decide if ComfyUI has to unload its models before a job runs.
+
+        Models are only unloaded when the job has to load a model that is not
+        resident and some resident model is not needed by the job. As ComfyUI
+        unloads all of its models at once, nothing is unloaded while other jobs
+        are running.
+
+        Args:
+            models (list): The models of the job, see workflow_models
+            free_memory (callable): Returns the free memory of the GPU in bytes or None
+            job_id (str, optional): The job, which doesn't count as another job
+
+        Returns:
+            bool: True if the models should be unloaded
+        """
+        with self.lock:
+            missing = [name for name in models if name not in self.resident]
+            if not missing or not set(self.resident) - set(models):
+                return False
+            if any(other_id != job_id for other_id in self.jobs):
+                return False
+            if self.max_models and len(set(self.resident) | set(models)) > (
+                self.max_models
+            ):
+                return True
+
+        needed_bytes = sum(self.model_sizes(missing).values())
+        free_bytes = free_memory()
+        if free_bytes is None or not needed_bytes:
+            return False
+        return needed_bytes + self.reserve_bytes > free_bytes
+
+    def freed(self):
+        """ComfyUI unloaded all of its models"""
+        with self.lock:
+            self.resident.clear()
+            self.frees += 1
+
+    def job_started(self, job_id, models):
+        """
+        The models of a job are loaded, which makes them the most recently used.
+
+        Args:
+            job_id (str): The unique identifier for the job
+            models (list): The models of the job, see workflow_models
+        """
+        sizes = self.model_sizes(models)
+        with self.lock:
+            self.jobs[job_id] = models
+            for name in models:
+                size = self.resident.pop(name, None)
+                self.resident[name] = sizes[name] if size is None else size
+
+    def job_finished(self, job_id):
+        with self.lock:
+            self.jobs.pop(job_id, None)
+
+    def resident_models(self):
+        """
+        Returns:
+            list: The names of the resident models, the least recently used first
+        """
+        with self.lock:
+            return list(self.resident)
+
+    def stats(self):
+        """
+        Returns:
+            dict: The resident models, their size and how often all models were unloaded
+        """
+        with self.lock:
+            return {
+                "resident": list(self.resident),
+                "resident_bytes": sum(self.resident.values()),
+                "frees": self.frees,
+            }
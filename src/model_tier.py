@@ -0,0 +1,429 @@
+import hashlib
+import json
+import os
+import shutil
+import sys
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# Folders of the model types that ComfyUI loads from extra_model_paths.yaml
+MODEL_FOLDERS = (
+    "checkpoints",
+    "clip",
+    "clip_vision",
+    "configs",
+    "controlnet",
+    "embeddings",
+    "loras",
+    "upscale_models",
+    "vae",
+    "unet",
+)
+# Free space in bytes that copies always leave on the local disk
+MIN_FREE_BYTES = 1024**3
+# Size of the parts in which a model is copied
+COPY_CHUNK_BYTES = 16 * 1024 * 1024
+# Name of the file that describes the cached models, in the folder of the cache
+MANIFEST_FILE = ".manifest.json"
+
+
+def sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(COPY_CHUNK_BYTES), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def extra_model_paths(source_path, cache_path, folders=MODEL_FOLDERS):
+    """
+    Build the extra_model_paths.yaml of ComfyUI with the cache in front of the source.
+
+    ComfyUI loads a model from the first folder that contains it, so the local
+    copy is used once it exists and the source until then.
+
+    Args:
+        source_path (str): The folder with the models, e.g. /runpod-volume/models
+        cache_path (str): The folder of the local copies
+        folders (iterable): The folders of the model types
+
+    Returns:
+        str: The content of the file
+    """
+    lines = []
+    for section, base_path in (
+        ("runpod_worker_comfy_cache", cache_path),
+        ("runpod_worker_comfy", source_path),
+    ):
+        lines.append(f"{section}:")
+        lines.append(f"  base_path: {base_path}")
+        lines.extend(f"  {folder}: {folder}/" for folder in folders)
+    return "\n".join(lines) + "\n"
+
+
+class ModelTier:
+    """
+    Copies of the models of the network volume on the local disk of the worker.
+
+    Loading a model from the network volume streams gigabytes over the network
+    for every cold job. The models of every job (and the hot_models) are
+    therefore copied to cache_path in the background, one at a time, and
+    ComfyUI prefers the local copy once it is there, see extra_model_paths.
+    The least recently used copies are evicted once the copies would need more
+    than max_bytes, except for the models of running jobs.
+
+    A copy is only used while the model on the volume has the size and mtime
+    it had when it was copied, otherwise it is removed and copied again. With
+    verify "sha256", a copy is checked against the SHA-256 of the source after
+    copying and again when the worker starts.
+
+    Args:
+        source_path (str): The folder with the models, e.g. /runpod-volume/models
+        cache_path (str): The folder of the copies on the local disk, "" disables the copies
+        max_bytes (int): The maximum size of all copies
+        verify (str): "mtime" to check copies by size and mtime, "sha256" to check their content
+        folders (iterable): The folders of the model types
+    """
+
+    def __init__(
+        self, source_path, cache_path, max_bytes, verify="mtime", folders=MODEL_FOLDERS
+    ):
+        self.source_path = source_path
+        self.cache_path = cache_path
+        self.max_bytes = max_bytes
+        self.verify = verify
+        self.folders = folders
+        self.lock = threading.Lock()
+        # "folder/name" => {"size", "mtime_ns", "sha256"} of the source when it
+        # was copied, from least to most recently used
+        self.entries = OrderedDict()
+        self.size = 0
+        # job_id => paths of the models of the running jobs, they are never evicted
+        self.jobs = {}
+        # Paths that are waiting to be copied
+        self.pending = set()
+        self.futures = []
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.hits = 0
+        self.misses = 0
+        self.copies = 0
+        self.copied_bytes = 0
+        self.evictions = 0
+        self.failures = 0
+        self._load()
+
+    @property
+    def enabled(self):
+        return bool(self.cache_path) and self.max_bytes > 0
+
+    def _cached_file(self, path):
+        return os.path.join(self.cache_path, path)
+
+    def _source_file(self, path):
+        return os.path.join(self.source_path, path)
+
+    def _load(self):
+        """Pick up the copies of a previous run whose file is still complete"""
+        if not self.enabled:
+            return
+        try:
+            with open(os.path.join(self.cache_path, MANIFEST_FILE)) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            manifest = {}
+        for path, entry in manifest.items():
+            try:
+                complete = os.path.getsize(self._cached_file(path)) == entry["size"]
+            except (OSError, KeyError, TypeError):
+                complete = False
+            if complete:
+                self.entries[path] = entry
+                self.size += entry["size"]
+            else:
+                self._remove_file(path)
+
+    def _save(self):
+        """Write the manifest, the lock has to be held"""
+        os.makedirs(self.cache_path, exist_ok=True)
+        manifest_file = os.path.join(self.cache_path, MANIFEST_FILE)
+        temporary_file = f"{manifest_file}.{uuid.uuid4().hex}.tmp"
+        with open(temporary_file, "w") as f:
+            json.dump(self.entries, f)
+        os.replace(temporary_file, manifest_file)
+
+    def _remove_file(self, path):
+        try:
+            os.remove(self._cached_file(path))
+        except OSError:
+            pass
+
+    def _remove(self, path):
+        """Remove a copy, the lock has to be held"""
+        entry = self.entries.pop(path, None)
+        if entry is not None:
+            self.size -= entry["size"]
+        self._remove_file(path)
+
+    def locate(self, name):
+        """
+        Find a model of a workflow in the source.
+
+        Args:
+            name (str): The name of the model, relative to the folder of its type
+
+        Returns:
+            str: The path relative to source_path, e.g. "unet/flux1-dev.safetensors",
+                 or None if the source doesn't have it
+        """
+        if os.path.isabs(name) or ".." in name.replace("\\", "/").split("/"):
+            return None
+        for folder in self.folders:
+            path = f"{folder}/{name}"
+            if os.path.isfile(self._source_file(path)):
+                return path
+        return None
+
+    def _is_current(self, path, entry):
+        """The copy is complete and the source didn't change since it was copied"""
+        try:
+            source = os.stat(self._source_file(path))
+            cached_size = os.path.getsize(self._cached_file(path))
+        except OSError:
+            return False
+        return (
+            source.st_size == entry["size"]
+            and source.st_mtime_ns == entry["mtime_ns"]
+            and cached_size == entry["size"]
+        )
+
+    def job_started(self, job_id, models):
+        """
+        Note the models of a job and copy the ones without a current copy in the background.
+
+        Copies whose source changed are removed right away, so that ComfyUI
+        loads the model from the source.
+
+        Args:
+            job_id (str): The unique identifier for the job
+            models (list): The models of the job, see model_residency.workflow_models
+
+        Returns:
+            list: The models that have a current copy on the local disk
+        """
+        if not self.enabled:
+            return []
+        cached = []
+        paths = []
+        for name in models:
+            path = self.locate(name)
+            if path is None:
+                continue
+            paths.append(path)
+            with self.lock:
+                entry = self.entries.get(path)
+                if entry is not None and not self._is_current(path, entry):
+                    self._remove(path)
+                    self._save()
+                    entry = None
+                if entry is not None:
+                    self.entries.move_to_end(path)
+                    self.hits += 1
+                    cached.append(name)
+                else:
+                    self.misses += 1
+        with self.lock:
+            self.jobs[job_id] = paths
+        self.prefetch(paths)
+        return cached
+
+    def job_finished(self, job_id):
+        with self.lock:
+            self.jobs.pop(job_id, None)
+
+    def prefetch(self, paths):
+        """
+        Copy models in the background, unless they have a copy or are waiting already.
+
+        Args:
+            paths (list): The paths relative to source_path, see locate
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            for path in paths:
+                if path in self.entries or path in self.pending:
+                    continue
+                self.pending.add(path)
+                self.futures.append(self.executor.submit(self._copy, path))
+            self.futures = [future for future in self.futures if not future.done()]
+
+    def prefetch_models(self, names):
+        """
+        Copy models by their name in the background, e.g. a list of hot models.
+
+        Args:
+            names (list): The names of the models, relative to the folder of their type
+
+        Returns:
+            list: The names that are not in the source
+        """
+        paths = [self.locate(name) for name in names]
+        self.prefetch([path for path in paths if path is not None])
+        return [name for name, path in zip(names, paths) if path is None]
+
+    def wait(self, timeout=None):
+        """Wait until the background copies that are queued right now are done"""
+        with self.lock:
+            futures = list(self.futures)
+        for future in futures:
+            future.result(timeout)
+
+    def _make_room(self, size):
+        """
+        Evict the least recently used copies that no running job needs, the lock has to be held.
+
+        Returns:
+            bool: True if a copy of the size fits into max_bytes
+        """
+        in_use = {path for paths in self.jobs.values() for path in paths}
+        for path in list(self.entries):
+            if self.size + size <= self.max_bytes:
+                break
+            if path not in in_use:
+                self._remove(path)
+                self.evictions += 1
+        return self.size + size <= self.max_bytes
+
+    def _copy(self, path):
+        try:
+            self._copy_file(path)
+        except OSError as e:
+            with self.lock:
+                self.failures += 1
+            print(f"runpod-worker-comfy - could not copy the model {path}: {e}")
+        finally:
+            with self.lock:
+                self.pending.discard(path)
+
+    def _copy_file(self, path):
+        source_file = self._source_file(path)
+        source = os.stat(source_file)
+        with self.lock:
+            if not self._make_room(source.st_size):
+                print(
+                    f"runpod-worker-comfy - the model {path} doesn't fit into the model cache"
+                )
+                return
+            self._save()
+        os.makedirs(self.cache_path, exist_ok=True)
+        if shutil.disk_usage(self.cache_path).free < source.st_size + MIN_FREE_BYTES:
+            print(
+                f"runpod-worker-comfy - not enough disk space to copy the model {path}"
+            )
+            return
+
+        # Copy next to the cache first, ComfyUI must never see a partial model
+        temporary_folder = os.path.join(self.cache_path, ".tmp")
+        os.makedirs(temporary_folder, exist_ok=True)
+        temporary_file = os.path.join(temporary_folder, uuid.uuid4().hex)
+        try:
+            digest = hashlib.sha256()
+            with open(source_file, "rb") as src, open(temporary_file, "wb") as dst:
+                for chunk in iter(lambda: src.read(COPY_CHUNK_BYTES), b""):
+                    if self.verify == "sha256":
+                        digest.update(chunk)
+                    dst.write(chunk)
+            shutil.copystat(source_file, temporary_file)
+            entry = {"size": source.st_size, "mtime_ns": source.st_mtime_ns}
+            if self.verify == "sha256":
+                entry["sha256"] = digest.hexdigest()
+                if sha256_file(temporary_file) != entry["sha256"]:
+                    raise OSError("the copy doesn't match the source")
+            if os.stat(source_file).st_mtime_ns != source.st_mtime_ns:
+                raise OSError("the model changed while it was copied")
+
+            cached_file = self._cached_file(path)
+            os.makedirs(os.path.dirname(cached_file), exist_ok=True)
+            os.replace(temporary_file, cached_file)
+        finally:
+            if os.path.exists(temporary_file):
+                os.remove(temporary_file)
+
+        with self.lock:
+            self.size -= self.entries.pop(path, {"size": 0})["size"]
+            self.entries[path] = entry
+            self.size += entry["size"]
+            self.copies += 1
+            self.copied_bytes += entry["size"]
+            self._save()
+
+    def verify_copies(self):
+        """
+        Remove the copies whose content doesn't match the SHA-256 of their source.
+
+        Returns:
+            list: The removed paths
+        """
+        with self.lock:
+            entries = list(self.entries.items())
+        removed = []
+        for path, entry in entries:
+            try:
+                valid = self._is_current(path, entry) and (
+                    "sha256" not in entry
+                    or sha256_file(self._cached_file(path)) == entry["sha256"]
+                )
+            except OSError:
+                valid = False
+            if not valid:
+                with self.lock:
+                    self._remove(path)
+                    self._save()
+                removed.append(path)
+        return removed
+
+    def start(self, hot_models=()):
+        """
+        Check the copies of a previous run and copy the hot models, in the background.
+
+        Args:
+            hot_models (list): Names of models that are copied before any job needs them
+
+        Returns:
+            list: The hot models that are not in the source
+        """
+        if not self.enabled:
+            return []
+        if self.verify == "sha256":
+            with self.lock:
+                self.futures.append(self.executor.submit(self.verify_copies))
+        return self.prefetch_models(list(hot_models))
+
+    def stats(self):
+        """
+        Returns:
+            dict: The hits, misses, copies and evictions since the start and the current size
+        """
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "copies": self.copies,
+                "copied_bytes": self.copied_bytes,
+                "evictions": self.evictions,
+                "failures": self.failures,
+                "entries": len(self.entries),
+                "bytes": self.size,
+            }
+
+
+if __name__ == "__main__":
+    # Write the extra_model_paths.yaml of ComfyUI before it starts, see start.sh
+    source_path = os.environ.get("MODEL_CACHE_SOURCE_PATH", "/runpod-volume/models")
+    cache_path = os.environ.get("MODEL_CACHE_PATH", "")
+    if not cache_path:
+        sys.exit("MODEL_CACHE_PATH is not set")
+    with open(sys.argv[1], "w") as f:
+        f.write(extra_model_paths(source_path, cache_path))
@@ -0,0 +1,211 @@
+import base64
+import mimetypes
+import os
+import tempfile
+import threading
+import time
+import uuid
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from runpod.serverless.utils import rp_upload
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Formats that output images can be re-encoded to => (format of Pillow, file extension)
+REENCODE_FORMATS = {"webp": ("WEBP", ".webp"), "jpeg": ("JPEG", ".jpg")}
+# Output images that can be re-encoded
+REENCODE_SOURCE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp")
+# Time in seconds that a presigned URL is valid, the maximum of AWS S3
+PRESIGNED_URL_EXPIRES_S = 7 * 24 * 60 * 60
+# Bytes that are read at once when a file is encoded as base64, a multiple of 3
+BASE64_CHUNK_BYTES = 3 * 256 * 1024
+
+# (endpoint, access key ID, secret access key) => boto3 client, clients are thread-safe
+bucket_clients = {}
+bucket_clients_lock = threading.Lock()
+
+
+def content_type(path):
+    """
+    Args:
+        path (str): The path of a file
+
+    Returns:
+        str: The MIME type of the file, guessed from its extension
+    """
+    return mimetypes.guess_type(path)[0] or "application/octet-stream"
+
+
+def encode_base64_file(path):
+    """
+    Encode a file as base64 in chunks, so that the whole file is never in memory twice.
+
+    Args:
+        path (str): The path of the file
+
+    Returns:
+        str: The base64 encoded file
+    """
+    chunks = []
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(BASE64_CHUNK_BYTES)
+            if not chunk:
+                break
+            chunks.append(base64.b64encode(chunk).decode("ascii"))
+    return "".join(chunks)
+
+
+class InlineBudget:
+    """
+    The bytes that the outputs of a job can still take up as base64, shared by
+    the threads that deliver the outputs.
+
+    Args:
+        max_bytes (int): The total size of the files that are inlined, 0 for no limit
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.used_bytes = 0
+        self.lock = threading.Lock()
+
+    def reserve(self, size):
+        """
+        Args:
+            size (int): The size of the file in bytes
+
+        Returns:
+            bool: True if the file fits and was counted, False if it has to be uploaded
+        """
+        if self.max_bytes <= 0:
+            return True
+        with self.lock:
+            if self.used_bytes + size > self.max_bytes:
+                return False
+            self.used_bytes += size
+            return True
+
+
+def reencode_image(path, image_format, quality):
+    """
+    Re-encode an output image to a smaller format.
+
+    Args:
+        path (str): The path of the image
+        image_format (str): "webp" or "jpeg"
+        quality (int): The quality of the encoder, from 1 to 100
+
+    Returns:
+        str: The path of a temporary file with the re-encoded image, which has to
+             be removed by the caller, or None if the image can't be re-encoded
+             (Pillow is missing, the file is no image) or would get bigger
+    """
+    if (
+        Image is None
+        or image_format not in REENCODE_FORMATS
+        or not path.lower().endswith(REENCODE_SOURCE_EXTENSIONS)
+    ):
+        return None
+
+    pillow_format, extension = REENCODE_FORMATS[image_format]
+    file_descriptor, reencoded_path = tempfile.mkstemp(suffix=extension)
+    os.close(file_descriptor)
+    try:
+        with Image.open(path) as image:
+            if pillow_format == "JPEG" and image.mode not in ("RGB", "L"):
+                image = image.convert("RGB")
+            image.save(reencoded_path, pillow_format, quality=quality)
+    except Exception:
+        os.remove(reencoded_path)
+        raise
+
+    if os.path.getsize(reencoded_path) >= os.path.getsize(path):
+        os.remove(reencoded_path)
+        return None
+    return reencoded_path
+
+
+def get_bucket_client(endpoint_url, access_key_id, secret_access_key):
+    """
+    Return the boto3 client for a bucket, it is created only once per worker.
+
+    Args:
+        endpoint_url (str): The endpoint URL of the bucket
+        access_key_id (str): The access key ID
+        secret_access_key (str): The secret access key
+
+    Returns:
+        botocore.client.S3: The client
+    """
+    key = (endpoint_url, access_key_id, secret_access_key)
+    with bucket_clients_lock:
+        if key not in bucket_clients:
+            bucket_clients[key] = boto3.session.Session().client(
+                "s3",
+                endpoint_url=endpoint_url,
+                aws_access_key_id=access_key_id,
+                aws_secret_access_key=secret_access_key,
+                config=Config(
+                    signature_version="s3v4",
+                    retries={"max_attempts": 3, "mode": "standard"},
+                ),
+                region_name=rp_upload.extract_region_from_url(endpoint_url),
+            )
+        return bucket_clients[key]
+
+
+def upload_file(job_id, path, chunk_bytes, max_concurrency, filename=None):
+    """
+    Upload a file to the bucket that is configured via BUCKET_ENDPOINT_URL.
+
+    The file is streamed from disk: files bigger than chunk_bytes are sent as
+    a multipart upload in parts of chunk_bytes, up to max_concurrency parts at
+    the same time. The bucket and key are the same as the ones of
+    rp_upload.upload_image, which is used without credentials, so it still
+    saves the file to the local "simulated_uploaded" folder.
+
+    Args:
+        job_id (str): The unique identifier for the job
+        path (str): The path of the file
+        chunk_bytes (int): The size of the parts of a multipart upload
+        max_concurrency (int): The maximum number of parts uploaded at the same time
+        filename (str, optional): The name used for the extension and MIME type,
+                                  defaults to the name of the file
+
+    Returns:
+        str: The presigned URL of the uploaded file
+    """
+    endpoint_url = os.environ.get("BUCKET_ENDPOINT_URL")
+    access_key_id = os.environ.get("BUCKET_ACCESS_KEY_ID")
+    secret_access_key = os.environ.get("BUCKET_SECRET_ACCESS_KEY")
+    if not (endpoint_url and access_key_id and secret_access_key):
+        return rp_upload.upload_image(job_id, path)
+
+    client = get_bucket_client(endpoint_url, access_key_id, secret_access_key)
+    extension = os.path.splitext(filename or path)[1]
+    bucket = time.strftime("%m-%y")
+    key = f"{job_id}/{str(uuid.uuid4())[:8]}{extension}"
+
+    client.upload_file(
+        path,
+        bucket,
+        key,
+        ExtraArgs={"ContentType": content_type(filename or path)},
+        Config=TransferConfig(
+            multipart_threshold=chunk_bytes,
+            multipart_chunksize=chunk_bytes,
+            max_concurrency=max_concurrency,
+            use_threads=max_concurrency > 1,
+        ),
+    )
+    return client.generate_presigned_url(
+        "get_object",
+        Params={"Bucket": bucket, "Key": key},
+        ExpiresIn=PRESIGNED_URL_EXPIRES_S,
+    )
@@ -0,0 +1,125 @@
+import time
+
+
+class PromptWatch:
+    """
+    Decides how long a job waits for its prompts in ComfyUI.
+
+    A job fails when its deadline is reached, or when one of its prompts is
+    running but ComfyUI didn't report any progress (a node that starts, a
+    sampler step or a preview) for stall_timeout_s. Prompts that wait in the
+    queue of ComfyUI behind other prompts never stall.
+
+    When polling, the interval starts at min_interval_s whenever another of
+    the prompts starts, so that fast workflows are noticed right away, and
+    doubles up to max_interval_s while it runs. Prompts that wait behind
+    other prompts are polled every max_interval_s.
+
+    Args:
+        prompt_ids (iterable): The IDs of the prompts to watch
+        deadline (float): The time.monotonic() at which the job times out
+        stall_timeout_s (float): Time without progress after which a running prompt
+                                 is considered stalled, 0 to never stall
+        min_interval_s (float): The shortest poll interval
+        max_interval_s (float): The longest poll interval
+    """
+
+    def __init__(
+        self, prompt_ids, deadline, stall_timeout_s, min_interval_s, max_interval_s
+    ):
+        self.prompt_ids = set(prompt_ids)
+        self.deadline = deadline
+        self.stall_timeout_s = stall_timeout_s
+        self.min_interval_s = min(min_interval_s, max_interval_s)
+        self.max_interval_s = max_interval_s
+        self.interval_s = self.min_interval_s
+        self.last_progress = time.monotonic()
+        # Prompts that ComfyUI is executing according to its WebSocket events
+        self.running = set()
+        # Prompts that ComfyUI is executing according to its queue
+        self.polled_running = set()
+        self.behind_others = False
+
+    def observe_event(self, event, prompt_id=None):
+        """
+        Note the progress of a WebSocket event.
+
+        Args:
+            event: The parsed event (dict) or the binary message (bytes) of a preview
+            prompt_id (str, optional): The prompt of events without a prompt ID,
+                                       as sent by older versions of ComfyUI
+        """
+        now = time.monotonic()
+        # Previews are only sent to the client that queued the prompt
+        if not isinstance(event, dict):
+            self.last_progress = now
+            return
+
+        data = event.get("data") or {}
+        prompt_id = data.get("prompt_id", prompt_id)
+        if prompt_id not in self.prompt_ids:
+            return
+        self.last_progress = now
+
+        if event["type"] in ("execution_error", "execution_interrupted"):
+            self.running.discard(prompt_id)
+        elif event["type"] == "executing" and data.get("node") is None:
+            self.running.discard(prompt_id)
+        elif event["type"] in ("execution_start", "executing", "progress"):
+            self.running.add(prompt_id)
+
+    def observe_queue(self, running_ids, pending_ids):
+        """
+        Note the state of the queue of ComfyUI, as it is polled.
+
+        Args:
+            running_ids (set): The IDs of the prompts that are executed
+            pending_ids (list): The IDs of the prompts that wait, in order
+        """
+        running = self.prompt_ids & set(running_ids)
+        if running - self.polled_running:
+            # Another prompt started, it might be done soon
+            self.interval_s = self.min_interval_s
+        self.polled_running = running
+        self.behind_others = not running
+
+    def done(self, prompt_id):
+        """The prompt is finished and no longer watched"""
+        self.prompt_ids.discard(prompt_id)
+        self.running.discard(prompt_id)
+        self.polled_running.discard(prompt_id)
+
+    def error_message(self, check_stall=True):
+        """
+        Args:
+            check_stall (bool): Check for stalled prompts, which needs WebSocket events
+
+        Returns:
+            str: Why the job has to stop waiting or None if it can go on
+        """
+        now = time.monotonic()
+        if now >= self.deadline:
+            return "Timeout while waiting for image generation, the job reached its deadline"
+        if (
+            check_stall
+            and self.stall_timeout_s
+            and self.running
+            and now - self.last_progress >= self.stall_timeout_s
+        ):
+            return (
+                f"Workflow stalled, ComfyUI reported no progress for "
+                f"{self.stall_timeout_s:g} seconds"
+            )
+        return None
+
+    def next_interval(self):
+        """
+        Returns:
+            float: Seconds to wait before polling again, never past the deadline
+        """
+        if self.behind_others:
+            interval_s = self.max_interval_s
+        else:
+            interval_s = self.interval_s
+            self.interval_s = min(self.interval_s * 2, self.max_interval_s)
+        return max(0, min(interval_s, self.deadline - time.monotonic()))
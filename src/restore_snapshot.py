@@ -0,0 +1,695 @@
+"""
+Restore a snapshot of ComfyUI-Manager: the custom nodes and their pip packages.
+
+The git custom nodes are cloned in parallel, each at the commit of the
+snapshot. Nodes that are already at that commit are skipped, so a restore
+that was interrupted can simply run again. Clones go through bare mirrors in
+the git cache, so that a rebuild only fetches new commits. The same goes for
+the git submodules of the custom nodes and ComfyUI itself, which is checked
+out at the commit of the snapshot.
+
+The nodes of the Comfy Registry ("cnr_custom_nodes") are downloaded at their
+version and their archives are kept in the git cache as well. A snapshot with
+a section that isn't known fails the restore, so no node is silently missing.
+
+The requirements of all custom nodes and the pip packages of the snapshot are
+resolved together in a single pass. The wheels of the packages that have to be
+installed are kept in the wheel cache and installed from there, so with a
+prepopulated git and wheel cache the restore works offline.
+
+Usage:
+
+    python restore_snapshot.py /example_snapshot.json --workspace /comfyui \\
+        --git-cache /cache/git --wheel-cache /cache/wheels
+"""
+
+import argparse
+import hashlib
+import importlib.metadata
+import json
+import os
+import posixpath
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import urllib.parse
+import urllib.request
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+# The API of the Comfy Registry, as used by ComfyUI-Manager
+REGISTRY_URL = os.environ.get("COMFY_REGISTRY_URL", "https://api.comfy.org")
+# The sections of a snapshot that are restored
+SNAPSHOT_SECTIONS = (
+    "comfyui",
+    "git_custom_nodes",
+    "cnr_custom_nodes",
+    "file_custom_nodes",
+    "pips",
+)
+
+
+class RestoreError(Exception):
+    pass
+
+
+def log(message):
+    print(f"runpod-worker-comfy - {message}", flush=True)
+
+
+def run(command, cwd=None):
+    """
+    Run a command and fail with its output.
+
+    Returns:
+        str: The output of the command
+    """
+    result = subprocess.run(command, cwd=cwd, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RestoreError(
+            f"{' '.join(command)} failed: {(result.stderr or result.stdout).strip()}"
+        )
+    return result.stdout
+
+
+def repo_name(url):
+    """The folder of a custom node, e.g. "ComfyUI-Manager" for its GitHub URL"""
+    name = url.rstrip("/").rsplit("/", 1)[-1]
+    return name[: -len(".git")] if name.endswith(".git") else name
+
+
+def has_commit(repo, commit):
+    result = subprocess.run(
+        ["git", "cat-file", "-e", f"{commit}^{{commit}}"],
+        cwd=repo,
+        capture_output=True,
+    )
+    return result.returncode == 0
+
+
+def current_commit(repo):
+    """
+    Returns:
+        str: The commit that is checked out or None if repo is no git repository
+    """
+    if not os.path.isdir(os.path.join(repo, ".git")):
+        return None
+    try:
+        return run(["git", "rev-parse", "HEAD"], cwd=repo).strip()
+    except RestoreError:
+        return None
+
+
+def mirror_path(git_cache, url):
+    """The folder of the bare mirror of a repository in the git cache"""
+    # The hash keeps forks with the same name apart
+    digest = hashlib.sha256(url.encode("utf-8")).hexdigest()[:12]
+    return os.path.join(git_cache, f"{repo_name(url)}-{digest}.git")
+
+
+def resolve_url(url, base_url):
+    """Resolve a relative submodule URL like "../other.git" against the URL of its repository"""
+    if not url.startswith(("./", "../")):
+        return url
+    scheme, separator, path = base_url.rstrip("/").partition("://")
+    if not separator:
+        return posixpath.normpath(posixpath.join(base_url, url))
+    host, _, path = path.partition("/")
+    return f"{scheme}://{host}{posixpath.normpath(posixpath.join('/' + path, url))}"
+
+
+def submodules(repo):
+    """
+    Returns:
+        list: The (name, path, url) of the submodules in the .gitmodules of repo
+    """
+    if not os.path.isfile(os.path.join(repo, ".gitmodules")):
+        return []
+    output = run(
+        ["git", "config", "--file", ".gitmodules", "--get-regexp"]
+        + [r"^submodule\..*\.(path|url)$"],
+        cwd=repo,
+    )
+    entries = {}
+    for line in output.splitlines():
+        key, _, value = line.partition(" ")
+        name, _, option = key[len("submodule.") :].rpartition(".")
+        entries.setdefault(name, {})[option] = value
+    return [
+        (name, entry["path"], entry["url"])
+        for name, entry in entries.items()
+        if "path" in entry and "url" in entry
+    ]
+
+
+def update_submodules(repo, url, git_cache, offline):
+    """
+    Check out the submodules of a repository recursively, through bare mirrors
+    in the git cache like the repository itself.
+
+    Args:
+        repo (str): The folder of the repository
+        url (str): The URL of the repository, for relative submodule URLs
+        git_cache (str): Folder with the bare mirrors of the repositories, empty to clone directly
+        offline (bool): Never fetch, fail if a commit is missing
+    """
+    if not git_cache:
+        if submodules(repo):
+            run(
+                ["git", "submodule", "update", "--quiet", "--init", "--recursive"],
+                cwd=repo,
+            )
+        return
+
+    for name, path, submodule_url in submodules(repo):
+        submodule_url = resolve_url(submodule_url, url)
+        # "160000 commit <hash>\t<path>", nothing if the submodule was removed
+        entry = run(["git", "ls-tree", "HEAD", "--", path], cwd=repo).split()
+        if len(entry) < 3 or entry[1] != "commit":
+            continue
+        commit = entry[2]
+        mirror = mirror_path(git_cache, submodule_url)
+        update_mirror(submodule_url, mirror, commit, offline)
+
+        # Clone from the mirror, but keep the real URL in the configuration
+        key = f"submodule.{name}.url"
+        run(["git", "submodule", "init", "--quiet", "--", path], cwd=repo)
+        run(["git", "config", key, mirror], cwd=repo)
+        try:
+            run(
+                ["git", "-c", "protocol.file.allow=always", "submodule", "update"]
+                + ["--quiet", "--", path],
+                cwd=repo,
+            )
+        finally:
+            run(["git", "config", key, submodule_url], cwd=repo)
+        submodule_path = os.path.join(repo, path)
+        run(["git", "remote", "set-url", "origin", submodule_url], cwd=submodule_path)
+        update_submodules(submodule_path, submodule_url, git_cache, offline)
+
+
+def update_mirror(url, mirror, commit, offline):
+    """
+    Make sure that the bare mirror of a repository contains the commit.
+
+    Args:
+        url (str): The URL of the repository
+        mirror (str): The folder of the mirror in the git cache
+        commit (str): The commit of the snapshot
+        offline (bool): Never fetch, fail if the commit is missing
+    """
+    if os.path.isdir(mirror) and has_commit(mirror, commit):
+        return
+    if offline:
+        raise RestoreError(f"{url} at {commit} is not in the git cache")
+
+    if not os.path.isdir(mirror):
+        # Clone next to the mirror, so that an interrupted clone is never used
+        partial = f"{mirror}.partial"
+        shutil.rmtree(partial, ignore_errors=True)
+        run(["git", "clone", "--mirror", "--quiet", url, partial])
+        os.replace(partial, mirror)
+    else:
+        run(["git", "fetch", "--quiet", "--prune", "origin"], cwd=mirror)
+
+    if not has_commit(mirror, commit):
+        # The commit might not be on a branch or tag anymore
+        run(["git", "fetch", "--quiet", "origin", commit], cwd=mirror)
+
+
+def restore_node(url, spec, custom_nodes_path, git_cache, offline):
+    """
+    Clone or update a git custom node and check out the commit of the snapshot.
+
+    Args:
+        url (str): The URL of the repository
+        spec (dict): The "hash" of the commit and whether the node is "disabled"
+        custom_nodes_path (str): The custom_nodes folder of ComfyUI
+        git_cache (str): Folder with the bare mirrors of the repositories, empty to clone directly
+        offline (bool): Only use the git cache
+
+    Returns:
+        str: "installed", "skipped" if it was at the commit already or "disabled"
+    """
+    if spec.get("disabled"):
+        return "disabled"
+
+    commit = spec["hash"]
+    target = os.path.join(custom_nodes_path, repo_name(url))
+    if current_commit(target) == commit:
+        return "skipped"
+
+    source = url
+    if git_cache:
+        source = mirror_path(git_cache, url)
+        update_mirror(url, source, commit, offline)
+    elif offline:
+        raise RestoreError(f"{url} can't be cloned offline without a git cache")
+
+    if current_commit(target) is None:
+        if os.path.exists(target):
+            raise RestoreError(f"{target} exists, but is not a git repository")
+        partial = f"{target}.partial"
+        shutil.rmtree(partial, ignore_errors=True)
+        run(["git", "clone", "--quiet", "--no-checkout", source, partial])
+        run(["git", "remote", "set-url", "origin", url], cwd=partial)
+        os.replace(partial, target)
+    elif not has_commit(target, commit):
+        run(["git", "fetch", "--quiet", source, commit], cwd=target)
+
+    run(
+        ["git", "-c", "advice.detachedHead=false", "checkout", "--quiet", "--force"]
+        + [commit],
+        cwd=target,
+    )
+    update_submodules(target, url, git_cache, offline)
+    return "installed"
+
+
+def restore_comfyui(workspace, commit, git_cache, offline):
+    """
+    Check out ComfyUI at the commit of the snapshot.
+
+    Args:
+        workspace (str): The folder of ComfyUI, a git repository
+        commit (str): The commit of the snapshot
+        git_cache (str): Folder with the bare mirrors of the repositories, empty to fetch directly
+        offline (bool): Only use the git cache
+
+    Returns:
+        str: "installed" or "skipped" if it was at the commit already
+    """
+    current = current_commit(workspace)
+    if current is None:
+        raise RestoreError(f"{workspace} is not a git repository")
+    if current == commit:
+        return "skipped"
+
+    if not has_commit(workspace, commit):
+        url = run(["git", "remote", "get-url", "origin"], cwd=workspace).strip()
+        if git_cache:
+            mirror = mirror_path(git_cache, url)
+            update_mirror(url, mirror, commit, offline)
+            run(["git", "fetch", "--quiet", mirror, commit], cwd=workspace)
+        elif offline:
+            raise RestoreError(f"{url} at {commit} can't be fetched offline")
+        else:
+            run(["git", "fetch", "--quiet", "origin", commit], cwd=workspace)
+    run(
+        ["git", "-c", "advice.detachedHead=false", "checkout", "--quiet", commit],
+        cwd=workspace,
+    )
+    return "installed"
+
+
+def node_version(node_path):
+    """
+    Returns:
+        str: The version in the pyproject.toml of a registry node or None
+    """
+    try:
+        with open(os.path.join(node_path, "pyproject.toml")) as f:
+            match = re.search(r"^version\s*=\s*[\"']([^\"']+)[\"']", f.read(), re.M)
+    except OSError:
+        return None
+    return match.group(1) if match else None
+
+
+def download(url, path):
+    """Download a file, next to its path first so that a partial file is never used"""
+    partial = f"{path}.partial"
+    try:
+        with urllib.request.urlopen(url, timeout=60) as response, open(
+            partial, "wb"
+        ) as f:
+            shutil.copyfileobj(response, f)
+        os.replace(partial, path)
+    except OSError as e:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise RestoreError(f"downloading {url} failed: {e}")
+
+
+def registry_archive(node_id, version, git_cache, offline):
+    """
+    Download the archive of a registry node, or take it from the cache.
+
+    Returns:
+        str: The path of the zip file
+    """
+    folder = os.path.join(git_cache, "registry")
+    path = os.path.join(folder, f"{node_id}-{version}.zip")
+    if os.path.isfile(path):
+        return path
+    if offline:
+        raise RestoreError(f"{node_id} {version} is not in the git cache")
+
+    os.makedirs(folder, exist_ok=True)
+    quoted = urllib.parse.quote(node_id, safe="")
+    install_url = f"{REGISTRY_URL}/nodes/{quoted}/install?" + urllib.parse.urlencode(
+        {"version": version}
+    )
+    try:
+        with urllib.request.urlopen(install_url, timeout=60) as response:
+            download_url = json.load(response)["downloadUrl"]
+    except (OSError, ValueError, KeyError) as e:
+        raise RestoreError(f"{node_id} {version} is not in the registry: {e}")
+    download(download_url, path)
+    return path
+
+
+def restore_registry_node(node_id, version, custom_nodes_path, git_cache, offline):
+    """
+    Install a node of the Comfy Registry at the version of the snapshot.
+
+    Like ComfyUI-Manager, the extracted files are listed in ".tracking", which
+    marks the folder as a registry node.
+
+    Args:
+        node_id (str): The ID of the node in the registry
+        version (str): The version of the snapshot
+        custom_nodes_path (str): The custom_nodes folder of ComfyUI
+        git_cache (str): Folder that keeps the archives, empty to only download them
+        offline (bool): Only use the archives in the git cache
+
+    Returns:
+        str: "installed" or "skipped" if it was at the version already
+    """
+    if not re.fullmatch(r"[A-Za-z0-9][A-Za-z0-9._-]*", node_id):
+        raise RestoreError(f"{node_id!r} is not a valid node ID")
+    target = os.path.join(custom_nodes_path, node_id)
+    tracking = os.path.join(target, ".tracking")
+    if os.path.exists(target) and not os.path.isfile(tracking):
+        raise RestoreError(f"{target} exists, but is not a registry node")
+    if os.path.isfile(tracking) and node_version(target) == version:
+        return "skipped"
+
+    with tempfile.TemporaryDirectory() as folder:
+        archive = registry_archive(node_id, version, git_cache or folder, offline)
+        partial = f"{target}.partial"
+        shutil.rmtree(partial, ignore_errors=True)
+        try:
+            with zipfile.ZipFile(archive) as zip_file:
+                names = zip_file.namelist()
+                for name in names:
+                    path = os.path.realpath(os.path.join(partial, name))
+                    if not path.startswith(os.path.realpath(partial) + os.sep):
+                        raise RestoreError(f"{archive} contains the path {name}")
+                zip_file.extractall(partial)
+        except zipfile.BadZipFile as e:
+            raise RestoreError(f"{archive} is no zip file: {e}")
+        with open(os.path.join(partial, ".tracking"), "w") as f:
+            f.write("\n".join(names) + "\n")
+    shutil.rmtree(target, ignore_errors=True)
+    os.replace(partial, target)
+    return "installed"
+
+
+def node_requirements(node_path):
+    """
+    Returns:
+        list: The lines of the requirements.txt of a custom node, without comments
+    """
+    path = os.path.join(node_path, "requirements.txt")
+    if not os.path.isfile(path):
+        return []
+    requirements = []
+    with open(path) as f:
+        for line in f:
+            line = line.split(" #", 1)[0].strip()
+            if not line or line.startswith("#"):
+                continue
+            # Included files are relative to the custom node
+            option, _, value = line.partition(" ")
+            if option in ("-r", "--requirement") and not os.path.isabs(value.strip()):
+                line = f"{option} {os.path.join(node_path, value.strip())}"
+            requirements.append(line)
+    return requirements
+
+
+def snapshot_pips(pips):
+    """
+    Returns:
+        list: The pip packages of the snapshot that are published on PyPI and
+              not installed yet, installed packages are kept at their version
+    """
+    requirements = []
+    for requirement in pips:
+        if "://" in requirement or " @ " in requirement:
+            continue
+        name = re.split(r"[=<>!~;\[ ]", requirement, 1)[0]
+        try:
+            importlib.metadata.version(name)
+        except importlib.metadata.PackageNotFoundError:
+            requirements.append(requirement)
+    return requirements
+
+
+def normalize(name):
+    return re.sub(r"[-_.]+", "_", name).lower()
+
+
+def cached_wheels(wheel_cache):
+    """
+    Returns:
+        set: The (normalized name, version) of every wheel in the cache
+    """
+    wheels = set()
+    for filename in os.listdir(wheel_cache):
+        if filename.endswith(".whl"):
+            name, version = filename.split("-")[:2]
+            wheels.add((normalize(name), version))
+    return wheels
+
+
+def pip(*args):
+    return [sys.executable, "-m", "pip", *args]
+
+
+def install_requirements(requirements, wheel_cache, offline):
+    """
+    Resolve and install all requirements in one pass, from the wheel cache.
+
+    Online, pip first resolves the requirements against the installed packages
+    (a dry run) and the wheels of the packages it would install are added to
+    the wheel cache. The installation itself never needs an index then.
+
+    Args:
+        requirements (list): The lines of a requirements file
+        wheel_cache (str): Folder with the wheels
+        offline (bool): Only install from the wheel cache
+    """
+    if not requirements:
+        return
+    os.makedirs(wheel_cache, exist_ok=True)
+    with tempfile.TemporaryDirectory() as folder:
+        requirements_file = os.path.join(folder, "requirements.txt")
+        with open(requirements_file, "w") as f:
+            f.write("\n".join(requirements) + "\n")
+        find_links = ["--find-links", wheel_cache]
+
+        if not offline:
+            report_file = os.path.join(folder, "report.json")
+            try:
+                run(
+                    pip("install", "--quiet", "--dry-run", "--report", report_file)
+                    + find_links
+                    + ["-r", requirements_file]
+                )
+            except RestoreError as e:
+                # pip < 22.2 has no report, install straight from the index
+                log(f"can't resolve the requirements up front, {e}")
+                run(pip("install") + find_links + ["-r", requirements_file])
+                return
+
+            with open(report_file) as f:
+                report = json.load(f)
+            cached = cached_wheels(wheel_cache)
+            missing = []
+            for item in report.get("install", []):
+                name = item["metadata"]["name"]
+                version = item["metadata"]["version"]
+                if (normalize(name), version) in cached:
+                    continue
+                download_info = item.get("download_info", {})
+                if item.get("is_direct"):
+                    # e.g. git+https://... of a requirements.txt
+                    vcs_info = download_info.get("vcs_info")
+                    url = download_info["url"]
+                    missing.append(
+                        f"{vcs_info['vcs']}+{url}@{vcs_info['commit_id']}"
+                        if vcs_info
+                        else url
+                    )
+                else:
+                    missing.append(f"{name}=={version}")
+            if missing:
+                log(f"adding {len(missing)} wheel(s) to the wheel cache")
+                run(
+                    pip("wheel", "--quiet", "--no-deps", "--wheel-dir", wheel_cache)
+                    + find_links
+                    + missing
+                )
+
+        run(
+            pip("install", "--quiet", "--no-index")
+            + find_links
+            + ["-r", requirements_file]
+        )
+
+
+def run_install_scripts(node_paths):
+    """Run the install.py of custom nodes, like ComfyUI-Manager does after installing them"""
+    for node_path in node_paths:
+        if os.path.isfile(os.path.join(node_path, "install.py")):
+            log(f"running install.py of {os.path.basename(node_path)}")
+            run([sys.executable, "install.py"], cwd=node_path)
+
+
+def restore_snapshot(snapshot, workspace, git_cache, wheel_cache, offline, jobs):
+    """
+    Args:
+        snapshot (dict): The parsed snapshot of ComfyUI-Manager
+        workspace (str): The folder of ComfyUI
+        git_cache (str): Folder with the bare mirrors of the repositories, empty to clone directly
+        wheel_cache (str): Folder with the wheels of the pip packages
+        offline (bool): Only use the caches
+        jobs (int): Number of custom nodes that are cloned at the same time
+
+    Returns:
+        list: The error messages, empty if the snapshot was restored
+    """
+    custom_nodes_path = os.path.join(workspace, "custom_nodes")
+    nodes = snapshot.get("git_custom_nodes") or {}
+    registry_nodes = snapshot.get("cnr_custom_nodes") or {}
+    errors = [
+        f"the section {name!r} of the snapshot is not supported"
+        for name in snapshot
+        if name not in SNAPSHOT_SECTIONS
+    ]
+    if errors:
+        return errors
+
+    installed = []
+    enabled = []
+    if snapshot.get("comfyui"):
+        try:
+            status = restore_comfyui(workspace, snapshot["comfyui"], git_cache, offline)
+        except RestoreError as e:
+            return [f"ComfyUI: {e}"]
+        log(f"{status} ComfyUI at {snapshot['comfyui']}")
+        if status == "installed":
+            # Its requirements might have changed
+            enabled.append(workspace)
+
+    if nodes or registry_nodes:
+        os.makedirs(custom_nodes_path, exist_ok=True)
+    if git_cache:
+        os.makedirs(git_cache, exist_ok=True)
+
+    def restore(item):
+        url, spec = item
+        try:
+            return url, restore_node(url, spec, custom_nodes_path, git_cache, offline)
+        except (RestoreError, OSError, KeyError) as e:
+            return url, e
+
+    def restore_from_registry(item):
+        node_id, version = item
+        try:
+            return node_id, restore_registry_node(
+                node_id, version, custom_nodes_path, git_cache, offline
+            )
+        except (RestoreError, OSError) as e:
+            return node_id, e
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        for node_id, status in executor.map(
+            restore_from_registry, registry_nodes.items()
+        ):
+            if isinstance(status, Exception):
+                errors.append(f"{node_id}: {status}")
+                continue
+            log(f"{status} {node_id} {registry_nodes[node_id]}")
+            node_path = os.path.join(custom_nodes_path, node_id)
+            enabled.append(node_path)
+            if status == "installed":
+                installed.append(node_path)
+
+        for url, status in executor.map(restore, nodes.items()):
+            if isinstance(status, Exception):
+                errors.append(f"{url}: {status}")
+                continue
+            log(f"{status} {url}")
+            node_path = os.path.join(custom_nodes_path, repo_name(url))
+            if status != "disabled":
+                enabled.append(node_path)
+            if status == "installed":
+                installed.append(node_path)
+
+    for node in snapshot.get("file_custom_nodes") or []:
+        path = os.path.join(custom_nodes_path, node["filename"])
+        if not node.get("disabled") and not os.path.exists(path):
+            log(f"the file custom node {node['filename']} is not part of the image")
+
+    # Every run resolves all requirements, so that a failed install is repeated
+    requirements = snapshot_pips(snapshot.get("pips") or {})
+    for node_path in enabled:
+        requirements += node_requirements(node_path)
+    try:
+        install_requirements(requirements, wheel_cache, offline)
+        run_install_scripts(installed)
+    except RestoreError as e:
+        errors.append(str(e))
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("snapshot", help="The snapshot file of ComfyUI-Manager")
+    parser.add_argument("--workspace", default="/comfyui")
+    parser.add_argument(
+        "--git-cache",
+        default=os.environ.get("SNAPSHOT_GIT_CACHE", ""),
+        help="Folder with the bare mirrors of the custom nodes",
+    )
+    parser.add_argument(
+        "--wheel-cache",
+        default=os.environ.get("SNAPSHOT_WHEEL_CACHE", ""),
+        help="Folder with the wheels of the pip packages",
+    )
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        default=os.environ.get("SNAPSHOT_OFFLINE", "false").lower() == "true",
+        help="Only use the git and the wheel cache",
+    )
+    parser.add_argument(
+        "--jobs", type=int, default=int(os.environ.get("SNAPSHOT_JOBS", 8))
+    )
+    args = parser.parse_args()
+
+    with open(args.snapshot) as f:
+        snapshot = json.load(f)
+    if args.offline and not (args.git_cache and args.wheel_cache):
+        log("an offline restore needs a git and a wheel cache")
+        return 1
+
+    with tempfile.TemporaryDirectory() as temporary_cache:
+        errors = restore_snapshot(
+            snapshot,
+            args.workspace,
+            args.git_cache,
+            args.wheel_cache or temporary_cache,
+            args.offline,
+            args.jobs,
+        )
+    for error in errors:
+        log(f"error: {error}")
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
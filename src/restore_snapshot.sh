@@ -2,7 +2,9 @@
 
 set -e
 
-SNAPSHOT_FILE=$(ls /*snapshot*.json 2>/dev/null | head -n 1)
+# The snapshot file and the folder of ComfyUI can be given for testing
+SNAPSHOT_FILE=${1:-$(ls /*snapshot*.json 2>/dev/null | head -n 1)}
+COMFYUI_PATH=${COMFYUI_PATH:-/comfyui}
 
 if [ -z "$SNAPSHOT_FILE" ]; then
     echo "runpod-worker-comfy: No snapshot file found. Exiting..."
@@ -11,6 +13,8 @@ fi
 
 echo "runpod-worker-comfy: restoring snapshot: $SNAPSHOT_FILE"
 
-comfy --workspace /comfyui node restore-snapshot "$SNAPSHOT_FILE" --pip-non-url
+# Clones the custom nodes in parallel and installs their requirements in one pass,
+# see restore_snapshot.py for the git and wheel cache (SNAPSHOT_GIT_CACHE, SNAPSHOT_WHEEL_CACHE)
+python "$(dirname "$0")/restore_snapshot.py" "$SNAPSHOT_FILE" --workspace "$COMFYUI_PATH"
 
-echo "runpod-worker-comfy: restored snapshot file: $SNAPSHOT_FILE"
\ No newline at end of file
+echo "runpod-worker-comfy: restored snapshot file: $SNAPSHOT_FILE"
@@ -0,0 +1,63 @@
+import hashlib
+import json
+
+from disk_cache import DiskCache
+
+
+class ResultCache(DiskCache):
+    """
+    Cache for the results of deterministic workflows.
+
+    The key of a result is the hash of the canonicalized workflow and the
+    hashes of the input images, so a retry or a duplicate submission of the
+    same job returns the stored result without running the workflow again.
+
+    Args:
+        path (str): The folder of the cache, e.g. on the network volume
+        max_bytes (int): The maximum size of all results, 0 disables the cache
+        ttl_s (float): The time in seconds after which a result expires
+    """
+
+    @staticmethod
+    def key(workflow, images=None):
+        """
+        Build the key of a job.
+
+        Args:
+            workflow (dict): The workflow of the job
+            images (list, optional): The validated input images with 'name' and 'sha256'
+
+        Returns:
+            str: The SHA-256 of the canonicalized workflow and its images
+        """
+        canonical = json.dumps(
+            {
+                "workflow": workflow,
+                "images": sorted(
+                    (image["name"], image["sha256"]) for image in images or []
+                ),
+            },
+            sort_keys=True,
+            separators=(",", ":"),
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    def get_result(self, key):
+        """
+        Args:
+            key (str): The key as returned by ResultCache.key
+
+        Returns:
+            dict: The stored result or None
+        """
+        value = self.get(key)
+        return json.loads(value) if value is not None else None
+
+    def put_result(self, key, result):
+        """
+        Args:
+            key (str): The key as returned by ResultCache.key
+            result (dict): The result of the job
+        """
+        self.put(key, json.dumps(result).encode("utf-8"))
@@ -1,35 +1,496 @@
 import runpod
 from runpod.serverless.utils import rp_upload
 import json
-import urllib.request
-import urllib.parse
 import time
 import os
+import uuid
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import base64
+import binascii
+import hashlib
+import ipaddress
+import socket
+import struct
+import threading
+import asyncio
+import websocket
+from urllib.parse import urlparse
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from io import BytesIO
+from input_cache import InputCache
+from input_stream import MultipartFile, base64_size
+from result_cache import ResultCache
+from job_metrics import JobMetrics, PrometheusTextFile
+import output_transport
+from prompt_watch import PromptWatch
+from workflow_schema import WorkflowSchema, is_link
+from workflow_templates import WorkflowTemplates
+from file_cleanup import FileCleanup
+from model_residency import ModelResidency, workflow_models
+from model_tier import ModelTier
+from url_cache import UrlCache
 
 # Time to wait between API check attempts in milliseconds
 COMFY_API_AVAILABLE_INTERVAL_MS = 50
 # Maximum number of API check attempts
-COMFY_API_AVAILABLE_MAX_RETRIES = 500
-# Time to wait between poll attempts in milliseconds
+COMFY_API_AVAILABLE_MAX_RETRIES = int(
+    os.environ.get("COMFY_API_AVAILABLE_MAX_RETRIES", 500)
+)
+# Endpoint of ComfyUI that is used to check if it is ready
+COMFY_READINESS_PATH = "/system_stats"
+# Time after which the last successful contact with ComfyUI is stale in milliseconds
+COMFY_LIVENESS_TTL_MS = int(os.environ.get("COMFY_LIVENESS_TTL_MS", 30000))
+# Time to wait for the liveness check of a stale ComfyUI in milliseconds
+COMFY_LIVENESS_TIMEOUT_MS = int(os.environ.get("COMFY_LIVENESS_TIMEOUT_MS", 2000))
+# Longest time to wait between poll attempts in milliseconds
 COMFY_POLLING_INTERVAL_MS = int(os.environ.get("COMFY_POLLING_INTERVAL_MS", 250))
-# Maximum number of poll attempts
-COMFY_POLLING_MAX_RETRIES = int(os.environ.get("COMFY_POLLING_MAX_RETRIES", 500))
+# Shortest time to wait between poll attempts in milliseconds, right after a prompt started
+COMFY_POLLING_MIN_INTERVAL_MS = int(os.environ.get("COMFY_POLLING_MIN_INTERVAL_MS", 50))
+# Maximum number of poll attempts, only used as default for JOB_TIMEOUT_S
+COMFY_POLLING_MAX_RETRIES = os.environ.get("COMFY_POLLING_MAX_RETRIES")
+# Maximum time in seconds that a job waits for its workflows, "timeout" in the input overrides it
+JOB_TIMEOUT_S = float(
+    os.environ.get(
+        "JOB_TIMEOUT_S",
+        (
+            int(COMFY_POLLING_MAX_RETRIES) * COMFY_POLLING_INTERVAL_MS / 1000
+            if COMFY_POLLING_MAX_RETRIES
+            else 1800
+        ),
+    )
+)
+# Time in seconds without progress after which a running workflow is cancelled,
+# off by default, as some nodes run for a long time without reporting progress
+COMFY_STALL_TIMEOUT_S = float(os.environ.get("COMFY_STALL_TIMEOUT_S", 0))
+# Time to wait for the WebSocket connection to ComfyUI in milliseconds
+COMFY_WEBSOCKET_CONNECT_TIMEOUT_MS = int(
+    os.environ.get("COMFY_WEBSOCKET_CONNECT_TIMEOUT_MS", 2000)
+)
+# Time without any WebSocket message after which the history is checked in milliseconds
+COMFY_WEBSOCKET_RECV_TIMEOUT_MS = int(
+    os.environ.get("COMFY_WEBSOCKET_RECV_TIMEOUT_MS", 5000)
+)
+# Minimum time between two streamed previews in milliseconds
+STREAM_PREVIEW_INTERVAL_MS = int(os.environ.get("STREAM_PREVIEW_INTERVAL_MS", 500))
+# Event type and image formats of the binary preview messages of ComfyUI
+COMFY_PREVIEW_EVENT = 1
+COMFY_PREVIEW_FORMATS = {1: "jpeg", 2: "png"}
+# Maximum number of output files that are uploaded or encoded at the same time
+OUTPUT_MAX_WORKERS = int(os.environ.get("OUTPUT_MAX_WORKERS", 8))
+# Size of the parts in which outputs are uploaded to AWS S3
+OUTPUT_UPLOAD_CHUNK_BYTES = int(
+    os.environ.get("OUTPUT_UPLOAD_CHUNK_BYTES", 8 * 1024 * 1024)
+)
+# Maximum number of parts of an output that are uploaded at the same time
+OUTPUT_UPLOAD_MAX_CONCURRENCY = int(os.environ.get("OUTPUT_UPLOAD_MAX_CONCURRENCY", 4))
+# Re-encode output images as "webp" or "jpeg" before they are returned, empty keeps them
+OUTPUT_IMAGE_FORMAT = os.environ.get("OUTPUT_IMAGE_FORMAT", "").lower()
+# Quality (1-100) of the re-encoded output images
+OUTPUT_IMAGE_QUALITY = int(os.environ.get("OUTPUT_IMAGE_QUALITY", 90))
+# Outputs bigger than this (in bytes) fail instead of being returned as base64 without AWS S3, 0 disables it
+OUTPUT_INLINE_MAX_BYTES = int(os.environ.get("OUTPUT_INLINE_MAX_BYTES", 0))
+# Maximum total size (in bytes) of the outputs of a job that are returned as base64
+# without AWS S3, the others fail, 0 disables it
+OUTPUT_INLINE_TOTAL_MAX_BYTES = int(os.environ.get("OUTPUT_INLINE_TOTAL_MAX_BYTES", 0))
+# Maximum number of finished workflows of a batch whose outputs are processed at the same time
+BATCH_PROCESSING_MAX_WORKERS = 4
+# Remove the input images and outputs of a job once they were delivered
+CLEANUP_FILES = os.environ.get("CLEANUP_FILES", "true").lower() == "true"
+# Time in seconds that the files of a job are kept after delivery, e.g. for debugging
+CLEANUP_RETENTION_S = float(os.environ.get("CLEANUP_RETENTION_S", 0))
+# Disk usage in percent above which the oldest files that the worker wrote to the folders of ComfyUI are removed, 0 disables it
+DISK_HIGH_WATER_PERCENT = float(os.environ.get("DISK_HIGH_WATER_PERCENT", 90))
+# Disk usage in percent down to which the oldest files are removed
+DISK_LOW_WATER_PERCENT = float(os.environ.get("DISK_LOW_WATER_PERCENT", 80))
+# Time in seconds between two checks of the disk usage and the retention window
+CLEANUP_INTERVAL_S = float(os.environ.get("CLEANUP_INTERVAL_S", 30))
+# Input that is added to the output nodes to run them again, see unique_outputs
+UNIQUE_RUN_INPUT = "runpod_worker_comfy_run"
+# Number of queued workflows that are remembered to detect repeated ones, see workflow_to_queue
+QUEUED_WORKFLOWS_MAX = 1000
+# Unload the models of earlier jobs when the next job needs their memory
+MODEL_RESIDENCY = os.environ.get("MODEL_RESIDENCY", "true").lower() == "true"
+# Maximum number of models that ComfyUI keeps loaded between jobs, 0 for no limit
+MODEL_RESIDENCY_MAX_MODELS = int(os.environ.get("MODEL_RESIDENCY_MAX_MODELS", 0))
+# Memory in MB that a job needs on top of its models, e.g. for the latents
+MODEL_RESIDENCY_RESERVE_MB = int(os.environ.get("MODEL_RESIDENCY_RESERVE_MB", 2048))
+# Folders with the models of ComfyUI (separated by commas), to know the size of a model
+COMFY_MODEL_PATHS = os.environ.get(
+    "COMFY_MODEL_PATHS", "/comfyui/models,/runpod-volume/models"
+).split(",")
+# Folder on the local disk where the models of the network volume are copied, "" disables the copies
+MODEL_CACHE_PATH = os.environ.get("MODEL_CACHE_PATH", "")
+# Folder with the models that are copied to MODEL_CACHE_PATH
+MODEL_CACHE_SOURCE_PATH = os.environ.get(
+    "MODEL_CACHE_SOURCE_PATH", "/runpod-volume/models"
+)
+# Maximum size of the copied models in bytes
+MODEL_CACHE_MAX_BYTES = int(os.environ.get("MODEL_CACHE_MAX_BYTES", 64 * 1024**3))
+# How the copies are checked: "mtime" (size and mtime of the source) or "sha256"
+MODEL_CACHE_VERIFY = os.environ.get("MODEL_CACHE_VERIFY", "mtime").lower()
+# Models (separated by commas) that are copied when the worker starts
+MODEL_CACHE_HOT_MODELS = [
+    name for name in os.environ.get("MODEL_CACHE_HOT_MODELS", "").split(",") if name
+]
+# Keys in the outputs of a node that contain generated files
+OUTPUT_FILE_KEYS = ("images", "gifs", "videos")
+# Maximum number of input images that are uploaded at the same time
+INPUT_UPLOAD_MAX_WORKERS = int(os.environ.get("INPUT_UPLOAD_MAX_WORKERS", 4))
+# Folder where input images are kept, so that later jobs can reference them by hash
+INPUT_CACHE_PATH = os.environ.get(
+    "INPUT_CACHE_PATH", "/tmp/runpod-worker-comfy/input-cache"
+)
+# Maximum size of the cached input images in bytes, 0 disables the cache
+INPUT_CACHE_MAX_BYTES = int(os.environ.get("INPUT_CACHE_MAX_BYTES", 1024**3))
+# Maximum number of input images that are downloaded from their URL at the same time
+INPUT_DOWNLOAD_MAX_WORKERS = int(os.environ.get("INPUT_DOWNLOAD_MAX_WORKERS", 8))
+# Maximum size of an input image that is downloaded from its URL in bytes
+INPUT_DOWNLOAD_MAX_BYTES = int(
+    os.environ.get("INPUT_DOWNLOAD_MAX_BYTES", 100 * 1024 * 1024)
+)
+# Maximum time in seconds to download an input image from its URL
+INPUT_DOWNLOAD_TIMEOUT_S = float(os.environ.get("INPUT_DOWNLOAD_TIMEOUT_S", 60))
+# Allow downloading input images from loopback, link-local and private addresses, e.g. an internal MinIO
+INPUT_DOWNLOAD_ALLOW_PRIVATE_HOSTS = (
+    os.environ.get("INPUT_DOWNLOAD_ALLOW_PRIVATE_HOSTS", "false").lower() == "true"
+)
+# Folder where input images that were downloaded from their URL are kept
+INPUT_URL_CACHE_PATH = os.environ.get(
+    "INPUT_URL_CACHE_PATH", "/tmp/runpod-worker-comfy/url-cache"
+)
+# Maximum size of the downloaded input images in bytes, 0 disables the cache
+INPUT_URL_CACHE_MAX_BYTES = int(os.environ.get("INPUT_URL_CACHE_MAX_BYTES", 1024**3))
+# Maximum size of all input images of a job in bytes, inline, referenced and downloaded
+INPUT_JOB_MAX_BYTES = int(os.environ.get("INPUT_JOB_MAX_BYTES", 256 * 1024 * 1024))
+# Folder where the results of workflows are cached, e.g. on the network volume
+RESULT_CACHE_PATH = os.environ.get(
+    "RESULT_CACHE_PATH", "/tmp/runpod-worker-comfy/result-cache"
+)
+# Maximum size of the cached results in bytes, 0 (the default) disables the cache
+RESULT_CACHE_MAX_BYTES = int(os.environ.get("RESULT_CACHE_MAX_BYTES", 0))
+# Time in seconds after which a cached result expires
+RESULT_CACHE_TTL_S = int(os.environ.get("RESULT_CACHE_TTL_S", 24 * 60 * 60))
+# First bytes of the supported image formats and their MIME type
+IMAGE_SIGNATURES = (
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"BM", "image/bmp"),
+    (b"II*\x00", "image/tiff"),
+    (b"MM\x00*", "image/tiff"),
+)
 # Host where ComfyUI is running
 COMFY_HOST = "127.0.0.1:8188"
+# Time to wait for a connection to ComfyUI in milliseconds
+COMFY_CONNECT_TIMEOUT_MS = int(os.environ.get("COMFY_CONNECT_TIMEOUT_MS", 3000))
+# Time to wait for a response of ComfyUI in milliseconds
+COMFY_READ_TIMEOUT_MS = int(os.environ.get("COMFY_READ_TIMEOUT_MS", 30000))
+# Number of retries for failed requests to ComfyUI
+COMFY_HTTP_RETRIES = int(os.environ.get("COMFY_HTTP_RETRIES", 3))
+# Backoff between retries, the n-th retry waits backoff * 2^(n-1) seconds
+COMFY_HTTP_BACKOFF_FACTOR = float(os.environ.get("COMFY_HTTP_BACKOFF_FACTOR", 0.1))
+# Number of connections to ComfyUI that are kept alive
+COMFY_HTTP_POOL_SIZE = int(os.environ.get("COMFY_HTTP_POOL_SIZE", 16))
+# Error that is returned when ComfyUI stopped responding
+COMFY_UNAVAILABLE_ERROR = (
+    "ComfyUI is not reachable, it might have crashed. Check the logs of the worker."
+)
 # Enforce a clean state after each job is done
 # see https://docs.runpod.io/docs/handler-additional-controls#refresh-worker
 REFRESH_WORKER = os.environ.get("REFRESH_WORKER", "false").lower() == "true"
+# Stream progress, previews and outputs while a workflow runs
+STREAM_OUTPUT = os.environ.get("STREAM_OUTPUT", "false").lower() == "true"
+# Workflow that is run once when the worker starts, to load the models before the first job
+WARMUP_WORKFLOW = os.environ.get("WARMUP_WORKFLOW", "")
+# Number of sampler steps of the warm-up workflow, 0 keeps the steps of the workflow
+WARMUP_STEPS = int(os.environ.get("WARMUP_STEPS", 1))
+# Log the timings of every job as JSON
+METRICS_LOG = os.environ.get("METRICS_LOG", "true").lower() == "true"
+# File for the timings of all jobs in the Prometheus text format, empty to disable it
+METRICS_PROMETHEUS_PATH = os.environ.get("METRICS_PROMETHEUS_PATH", "")
+# Maximum number of jobs that a worker runs at the same time
+MAX_CONCURRENCY = int(os.environ.get("MAX_CONCURRENCY", 1))
+# Number of prompts that may wait in ComfyUI's queue before the worker stops taking jobs
+CONCURRENCY_MAX_QUEUE_PENDING = int(os.environ.get("CONCURRENCY_MAX_QUEUE_PENDING", 1))
+# Free VRAM in MB below which the worker only runs one job at a time
+CONCURRENCY_MIN_FREE_VRAM_MB = int(os.environ.get("CONCURRENCY_MIN_FREE_VRAM_MB", 1024))
+# Time in milliseconds for which the queue depth and free VRAM of ComfyUI are reused
+CONCURRENCY_CHECK_INTERVAL_MS = int(
+    os.environ.get("CONCURRENCY_CHECK_INTERVAL_MS", 1000)
+)
+# Validate workflows against the node schema of ComfyUI before they are queued
+WORKFLOW_VALIDATION = os.environ.get("WORKFLOW_VALIDATION", "true").lower() == "true"
+# Minimum time in milliseconds between two fetches of the node schema of ComfyUI
+WORKFLOW_SCHEMA_REFRESH_INTERVAL_MS = int(
+    os.environ.get("WORKFLOW_SCHEMA_REFRESH_INTERVAL_MS", 5000)
+)
+# Folders with the workflow templates that jobs can use by their name
+WORKFLOW_TEMPLATE_PATHS = os.environ.get(
+    "WORKFLOW_TEMPLATE_PATHS", "/templates,/runpod-volume/templates"
+).split(",")
+
+
+def create_comfy_session():
+    """
+    Create the HTTP session that is used for all requests to ComfyUI.
+
+    The connections are kept alive and reused between jobs. Failed connections
+    and 502/503/504 responses are retried with an exponential backoff.
+    Non-idempotent requests (like queuing a workflow) are only retried when the
+    connection could not be established, so they are never sent twice.
+
+    Returns:
+        requests.Session: The session
+    """
+    retry = Retry(
+        total=COMFY_HTTP_RETRIES,
+        connect=COMFY_HTTP_RETRIES,
+        read=COMFY_HTTP_RETRIES,
+        status=COMFY_HTTP_RETRIES,
+        backoff_factor=COMFY_HTTP_BACKOFF_FACTOR,
+        status_forcelist=(502, 503, 504),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=1, pool_maxsize=COMFY_HTTP_POOL_SIZE, max_retries=retry
+    )
+    session = requests.Session()
+    # ComfyUI runs locally, so proxies and .netrc from the environment never apply
+    session.trust_env = False
+    session.mount("http://", adapter)
+    return session
+
+
+# The session that is shared by all requests to ComfyUI
+comfy_session = create_comfy_session()
+
+
+def check_public_url(url):
+    """
+    Make sure that a URL doesn't point into the worker or its network.
+
+    Otherwise a job could make the worker download from ComfyUI itself
+    (127.0.0.1:8188), from the metadata service of the cloud (169.254.169.254)
+    or from other private hosts. Every address that the host resolves to has
+    to be public, unless INPUT_DOWNLOAD_ALLOW_PRIVATE_HOSTS is set.
+
+    Args:
+        url (str): The URL
+
+    Raises:
+        ValueError: If the host resolves to a non-public address
+        OSError: If the host can't be resolved
+    """
+    if INPUT_DOWNLOAD_ALLOW_PRIVATE_HOSTS:
+        return
+    parsed = urlparse(url)
+    host = parsed.hostname
+    if not host:
+        raise ValueError(f"the URL {url} has no host")
+    port = parsed.port or (443 if parsed.scheme == "https" else 80)
+    for *_, address in socket.getaddrinfo(host, port, proto=socket.IPPROTO_TCP):
+        ip = ipaddress.ip_address(address[0].split("%")[0])
+        if getattr(ip, "ipv4_mapped", None):
+            ip = ip.ipv4_mapped
+        if not ip.is_global or ip.is_multicast:
+            raise ValueError(f"the host {host} resolves to the non-public address {ip}")
+
+
+class DownloadSession(requests.Session):
+    """A session that only sends requests to public hosts, also when it follows a redirect"""
+
+    def send(self, request, **kwargs):
+        check_public_url(request.url)
+        return super().send(request, **kwargs)
+
+
+def create_download_session():
+    """
+    Create the HTTP session that is used to download input images from their URL.
+
+    The connections to the hosts of the images (e.g. S3) are kept alive and
+    reused between jobs. Failed connections and 502/503/504 responses are
+    retried with an exponential backoff. Hosts that are not public are
+    refused, see check_public_url.
+
+    Returns:
+        requests.Session: The session
+    """
+    retry = Retry(
+        total=COMFY_HTTP_RETRIES,
+        backoff_factor=COMFY_HTTP_BACKOFF_FACTOR,
+        status_forcelist=(502, 503, 504),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_maxsize=max(1, INPUT_DOWNLOAD_MAX_WORKERS), max_retries=retry
+    )
+    session = DownloadSession()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+# The session that is shared by all downloads of input images
+download_session = create_download_session()
+
+# Monotonic time of the last successful contact with ComfyUI. None means that
+# ComfyUI was never ready, 0 means that it stopped responding.
+comfy_state = {"last_healthy": None}
+
+# (size, mtime) and SHA-256 of the files in the input folder of ComfyUI, keyed by path
+uploaded_input_hashes = {}
+
+# Names of the input images of running jobs => (sha256, number of jobs)
+input_names_in_use = {}
+input_names_condition = threading.Condition()
+
+# Hashes of the workflows that were queued, the least recently queued first
+queued_workflows = OrderedDict()
+queued_workflows_lock = threading.Lock()
+
+# Histograms of the timings of all jobs, see METRICS_PROMETHEUS_PATH
+prometheus_metrics = PrometheusTextFile(METRICS_PROMETHEUS_PATH)
+
+# The number of running jobs and how many are allowed, see adjust_concurrency
+concurrency_state = {"running": 0, "target": 1, "checked_at": None}
+concurrency_lock = threading.Lock()
+
+# Input images of previous jobs, so that they can be referenced by their SHA-256
+input_cache = InputCache(INPUT_CACHE_PATH, INPUT_CACHE_MAX_BYTES)
+
+# Input images that were downloaded from their URL, revalidated with their ETag
+url_cache = UrlCache(INPUT_URL_CACHE_PATH, INPUT_URL_CACHE_MAX_BYTES)
+
+# Results of previous jobs, keyed by the hash of their workflow and input images
+result_cache = ResultCache(
+    RESULT_CACHE_PATH, RESULT_CACHE_MAX_BYTES, RESULT_CACHE_TTL_S
+)
+
+# Removes the files of finished jobs and keeps the disk below DISK_HIGH_WATER_PERCENT
+file_cleanup = FileCleanup(
+    [
+        os.environ.get("COMFY_OUTPUT_PATH", "/comfyui/output"),
+        os.environ.get("COMFY_INPUT_PATH", "/comfyui/input"),
+        os.environ.get("COMFY_TEMP_PATH", "/comfyui/temp"),
+    ],
+    CLEANUP_RETENTION_S,
+    DISK_HIGH_WATER_PERCENT,
+    DISK_LOW_WATER_PERCENT,
+)
+
+# The models that ComfyUI holds in memory, the least recently used first
+model_residency = ModelResidency(
+    COMFY_MODEL_PATHS, MODEL_RESIDENCY_MAX_MODELS, MODEL_RESIDENCY_RESERVE_MB * 1024**2
+)
+
+# Copies of the models of the network volume on the local disk
+model_tier = ModelTier(
+    MODEL_CACHE_SOURCE_PATH, MODEL_CACHE_PATH, MODEL_CACHE_MAX_BYTES, MODEL_CACHE_VERIFY
+)
+
+# The node schema of ComfyUI, fetched once and again when a workflow doesn't match it
+workflow_schema = WorkflowSchema(
+    lambda: get_object_info(), WORKFLOW_SCHEMA_REFRESH_INTERVAL_MS / 1000
+)
+
+# The workflow templates, loaded once when the worker starts
+workflow_templates = WorkflowTemplates(WORKFLOW_TEMPLATE_PATHS)
+
+
+def comfy_request(method, path, timeout=None, **kwargs):
+    """
+    Send a request to ComfyUI using the shared session.
+
+    Args:
+        method (str): The HTTP method
+        path (str): The path of the endpoint, e.g. "/prompt"
+        timeout (tuple, optional): The (connect, read) timeout in seconds.
+                                   Defaults to COMFY_CONNECT_TIMEOUT_MS and COMFY_READ_TIMEOUT_MS
+        **kwargs: Passed on to requests
+
+    Returns:
+        requests.Response: The response of ComfyUI
+    """
+    if timeout is None:
+        timeout = (COMFY_CONNECT_TIMEOUT_MS / 1000, COMFY_READ_TIMEOUT_MS / 1000)
+    try:
+        response = comfy_session.request(
+            method, f"http://{COMFY_HOST}{path}", timeout=timeout, **kwargs
+        )
+    except requests.ConnectionError:
+        comfy_state["last_healthy"] = 0
+        raise
+    comfy_state["last_healthy"] = time.monotonic()
+    return response
+
+
+def wait_for_comfy_ready():
+    """
+    Wait until ComfyUI is ready to accept workflows.
+
+    This is done once when the worker starts, so that jobs don't have to
+    check the server themselves.
+
+    Returns:
+        bool: True if ComfyUI is ready, otherwise False
+    """
+    ready = check_server(
+        f"http://{COMFY_HOST}{COMFY_READINESS_PATH}",
+        COMFY_API_AVAILABLE_MAX_RETRIES,
+        COMFY_API_AVAILABLE_INTERVAL_MS,
+    )
+    if ready:
+        comfy_state["last_healthy"] = time.monotonic()
+    return ready
+
+
+def ensure_comfy_available():
+    """
+    Make sure that ComfyUI is available before a job is started.
+
+    Every successful request to ComfyUI refreshes its healthy state, so a warm
+    worker doesn't need any extra request. A cheap liveness check is only done
+    when the last contact is older than COMFY_LIVENESS_TTL_MS or a request
+    failed. Only a worker that never saw ComfyUI ready waits for it.
 
+    Returns:
+        bool: True if ComfyUI is available, otherwise False
+    """
+    last_healthy = comfy_state["last_healthy"]
+    if last_healthy is None:
+        return wait_for_comfy_ready()
 
-def validate_input(job_input):
+    if time.monotonic() - last_healthy < COMFY_LIVENESS_TTL_MS / 1000:
+        return True
+
+    try:
+        comfy_request(
+            "GET",
+            COMFY_READINESS_PATH,
+            timeout=(
+                COMFY_LIVENESS_TIMEOUT_MS / 1000,
+                COMFY_LIVENESS_TIMEOUT_MS / 1000,
+            ),
+        )
+        return True
+    except requests.RequestException as e:
+        comfy_state["last_healthy"] = 0
+        print(f"runpod-worker-comfy - ComfyUI is not responding: {e}")
+        return False
+
+
+def validate_input(job_input, metrics=None):
     """
     Validates the input for the handler function.
 
     Args:
         job_input (dict): The input data to validate.
+        metrics (JobMetrics, optional): Counts the lookups of the input cache
 
     Returns:
         tuple: A tuple containing the validated data and an error message, if any.
@@ -46,24 +507,215 @@ def validate_input(job_input):
         except json.JSONDecodeError:
             return None, "Invalid JSON format in input"
 
-    # Validate 'workflow' in input
+    # Validate 'workflow', 'workflows' or 'template' in input
     workflow = job_input.get("workflow")
-    if workflow is None:
+    workflows = job_input.get("workflows")
+    template = None
+    if workflow is not None and workflows is not None:
+        return None, "Provide either 'workflow' or 'workflows', not both"
+    if "template" in job_input:
+        if workflow is not None or workflows is not None:
+            return None, "Provide either 'template' or a workflow, not both"
+        template_name = job_input["template"]
+        template = (
+            workflow_templates.get(template_name)
+            if isinstance(template_name, str)
+            else None
+        )
+        if template is None:
+            return None, (
+                f"Unknown template '{template_name}', available templates: "
+                f"{', '.join(workflow_templates.names()) or 'none'}"
+            )
+        # The nodes without parameters are shared with the template, never change them
+        workflow, error_message = template.render(job_input.get("params", {}))
+        if error_message:
+            return None, error_message
+    elif workflows is not None:
+        if (
+            not isinstance(workflows, list)
+            or not workflows
+            or not all(isinstance(w, dict) for w in workflows)
+        ):
+            return None, "'workflows' must be a non-empty list of workflows"
+    elif workflow is None:
         return None, "Missing 'workflow' parameter"
 
     # Validate 'images' in input, if provided
     images = job_input.get("images")
     if images is not None:
         if not isinstance(images, list) or not all(
-            "name" in image and "image" in image for image in images
+            isinstance(image, dict)
+            and "name" in image
+            and ("image" in image or "sha256" in image or "url" in image)
+            for image in images
         ):
             return (
                 None,
-                "'images' must be a list of objects with 'name' and 'image' keys",
+                "'images' must be a list of objects with 'name' and either 'image', 'sha256' or 'url' keys",
             )
 
+        for image in images:
+            if "url" in image and "image" not in image:
+                url = image["url"]
+                if not isinstance(url, str) or urlparse(url).scheme not in (
+                    "http",
+                    "https",
+                ):
+                    return (
+                        None,
+                        f"The url of image '{image['name']}' must be an http(s) URL",
+                    )
+
+    if workflows is not None:
+        validated_data = {"workflows": workflows, "images": images}
+    else:
+        validated_data = {"workflow": workflow, "images": images}
+    if template is not None:
+        validated_data["template"] = template
+        validated_data["params"] = job_input.get("params", {})
+
+    # Validate 'cache' in input, if provided
+    if "cache" in job_input:
+        if not isinstance(job_input["cache"], bool):
+            return None, "'cache' must be a boolean"
+        validated_data["cache"] = job_input["cache"]
+
+    # Validate 'previews' in input, if provided
+    if "previews" in job_input:
+        if not isinstance(job_input["previews"], bool):
+            return None, "'previews' must be a boolean"
+        validated_data["previews"] = job_input["previews"]
+
+    # Validate 'metrics' in input, if provided
+    if "metrics" in job_input:
+        if not isinstance(job_input["metrics"], bool):
+            return None, "'metrics' must be a boolean"
+        validated_data["metrics"] = job_input["metrics"]
+
+    # Validate 'timeout' in input, if provided
+    if "timeout" in job_input:
+        timeout = job_input["timeout"]
+        if (
+            isinstance(timeout, bool)
+            or not isinstance(timeout, (int, float))
+            or timeout <= 0
+        ):
+            return None, "'timeout' must be a positive number of seconds"
+        validated_data["timeout"] = timeout
+
+    # Decode the images last, so that no other error leaves their files open
+    if images is not None:
+        images, error_message = open_images(images, metrics)
+        if error_message:
+            return None, error_message
+        validated_data["images"] = images
+
     # Return validated data and no error
-    return {"workflow": workflow, "images": images}, None
+    return validated_data, None
+
+
+def open_images(images, metrics=None):
+    """
+    Decode the inline images of a job to the disk and open the referenced ones.
+
+    The base64 encoded images are decoded a part at a time into the input
+    cache, so that malformed data is rejected before any upload. Each payload
+    is removed from the job input once it is decoded, so that it is released
+    before the next one is decoded. The decoded, referenced and downloaded
+    images of a job are limited to INPUT_JOB_MAX_BYTES together.
+
+    Args:
+        images (list): The 'images' of the job input, their 'image' is removed once decoded
+        metrics (JobMetrics, optional): Counts the lookups of the referenced images
+
+    Returns:
+        tuple: (images, error_message). The inline and referenced images have
+               their content as open binary 'file' and its 'sha256', the others
+               keep their 'url'. They have to be closed with close_images.
+               Nothing is open on error.
+    """
+    opened_images = []
+    remaining_bytes = INPUT_JOB_MAX_BYTES
+    for image in images:
+        name = image["name"]
+        if "url" in image and "image" not in image:
+            # Downloaded by download_images, which adds the file and the sha256
+            opened_images.append({"name": name, "url": image["url"]})
+            continue
+
+        error_message = None
+        if "image" in image:
+            data = image.pop("image")
+            if isinstance(data, str) and base64_size(data) > remaining_bytes:
+                error_message = job_bytes_error(name)
+            else:
+                try:
+                    f, sha256 = input_cache.add_base64(data)
+                except (binascii.Error, ValueError, TypeError):
+                    error_message = f"Invalid base64 data for image '{name}'"
+            # The payload is the biggest part of the job and not needed anymore
+            del data
+        else:
+            sha256 = str(image["sha256"]).lower()
+            f = input_cache.open(sha256)
+            if metrics is not None:
+                metrics.cache_lookup("input_cache", f is not None)
+            if f is None:
+                error_message = (
+                    f"Image '{name}' with sha256 {sha256} is not cached "
+                    "on this worker, please send it again with 'image'"
+                )
+        if not error_message:
+            opened_images.append({"name": name, "file": f, "sha256": sha256})
+            remaining_bytes -= os.fstat(f.fileno()).st_size
+            if remaining_bytes < 0:
+                error_message = job_bytes_error(name)
+        if error_message:
+            close_images(opened_images)
+            return None, error_message
+    return opened_images, None
+
+
+def job_bytes_error(name):
+    """The error message for an image that exceeds INPUT_JOB_MAX_BYTES"""
+    return (
+        f"Image '{name}' exceeds the limit of {INPUT_JOB_MAX_BYTES} bytes "
+        "for the images of a job"
+    )
+
+
+def image_bytes(images):
+    """
+    Args:
+        images (list): The images, may be None
+
+    Returns:
+        int: The size of the images that are open as 'file' in bytes
+    """
+    return sum(
+        os.fstat(image["file"].fileno()).st_size
+        for image in images or []
+        if "file" in image
+    )
+
+
+def detect_mime_type(blob):
+    """
+    Detect the MIME type of an image from its first bytes.
+
+    Args:
+        blob (bytes): The image
+
+    Returns:
+        str: The MIME type, "application/octet-stream" if the format is unknown
+    """
+    for signature, mime_type in IMAGE_SIGNATURES:
+        if blob.startswith(signature):
+            return mime_type
+    if blob[:4] == b"RIFF" and blob[8:12] == b"WEBP":
+        return "image/webp"
+    return "application/octet-stream"
 
 
 def check_server(url, retries=500, delay=50):
@@ -81,7 +733,10 @@ def check_server(url, retries=500, delay=50):
 
     for i in range(retries):
         try:
-            response = requests.get(url)
+            response = comfy_session.get(
+                url,
+                timeout=(COMFY_CONNECT_TIMEOUT_MS / 1000, COMFY_READ_TIMEOUT_MS / 1000),
+            )
 
             # If the response status code is 200, the server is up and running
             if response.status_code == 200:
@@ -100,16 +755,229 @@ def check_server(url, retries=500, delay=50):
     return False
 
 
+def sha256_file(path):
+    """
+    Calculate the SHA-256 of a file without loading it into memory at once.
+
+    Args:
+        path (str): The path to the file
+
+    Returns:
+        str: The hex digest
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def input_image_path(name):
+    """
+    Args:
+        name (str): The name of an input image
+
+    Returns:
+        str: The path of the image in the input folder of ComfyUI
+    """
+    COMFY_INPUT_PATH = os.environ.get("COMFY_INPUT_PATH", "/comfyui/input")
+    return os.path.join(COMFY_INPUT_PATH, name)
+
+
+def is_input_present(name, sha256):
+    """
+    Check if the input folder of ComfyUI already contains an image with the same content.
+
+    The hash of a file is only calculated again when its size or mtime changed.
+
+    Args:
+        name (str): The name of the image
+        sha256 (str): The SHA-256 of the image that should be uploaded
+
+    Returns:
+        bool: True if the image doesn't need to be uploaded
+    """
+    path = input_image_path(name)
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return False
+
+    key = (stat.st_size, stat.st_mtime_ns)
+    known = uploaded_input_hashes.get(path)
+    if known is None or known[0] != key:
+        known = (key, sha256_file(path))
+        uploaded_input_hashes[path] = known
+    return known[1] == sha256
+
+
+def download_image(image, max_bytes=None, metrics=None):
+    """
+    Download a single input image from its URL, or open it from the URL cache.
+
+    Args:
+        image (dict): The 'name' and the 'url' of the image
+        max_bytes (int, optional): The maximum size of the image. Defaults to INPUT_DOWNLOAD_MAX_BYTES
+        metrics (JobMetrics, optional): Counts the lookups of the URL cache
+
+    Returns:
+        tuple: (image, error_message). The image has the downloaded content
+               as open binary 'file' and its 'sha256'.
+    """
+    try:
+        f, sha256, cached = url_cache.open(
+            image["url"],
+            download_session,
+            INPUT_DOWNLOAD_MAX_BYTES if max_bytes is None else max_bytes,
+            INPUT_DOWNLOAD_TIMEOUT_S,
+        )
+    except (requests.RequestException, ValueError, OSError) as e:
+        return None, f"Error downloading image '{image['name']}': {e}"
+    if metrics is not None:
+        metrics.cache_lookup("url_cache", cached)
+    return {"name": image["name"], "file": f, "sha256": sha256}, None
+
+
+def download_images(images, metrics=None):
+    """
+    Download the input images that are given by their URL.
+
+    The images are downloaded concurrently, using at most
+    INPUT_DOWNLOAD_MAX_WORKERS connections, and streamed to the disk instead
+    of being held in memory. Images whose URL was downloaded before are only
+    downloaded again when their ETag changed. Together with the other images
+    of the job, they are limited to INPUT_JOB_MAX_BYTES.
+
+    Args:
+        images (list): The validated images, the ones with a 'url' are downloaded
+        metrics (JobMetrics, optional): Counts the lookups of the URL cache
+
+    Returns:
+        tuple: (images, error_message). The images that had a 'url' have the
+               downloaded content as open binary 'file' and its 'sha256', they
+               have to be closed with close_images. Nothing is open on error.
+    """
+    pending = [index for index, image in enumerate(images or []) if "url" in image]
+    if not pending:
+        return images, None
+
+    images = list(images)
+    errors = []
+    # Each download can use what the other images left, their total is checked afterwards
+    max_bytes = min(INPUT_DOWNLOAD_MAX_BYTES, INPUT_JOB_MAX_BYTES - image_bytes(images))
+    print(f"runpod-worker-comfy - image(s) download")
+    with ThreadPoolExecutor(
+        max_workers=max(1, min(INPUT_DOWNLOAD_MAX_WORKERS, len(pending)))
+    ) as executor:
+        downloads = executor.map(
+            lambda image: download_image(image, max(0, max_bytes), metrics),
+            [images[index] for index in pending],
+        )
+        for index, (image, error_message) in zip(pending, downloads):
+            if error_message:
+                errors.append(error_message)
+            else:
+                images[index] = image
+    if not errors and image_bytes(images) > INPUT_JOB_MAX_BYTES:
+        errors.append(
+            f"The images of the job exceed the limit of {INPUT_JOB_MAX_BYTES} bytes"
+        )
+
+    if errors:
+        close_images(images)
+        return None, "; ".join(errors)
+
+    print(
+        f"runpod-worker-comfy - image(s) download complete, url cache {json.dumps(url_cache.stats())}"
+    )
+    return images, None
+
+
+def close_images(images):
+    """
+    Close the files of opened and downloaded images, see open_images and download_images.
+
+    Args:
+        images (list): The images, may be None
+    """
+    for image in images or []:
+        if "file" in image:
+            image["file"].close()
+
+
+def upload_image(image):
+    """
+    Upload a single decoded image to ComfyUI, unless it already has the same content.
+
+    Args:
+        image (dict): The 'name' of the image and either its content as open
+                      'file', the decoded 'blob' or the base64 encoded 'image'
+
+    Returns:
+        tuple: (message, error_message)
+    """
+    name = image["name"]
+    if "file" in image:
+        content = image["file"]
+        content.seek(0)
+        mime_type = detect_mime_type(content.read(16))
+        content.seek(0)
+        sha256 = image["sha256"]
+    else:
+        blob = image["blob"] if "blob" in image else base64.b64decode(image["image"])
+        content = BytesIO(blob)
+        mime_type = detect_mime_type(blob)
+        sha256 = image.get("sha256") or hashlib.sha256(blob).hexdigest()
+
+    if is_input_present(name, sha256):
+        return f"Skipped {name}, it is already uploaded", None
+
+    try:
+        if "file" in image:
+            # Streamed from the disk, requests would read the whole file into memory
+            body = MultipartFile(
+                "image", name, content, mime_type, {"overwrite": "true"}
+            )
+            response = comfy_request(
+                "POST",
+                "/upload/image",
+                data=body,
+                headers={"Content-Type": body.content_type},
+            )
+        else:
+            # Prepare the form data
+            files = {
+                "image": (name, content, mime_type),
+                "overwrite": (None, "true"),
+            }
+            response = comfy_request("POST", "/upload/image", files=files)
+    except requests.ConnectionError:
+        # ComfyUI is gone, which fails the whole job
+        raise
+    except (requests.RequestException, OSError) as e:
+        return None, f"Error uploading {name}: {e}"
+    if response.status_code != 200:
+        return None, f"Error uploading {name}: {response.text}"
+    # Only the files that the worker wrote are ever removed
+    file_cleanup.register([input_image_path(name)])
+    return f"Successfully uploaded {name}", None
+
+
 def upload_images(images):
     """
-    Upload a list of base64 encoded images to the ComfyUI server using the /upload/image endpoint.
+    Upload a list of images to the ComfyUI server using the /upload/image endpoint.
+
+    The images are uploaded concurrently, using at most INPUT_UPLOAD_MAX_WORKERS
+    connections. Images whose content is already in the input folder of ComfyUI
+    are skipped.
 
     Args:
-        images (list): A list of dictionaries, each containing the 'name' of the image and the 'image' as a base64 encoded string.
-        server_address (str): The address of the ComfyUI server.
+        images (list): A list of dictionaries, each containing the 'name' of the image and
+                       either its content as open 'file', the decoded 'blob' or the
+                       'image' as a base64 encoded string.
 
     Returns:
-        list: A list of responses from the server for each image upload.
+        dict: The status, a message and the details for each image upload.
     """
     if not images:
         return {"status": "success", "message": "No images to upload", "details": []}
@@ -119,23 +987,14 @@ def upload_images(images):
 
     print(f"runpod-worker-comfy - image(s) upload")
 
-    for image in images:
-        name = image["name"]
-        image_data = image["image"]
-        blob = base64.b64decode(image_data)
-
-        # Prepare the form data
-        files = {
-            "image": (name, BytesIO(blob), "image/png"),
-            "overwrite": (None, "true"),
-        }
-
-        # POST request to upload the image
-        response = requests.post(f"http://{COMFY_HOST}/upload/image", files=files)
-        if response.status_code != 200:
-            upload_errors.append(f"Error uploading {name}: {response.text}")
-        else:
-            responses.append(f"Successfully uploaded {name}")
+    with ThreadPoolExecutor(
+        max_workers=max(1, min(INPUT_UPLOAD_MAX_WORKERS, len(images)))
+    ) as executor:
+        for message, error_message in executor.map(upload_image, images):
+            if error_message:
+                upload_errors.append(error_message)
+            else:
+                responses.append(message)
 
     if upload_errors:
         print(f"runpod-worker-comfy - image(s) upload with errors")
@@ -153,198 +1012,1965 @@ def upload_images(images):
     }
 
 
-def queue_workflow(workflow):
+def acquire_input_names(images, timeout=None):
     """
-    Queue a workflow to be processed by ComfyUI
+    Reserve the names of the input images for a job.
+
+    ComfyUI reads an input image when the workflow runs, so a job that runs at
+    the same time must not overwrite an image with the same name but a
+    different content. Such a job waits until the other one is done.
 
     Args:
-        workflow (dict): A dictionary containing the workflow to be processed
+        images (list): The validated images with 'name' and 'sha256'
+        timeout (float, optional): The maximum time to wait in seconds, None waits forever
 
     Returns:
-        dict: The JSON response from ComfyUI after processing the workflow
+        bool: Whether the names were reserved, False if the wait timed out
     """
+    images = images or []
+    with input_names_condition:
+        if not input_names_condition.wait_for(
+            lambda: all(
+                input_names_in_use.get(image["name"], (image["sha256"], 0))[0]
+                == image["sha256"]
+                for image in images
+            ),
+            timeout,
+        ):
+            return False
+        for image in images:
+            _, count = input_names_in_use.get(image["name"], (image["sha256"], 0))
+            input_names_in_use[image["name"]] = (image["sha256"], count + 1)
+    file_cleanup.protect(input_image_path(image["name"]) for image in images)
+    return True
 
-    # The top level element "prompt" is required by ComfyUI
-    data = json.dumps({"prompt": workflow}).encode("utf-8")
 
-    req = urllib.request.Request(f"http://{COMFY_HOST}/prompt", data=data)
-    return json.loads(urllib.request.urlopen(req).read())
+def release_input_names(images):
+    """
+    Release the names that were reserved by acquire_input_names.
 
+    Images that are no longer used by any job are removed from the input
+    folder of ComfyUI (CLEANUP_FILES).
 
-def get_history(prompt_id):
+    Args:
+        images (list): The validated images with 'name' and 'sha256'
     """
-    Retrieve the history of a given prompt using its ID
+    images = images or []
+    unused_names = []
+    with input_names_condition:
+        for image in images:
+            sha256, count = input_names_in_use.pop(image["name"], (None, 0))
+            if count > 1:
+                input_names_in_use[image["name"]] = (sha256, count - 1)
+            else:
+                unused_names.append(image["name"])
+        input_names_condition.notify_all()
+
+    file_cleanup.unprotect(input_image_path(image["name"]) for image in images)
+    if CLEANUP_FILES:
+        file_cleanup.remove(input_image_path(name) for name in unused_names)
+
+
+def queue_workflow(workflow, client_id=None):
+    """
+    Queue a workflow to be processed by ComfyUI
 
     Args:
-        prompt_id (str): The ID of the prompt whose history is to be retrieved
+        workflow (dict): A dictionary containing the workflow to be processed
+        client_id (str, optional): The ID of the WebSocket client that should receive the execution events
 
     Returns:
-        dict: The history of the prompt, containing all the processing steps and results
+        dict: The JSON response from ComfyUI after processing the workflow
     """
-    with urllib.request.urlopen(f"http://{COMFY_HOST}/history/{prompt_id}") as response:
-        return json.loads(response.read())
 
+    # The top level element "prompt" is required by ComfyUI
+    payload = {"prompt": workflow}
+    if client_id:
+        payload["client_id"] = client_id
 
-def base64_encode(img_path):
-    """
-    Returns base64 encoded image.
+    response = comfy_request("POST", "/prompt", json=payload)
+    if response.status_code != 200:
+        raise RuntimeError(
+            f"ComfyUI returned status {response.status_code}: {response.text}"
+        )
+    return response.json()
 
-    Args:
-        img_path (str): The path to the image
+
+def get_object_info():
+    """
+    Retrieve the node schema of ComfyUI: the inputs and outputs of every node
+    class and the values of every list, e.g. the names of the checkpoints.
 
     Returns:
-        str: The base64 encoded image
+        dict: The node schema, keyed by the class of the node
     """
-    with open(img_path, "rb") as image_file:
-        encoded_string = base64.b64encode(image_file.read()).decode("utf-8")
-        return f"{encoded_string}"
+    response = comfy_request("GET", "/object_info")
+    response.raise_for_status()
+    return response.json()
 
 
-def process_output_images(outputs, job_id):
+def validate_workflows(workflows, images, template=None):
     """
-    This function takes the "outputs" from image generation and the job ID,
-    then determines the correct way to return the image, either as a direct URL
-    to an AWS S3 bucket or as a base64 encoded string, depending on the
-    environment configuration.
+    Validate workflows against the node schema of ComfyUI, so that invalid
+    workflows fail before they are queued.
+
+    The validation is skipped if it is turned off (WORKFLOW_VALIDATION) or
+    the schema can't be fetched, ComfyUI still validates every workflow then.
 
     Args:
-        outputs (dict): A dictionary containing the outputs from image generation,
-                        typically includes node IDs and their respective output data.
-        job_id (str): The unique identifier for the job.
+        workflows (list): The workflows
+        images (list): The input images of the job, their names are valid values
+                       for every list input
+        template (WorkflowTemplate, optional): The template that the workflows
+                       were rendered from, only their parameters are validated then
 
     Returns:
-        dict: A dictionary with the status ('success' or 'error') and the message,
-              which is either the URL to the image in the AWS S3 bucket or a base64
-              encoded string of the image. In case of error, the message details the issue.
-
-    The function works as follows:
-    - It first determines the output path for the images from an environment variable,
-      defaulting to "/comfyui/output" if not set.
-    - It then iterates through the outputs to find the filenames of the generated images.
-    - After confirming the existence of the image in the output folder, it checks if the
-      AWS S3 bucket is configured via the BUCKET_ENDPOINT_URL environment variable.
-    - If AWS S3 is configured, it uploads the image to the bucket and returns the URL.
-    - If AWS S3 is not configured, it encodes the image in base64 and returns the string.
-    - If the image file does not exist in the output folder, it returns an error status
-      with a message indicating the missing image file.
+        list: The error message of every workflow, None if it is valid
     """
+    if not WORKFLOW_VALIDATION:
+        return [None] * len(workflows)
 
-    # The path where ComfyUI stores the generated images
-    COMFY_OUTPUT_PATH = os.environ.get("COMFY_OUTPUT_PATH", "/comfyui/output")
+    input_names = [image["name"] for image in images or []]
+    error_messages = []
+    for workflow in workflows:
+        try:
+            if template is None:
+                errors = workflow_schema.validate(workflow, input_names)
+            else:
+                errors = template.validate(workflow_schema, workflow, input_names)
+        except (requests.RequestException, ValueError) as e:
+            print(
+                f"runpod-worker-comfy - can't fetch the node schema, skipping the validation: {e}"
+            )
+            return [None] * len(workflows)
+        error_messages.append(
+            f"Invalid workflow: {'; '.join(errors)}" if errors else None
+        )
+    return error_messages
 
-    output_images = {}
 
-    for node_id, node_output in outputs.items():
-        if "images" in node_output:
-            for image in node_output["images"]:
-                output_images = os.path.join(image["subfolder"], image["filename"])
+def get_vram_free():
+    """
+    Returns:
+        int: The free VRAM in bytes of the first device, None if ComfyUI doesn't report it
+    """
+    try:
+        stats = comfy_request(
+            "GET", COMFY_READINESS_PATH, timeout=COMFY_LIVENESS_TIMEOUT_MS / 1000
+        ).json()
+    except (requests.RequestException, ValueError) as e:
+        print(f"runpod-worker-comfy - could not get the free VRAM: {e}")
+        return None
+    devices = stats.get("devices") or []
+    return devices[0].get("vram_free") if devices else None
 
-    print(f"runpod-worker-comfy - image generation is done")
 
-    # expected image output folder
-    local_image_path = f"{COMFY_OUTPUT_PATH}/{output_images}"
+def prepare_models(job_id, workflows, metrics):
+    """
+    Note the models of a job and unload the models of earlier jobs if the job needs their memory.
 
-    print(f"runpod-worker-comfy - {local_image_path}")
+    ComfyUI only unloads its models via /free once the prompt that it
+    executes right now is done, so a running workflow is never affected.
+    Models without a copy on the local disk are copied in the background
+    (MODEL_CACHE_PATH).
 
-    # The image is in the output folder
-    if os.path.exists(local_image_path):
-        if os.environ.get("BUCKET_ENDPOINT_URL", False):
-            # URL to image in AWS S3
-            image = rp_upload.upload_image(job_id, local_image_path)
-            print(
-                "runpod-worker-comfy - the image was generated and uploaded to AWS S3"
+    Args:
+        job_id (str): The unique identifier for the job
+        workflows (list): The workflows of the job that are queued
+        metrics (JobMetrics): Gets the models of the job and the resident models
+    """
+    models = sorted(
+        {name for workflow in workflows for name in workflow_models(workflow)}
+    )
+    resident = model_residency.resident_models()
+    freed = False
+    if MODEL_RESIDENCY and model_residency.needs_free(models, get_vram_free, job_id):
+        print(f"runpod-worker-comfy - unloading the models {resident} to load {models}")
+        try:
+            response = comfy_request(
+                "POST", "/free", json={"unload_models": True, "free_memory": True}
             )
+            response.raise_for_status()
+        except requests.RequestException as e:
+            print(f"runpod-worker-comfy - could not unload the models: {e}")
         else:
-            # base64 image
-            image = base64_encode(local_image_path)
-            print(
-                "runpod-worker-comfy - the image was generated and converted to base64"
-            )
-
-        return {
-            "status": "success",
-            "message": image,
-        }
-    else:
-        print("runpod-worker-comfy - the image does not exist in the output folder")
-        return {
-            "status": "error",
-            "message": f"the image does not exist in the specified output folder: {local_image_path}",
-        }
+            model_residency.freed()
+            freed = True
+    model_residency.job_started(job_id, models)
+    metrics.models = {"required": models, "resident": resident, "freed": freed}
+    if model_tier.enabled:
+        # Models without a local copy are loaded from the volume and copied for the next jobs
+        metrics.models["cached"] = model_tier.job_started(job_id, models)
+        print(f"runpod-worker-comfy - model cache {json.dumps(model_tier.stats())}")
 
 
-def handler(job):
+def get_history(prompt_id):
     """
-    The main function that handles a job of generating an image.
-
-    This function validates the input, sends a prompt to ComfyUI for processing,
-    polls ComfyUI for result, and retrieves generated images.
+    Retrieve the history of a given prompt using its ID
 
     Args:
-        job (dict): A dictionary containing job details and input parameters.
+        prompt_id (str): The ID of the prompt whose history is to be retrieved
 
     Returns:
-        dict: A dictionary containing either an error message or a success status with generated images.
+        dict: The history of the prompt, containing all the processing steps and results
+    """
+    response = comfy_request("GET", f"/history/{prompt_id}")
+    response.raise_for_status()
+    return response.json()
+
+
+def get_queue():
+    """
+    Retrieve the prompts in the queue of ComfyUI.
+
+    Returns:
+        tuple: (running_ids, pending_ids). The set of the IDs of the prompts that
+               are executed and the list of the IDs of the ones that wait, in order.
+    """
+    response = comfy_request("GET", "/queue")
+    response.raise_for_status()
+    queue = response.json()
+    running_ids = {item[1] for item in queue.get("queue_running", [])}
+    pending_ids = [item[1] for item in queue.get("queue_pending", [])]
+    return running_ids, pending_ids
+
+
+def cancel_prompts(prompt_ids):
+    """
+    Cancel prompts, so that they don't keep the GPU busy after a job gave up on them.
+
+    Waiting prompts are deleted from the queue of ComfyUI and a running prompt
+    is interrupted. The interrupt is only sent when one of the prompts is
+    running, as older versions of ComfyUI interrupt whatever prompt runs.
+
+    Args:
+        prompt_ids (iterable): The IDs of the prompts
+    """
+    prompt_ids = set(prompt_ids)
+    if not prompt_ids:
+        return
+    try:
+        running_ids, pending_ids = get_queue()
+        waiting = [prompt_id for prompt_id in pending_ids if prompt_id in prompt_ids]
+        if waiting:
+            comfy_request("POST", "/queue", json={"delete": waiting})
+        for prompt_id in prompt_ids & running_ids:
+            comfy_request("POST", "/interrupt", json={"prompt_id": prompt_id})
+        print(
+            f"runpod-worker-comfy - cancelled {len(waiting)} waiting and "
+            f"{len(prompt_ids & running_ids)} running workflows"
+        )
+    except requests.RequestException as e:
+        print(f"runpod-worker-comfy - can't cancel the workflows: {e}")
+
+
+def watch_prompts(prompt_ids, deadline=None):
+    """
+    Args:
+        prompt_ids (iterable): The IDs of the prompts of a job
+        deadline (float, optional): The time.monotonic() at which the job times out,
+                                    defaults to JOB_TIMEOUT_S from now
+
+    Returns:
+        PromptWatch: Decides how long to wait for the prompts
+    """
+    if deadline is None:
+        deadline = time.monotonic() + JOB_TIMEOUT_S
+    return PromptWatch(
+        prompt_ids,
+        deadline,
+        COMFY_STALL_TIMEOUT_S,
+        COMFY_POLLING_MIN_INTERVAL_MS / 1000,
+        COMFY_POLLING_INTERVAL_MS / 1000,
+    )
+
+
+def open_websocket(client_id):
+    """
+    Open a WebSocket connection to ComfyUI to receive the execution events of our prompts.
+
+    The connection has to be opened before the workflow is queued, otherwise
+    fast workflows might finish before we are listening.
+
+    Args:
+        client_id (str): The ID that identifies this client against ComfyUI
+
+    Returns:
+        websocket.WebSocket: The connected WebSocket or None if it could not be opened
+    """
+    try:
+        return websocket.create_connection(
+            f"ws://{COMFY_HOST}/ws?clientId={client_id}",
+            timeout=COMFY_WEBSOCKET_CONNECT_TIMEOUT_MS / 1000,
+        )
+    except (websocket.WebSocketException, OSError) as e:
+        print(
+            f"runpod-worker-comfy - websocket not available, falling back to polling: {e}"
+        )
+        return None
+
+
+def is_prompt_finished(history, prompt_id):
+    """
+    Check if the history of ComfyUI contains the finished prompt.
+
+    Args:
+        history (dict): The history as returned by get_history
+        prompt_id (str): The ID of the prompt
+
+    Returns:
+        bool: True if the prompt has outputs or ComfyUI marked it as completed
+    """
+    entry = history.get(prompt_id)
+    if not entry:
+        return False
+    return bool(entry.get("outputs")) or entry.get("status", {}).get("completed", False)
+
+
+def receive_websocket_messages(ws, deadline):
+    """
+    Receive the messages of ComfyUI's WebSocket until the deadline is reached.
+
+    Args:
+        ws (websocket.WebSocket): The connected WebSocket
+        deadline (float): The time.monotonic() until which to receive
+
+    Yields:
+        The parsed event (dict) of a text message, the raw data (bytes) of a
+        binary message or None when the connection was silent for
+        COMFY_WEBSOCKET_RECV_TIMEOUT_MS
+
+    Raises:
+        websocket.WebSocketException, OSError: When the connection was lost
+    """
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+
+        ws.settimeout(min(remaining, COMFY_WEBSOCKET_RECV_TIMEOUT_MS / 1000))
+        try:
+            message = ws.recv()
+        except websocket.WebSocketTimeoutException:
+            yield None
+            continue
+
+        yield json.loads(message) if isinstance(message, str) else message
+
+
+def execution_error_message(event):
+    """
+    Args:
+        event (dict): An "execution_error" or "execution_interrupted" event of ComfyUI
+
+    Returns:
+        str: The error message for the client
+    """
+    if event["type"] == "execution_interrupted":
+        return "Workflow execution was interrupted"
+    data = event.get("data", {})
+    return (
+        f"Workflow execution error in node {data.get('node_id')} "
+        f"({data.get('node_type')}): {data.get('exception_message')}"
+    )
+
+
+def next_websocket_completion(ws, prompt_ids, watch, metrics=None):
+    """
+    Wait until ComfyUI reports that one of the prompts was executed via its WebSocket events.
+
+    ComfyUI sends an "executing" message with "node" set to None once a prompt
+    is done and its history was stored. When the connection is silent for
+    COMFY_WEBSOCKET_RECV_TIMEOUT_MS, the history is checked once, so that a lost
+    message can't keep us waiting until the deadline.
+
+    Args:
+        ws (websocket.WebSocket): The connected WebSocket
+        prompt_ids (set): The IDs of the prompts that are not finished yet
+        watch (PromptWatch): Notes the progress of the prompts and decides when to give up
+        metrics (JobMetrics, optional): Receives the execution events of the prompts
+
+    Returns:
+        tuple: (prompt_id, error_message). The prompt_id is None when the deadline
+               was reached or a prompt stalled (with an error_message) or when the
+               connection was lost (without), in which case the caller should
+               fall back to polling.
+    """
+    try:
+        for event in receive_websocket_messages(ws, watch.deadline):
+            if event is None:
+                for prompt_id in prompt_ids:
+                    if is_prompt_finished(get_history(prompt_id), prompt_id):
+                        return prompt_id, None
+            elif isinstance(event, dict):
+                data = event.get("data", {})
+                prompt_id = data.get("prompt_id")
+                if prompt_id in prompt_ids:
+                    watch.observe_event(event)
+                    if metrics:
+                        metrics.observe_event(event)
+
+                    if event["type"] == "executing" and data.get("node") is None:
+                        return prompt_id, None
+                    if event["type"] in ("execution_error", "execution_interrupted"):
+                        return prompt_id, execution_error_message(event)
+            else:
+                # Binary messages contain the previews of the sampler
+                watch.observe_event(event)
+
+            error_message = watch.error_message()
+            if error_message:
+                return None, error_message
+    except (websocket.WebSocketException, OSError) as e:
+        print(f"runpod-worker-comfy - websocket connection lost: {e}")
+        return None, None
+
+    return None, watch.error_message()
+
+
+def poll_for_completions(prompt_ids, watch):
+    """
+    Poll the queue of ComfyUI until the prompts are finished.
+
+    A prompt leaves the queue once its history is stored, so the history of
+    every prompt is only fetched once. The prompts are cancelled when the
+    deadline is reached.
+
+    Args:
+        prompt_ids (set): The IDs of the prompts to wait for
+        watch (PromptWatch): Decides how long to wait between two polls and when to give up
+
+    Yields:
+        tuple: (prompt_id, history, error_message) for every prompt once it is finished
+    """
+    pending = set(prompt_ids)
+    while pending:
+        running_ids, pending_ids = get_queue()
+        watch.observe_queue(running_ids, pending_ids)
+        queued = running_ids | set(pending_ids)
+
+        for prompt_id in list(pending):
+            if prompt_id in queued:
+                continue
+            pending.discard(prompt_id)
+            watch.done(prompt_id)
+
+            history = get_history(prompt_id)
+            status = history.get(prompt_id, {}).get("status", {})
+            if status.get("status_str") == "error":
+                yield (
+                    prompt_id,
+                    None,
+                    "Workflow execution failed, see the ComfyUI logs for details",
+                )
+            elif prompt_id in history:
+                yield prompt_id, history, None
+            else:
+                yield (
+                    prompt_id,
+                    None,
+                    "The workflow is neither in the queue nor in the history of ComfyUI",
+                )
+
+        if not pending:
+            return
+
+        # Without WebSocket events there is no progress to tell whether a prompt stalled
+        error_message = watch.error_message(check_stall=False)
+        if error_message:
+            break
+
+        # Wait before trying again
+        time.sleep(watch.next_interval())
+
+    cancel_prompts(pending)
+    for prompt_id in pending:
+        yield prompt_id, None, error_message
+
+
+def wait_for_completions(ws, prompt_ids, metrics=None, deadline=None):
+    """
+    Wait until the prompts are finished and yield each one as soon as it is done.
+
+    The WebSocket events are used when a connection is available, the history of
+    a prompt is then fetched only once. Polling the queue is used as fallback
+    when there is no WebSocket or the connection was lost. Prompts that are
+    still running when the deadline is reached or that stalled are cancelled.
+
+    Args:
+        ws (websocket.WebSocket): The connected WebSocket or None
+        prompt_ids (list): The IDs of the prompts to wait for
+        metrics (JobMetrics, optional): Receives the execution events of the prompts
+        deadline (float, optional): The time.monotonic() at which the job times out,
+                                    defaults to JOB_TIMEOUT_S from now
+
+    Yields:
+        tuple: (prompt_id, history, error_message) for every prompt once it is finished
+    """
+    watch = watch_prompts(prompt_ids, deadline)
+    pending = set(prompt_ids)
+    # Prompts that are done, but their history was not found right away
+    unresolved = set()
+
+    while ws is not None and pending:
+        prompt_id, error_message = next_websocket_completion(
+            ws, pending, watch, metrics
+        )
+        if prompt_id is None:
+            if error_message:
+                cancel_prompts(pending)
+                for prompt_id in pending | unresolved:
+                    yield prompt_id, None, error_message
+                return
+            break
+
+        pending.discard(prompt_id)
+        watch.done(prompt_id)
+        if error_message:
+            yield prompt_id, None, error_message
+            continue
+
+        history = get_history(prompt_id)
+        if prompt_id in history:
+            yield prompt_id, history, None
+        else:
+            unresolved.add(prompt_id)
+
+    yield from poll_for_completions(pending | unresolved, watch)
+
+
+def wait_for_completion(ws, prompt_id):
+    """
+    Wait until a single prompt is finished and return its history.
+
+    Args:
+        ws (websocket.WebSocket): The connected WebSocket or None
+        prompt_id (str): The ID of the prompt to wait for
+
+    Returns:
+        tuple: (history, error_message)
+    """
+    for _, history, error_message in wait_for_completions(ws, [prompt_id]):
+        return history, error_message
+
+
+def base64_encode(img_path):
+    """
+    Returns base64 encoded image.
+
+    Args:
+        img_path (str): The path to the image
+
+    Returns:
+        str: The base64 encoded image
+    """
+    return output_transport.encode_base64_file(img_path)
+
+
+def collect_output_files(outputs, output_path):
+    """
+    Collect every file that was written by the output nodes of a workflow.
+
+    Args:
+        outputs (dict): The "outputs" of the history, keyed by node ID
+        output_path (str): The folder where ComfyUI stores its outputs
+
+    Returns:
+        list: One dict per file with the node_id, the kind of output ("images",
+              "gifs" or "videos"), the filename, the subfolder and the local path
+    """
+    files = []
+    for node_id, node_output in outputs.items():
+        for kind in OUTPUT_FILE_KEYS:
+            for item in node_output.get(kind, []):
+                # Previews are stored in the temp folder and are not part of the result
+                if item.get("type") == "temp":
+                    continue
+                subfolder = item.get("subfolder", "")
+                files.append(
+                    {
+                        "node_id": node_id,
+                        "kind": kind,
+                        "filename": item["filename"],
+                        "subfolder": subfolder,
+                        "path": os.path.join(output_path, subfolder, item["filename"]),
+                    }
+                )
+    return files
+
+
+def output_file_paths(outputs):
+    """
+    Args:
+        outputs (dict): The "outputs" of the history, keyed by node ID
+
+    Returns:
+        list: The paths of all files of the outputs, including the previews in the temp folder
+    """
+    folders = {
+        "output": os.environ.get("COMFY_OUTPUT_PATH", "/comfyui/output"),
+        "temp": os.environ.get("COMFY_TEMP_PATH", "/comfyui/temp"),
+    }
+    paths = []
+    for node_output in outputs.values():
+        for kind in OUTPUT_FILE_KEYS:
+            for item in node_output.get(kind, []):
+                folder = folders.get(item.get("type", "output"))
+                if folder:
+                    paths.append(
+                        os.path.join(
+                            folder, item.get("subfolder", ""), item["filename"]
+                        )
+                    )
+    return paths
+
+
+def clean_up_outputs(outputs):
+    """
+    Remove the files of outputs that were delivered (CLEANUP_FILES).
+
+    The files are registered with the file cleanup either way, so that they
+    can be evicted when the disk is full.
+
+    Args:
+        outputs (dict): The "outputs" of the history, keyed by node ID
+    """
+    paths = output_file_paths(outputs)
+    file_cleanup.register(paths)
+    if CLEANUP_FILES:
+        file_cleanup.remove(paths)
+
+
+def workflow_to_queue(workflow):
+    """
+    The workflow to queue, with unique outputs if it ran before on this worker.
+
+    Only a workflow that ran before can have its outputs cached by ComfyUI,
+    and only then their files might be removed already (CLEANUP_FILES), so
+    all other workflows are queued as they are, see unique_outputs.
+
+    Args:
+        workflow (dict): The workflow
+
+    Returns:
+        dict: The workflow or a copy of it with unique outputs
+    """
+    if not CLEANUP_FILES:
+        return workflow
+    key = ResultCache.key(workflow)
+    with queued_workflows_lock:
+        repeated = key in queued_workflows
+        queued_workflows[key] = True
+        queued_workflows.move_to_end(key)
+        while len(queued_workflows) > QUEUED_WORKFLOWS_MAX:
+            queued_workflows.popitem(last=False)
+    return unique_outputs(workflow) if repeated else workflow
+
+
+def unique_outputs(workflow):
+    """
+    Make the output nodes of a workflow run again, even if nothing changed.
+
+    ComfyUI caches the outputs of nodes whose inputs didn't change, so an
+    identical workflow would report the files of an earlier run, which might
+    be removed already. An extra input, which ComfyUI doesn't pass on to the
+    node, makes every run of the output nodes unique, while all the nodes
+    before them stay cached. Output nodes are the nodes that no other node
+    links to.
+
+    Args:
+        workflow (dict): The workflow
+
+    Returns:
+        dict: A copy of the workflow with the extra input in the output nodes
+    """
+    linked = {
+        str(value[0])
+        for node in workflow.values()
+        if isinstance(node, dict)
+        for value in (node.get("inputs") or {}).values()
+        if is_link(value)
+    }
+    run = uuid.uuid4().hex
+    return {
+        node_id: (
+            {**node, "inputs": {**(node.get("inputs") or {}), UNIQUE_RUN_INPUT: run}}
+            if isinstance(node, dict) and node_id not in linked
+            else node
+        )
+        for node_id, node in workflow.items()
+    }
+
+
+def deliver_output_file(job_id, output_file, use_bucket, inline_budget=None):
+    """
+    Return a single output file either as URL to AWS S3 or as base64 encoded string.
+
+    Args:
+        job_id (str): The unique identifier for the job
+        output_file (dict): The file as returned by collect_output_files
+        use_bucket (bool): Upload the file to AWS S3 instead of encoding it
+        inline_budget (InlineBudget, optional): The bytes that the outputs of the
+                                                job can still take up as base64
+
+    Returns:
+        dict: The filename, subfolder, type ("s3_url", "base64" or "error") and
+              the data, which is the URL, the base64 string or the error message
+    """
+    local_path = output_file["path"]
+    result = {
+        "filename": output_file["filename"],
+        "subfolder": output_file["subfolder"],
+    }
+
+    if not os.path.exists(local_path):
+        print(f"runpod-worker-comfy - {local_path} does not exist in the output folder")
+        return {
+            **result,
+            "type": "error",
+            "data": f"the image does not exist in the specified output folder: {local_path}",
+        }
+
+    reencoded_path = None
+    try:
+        # Shrink images before they are returned, if configured
+        if OUTPUT_IMAGE_FORMAT and output_file["kind"] == "images":
+            reencoded_path = output_transport.reencode_image(
+                local_path, OUTPUT_IMAGE_FORMAT, OUTPUT_IMAGE_QUALITY
+            )
+            if reencoded_path:
+                result["filename"] = (
+                    os.path.splitext(output_file["filename"])[0]
+                    + os.path.splitext(reencoded_path)[1]
+                )
+        path = reencoded_path or local_path
+
+        if use_bucket:
+            # URL to image in AWS S3, whatever its size
+            return {
+                **result,
+                "type": "s3_url",
+                "data": output_transport.upload_file(
+                    job_id,
+                    path,
+                    OUTPUT_UPLOAD_CHUNK_BYTES,
+                    OUTPUT_UPLOAD_MAX_CONCURRENCY,
+                    filename=result["filename"],
+                ),
+            }
+
+        # Big outputs would make the response too big for RunPod
+        size = os.path.getsize(path)
+        if 0 < OUTPUT_INLINE_MAX_BYTES < size:
+            return {
+                **result,
+                "type": "error",
+                "data": f"{result['filename']} has {size} bytes, which is more than "
+                f"OUTPUT_INLINE_MAX_BYTES ({OUTPUT_INLINE_MAX_BYTES}), configure "
+                "AWS S3 to receive it",
+            }
+        # So do all outputs once the job returned too much as base64
+        if inline_budget and not inline_budget.reserve(size):
+            return {
+                **result,
+                "type": "error",
+                "data": f"{result['filename']} doesn't fit into the response, the "
+                f"outputs of the job have more than OUTPUT_INLINE_TOTAL_MAX_BYTES "
+                f"({OUTPUT_INLINE_TOTAL_MAX_BYTES}) bytes, configure AWS S3 to "
+                "receive them",
+            }
+        # base64 image
+        return {**result, "type": "base64", "data": base64_encode(path)}
+    except Exception as e:
+        return {
+            **result,
+            "type": "error",
+            "data": f"Error processing {local_path}: {str(e)}",
+        }
+    finally:
+        if reencoded_path:
+            os.remove(reencoded_path)
+
+
+def process_output_images(outputs, job_id, inline_budget=None):
+    """
+    This function takes the "outputs" from image generation and the job ID,
+    then determines the correct way to return every generated file, either as a
+    direct URL to an AWS S3 bucket or as a base64 encoded string, depending on
+    the environment configuration.
+
+    Args:
+        outputs (dict): A dictionary containing the outputs from image generation,
+                        typically includes node IDs and their respective output data.
+        job_id (str): The unique identifier for the job.
+        inline_budget (InlineBudget, optional): The bytes that the outputs of the
+                                                job can still take up as base64
+
+    Returns:
+        dict: A dictionary with the status ('success' or 'error'), the message and
+              the outputs. The outputs contain a list of files per node ID. The
+              message is the first file (URL or base64 string) to stay compatible
+              with clients that only expect one image. In case of error, the
+              message details the issue.
+
+    The function works as follows:
+    - It first determines the output path for the images from an environment variable,
+      defaulting to "/comfyui/output" if not set.
+    - It then collects all images, gifs and videos of all nodes from the outputs.
+    - The files are uploaded to AWS S3 (if BUCKET_ENDPOINT_URL is configured) or
+      encoded as base64 concurrently, using at most OUTPUT_MAX_WORKERS threads.
+    - Once the inlined files exceed OUTPUT_INLINE_TOTAL_MAX_BYTES, the others are
+      uploaded to AWS S3 or reported as errors without it.
+    - Files that don't exist in the output folder are reported under "errors".
+    """
+
+    # The path where ComfyUI stores the generated images
+    COMFY_OUTPUT_PATH = os.environ.get("COMFY_OUTPUT_PATH", "/comfyui/output")
+
+    print(f"runpod-worker-comfy - image generation is done")
+
+    output_files = collect_output_files(outputs or {}, COMFY_OUTPUT_PATH)
+    if not output_files:
+        return {
+            "status": "error",
+            "message": f"the workflow did not produce any output in {COMFY_OUTPUT_PATH}",
+        }
+
+    use_bucket = bool(os.environ.get("BUCKET_ENDPOINT_URL", False))
+    grouped_outputs, errors = deliver_output_files(
+        job_id, output_files, use_bucket, inline_budget
+    )
+
+    if not grouped_outputs:
+        print("runpod-worker-comfy - the image does not exist in the output folder")
+        return {"status": "error", "message": errors[0], "details": errors}
+
+    print(
+        f"runpod-worker-comfy - {len(output_files) - len(errors)} output(s) "
+        + ("uploaded to AWS S3" if use_bucket else "converted to base64")
+    )
+
+    return build_output_result(grouped_outputs, errors)
+
+
+def deliver_output_files(job_id, output_files, use_bucket, inline_budget=None):
+    """
+    Upload or encode output files concurrently, using at most OUTPUT_MAX_WORKERS threads.
+
+    Args:
+        job_id (str): The unique identifier for the job
+        output_files (list): The files as returned by collect_output_files
+        use_bucket (bool): Upload the files to AWS S3 instead of encoding them
+        inline_budget (InlineBudget, optional): The bytes that the outputs of the
+                                                job can still take up as base64
+
+    Returns:
+        tuple: (grouped_outputs, errors) with the delivered files grouped by
+               node ID and the error messages of the files that failed
+    """
+    if not output_files:
+        return {}, []
+
+    with ThreadPoolExecutor(
+        max_workers=max(1, min(OUTPUT_MAX_WORKERS, len(output_files)))
+    ) as executor:
+        delivered = list(
+            executor.map(
+                lambda output_file: deliver_output_file(
+                    job_id, output_file, use_bucket, inline_budget
+                ),
+                output_files,
+            )
+        )
+
+    grouped_outputs = {}
+    errors = []
+    for output_file, result in zip(output_files, delivered):
+        if result["type"] == "error":
+            errors.append(result["data"])
+            continue
+        grouped_outputs.setdefault(output_file["node_id"], []).append(
+            {**result, "kind": output_file["kind"]}
+        )
+    return grouped_outputs, errors
+
+
+def build_output_result(grouped_outputs, errors):
+    """
+    Build the result of a job from its delivered outputs.
+
+    Args:
+        grouped_outputs (dict): The delivered files, grouped by node ID
+        errors (list): The error messages of the files that failed
+
+    Returns:
+        dict: The status, the first file as message (for clients that only
+              expect one image), the outputs and the errors, if any
+    """
+    first_output = next(iter(grouped_outputs.values()))[0]
+    result = {
+        "status": "success",
+        "message": first_output["data"],
+        "outputs": grouped_outputs,
+    }
+    if errors:
+        result["errors"] = errors
+    return result
+
+
+def run_workflows(job_id, workflows, metrics=None, deadline=None):
+    """
+    Run workflows in ComfyUI and yield the result of each one as soon as it is done.
+
+    All workflows are queued up front, so that ComfyUI's queue stays full and
+    it can start the next workflow as soon as one is finished. The outputs of a
+    finished workflow are processed while the others are still running.
+
+    Args:
+        job_id (str): The unique identifier for the job
+        workflows (list): The workflows to run
+        metrics (JobMetrics, optional): Records the timings of the job
+        deadline (float, optional): The time.monotonic() at which the job times out
+
+    Yields:
+        tuple: (index, result) for every workflow, with either the result of
+               process_output_images or an "error"
+    """
+    metrics = metrics or JobMetrics(job_id)
+    prompt_indexes = {}
+    finished = set()
+    # All workflows of the job end up in the same response
+    inline_budget = output_transport.InlineBudget(OUTPUT_INLINE_TOTAL_MAX_BYTES)
+
+    def process_outputs(outputs):
+        with metrics.phase("outputs"):
+            try:
+                return process_output_images(outputs, job_id, inline_budget)
+            finally:
+                clean_up_outputs(outputs)
+
+    def outputs_result(future):
+        # A failed workflow must still get a result, it is finished already
+        try:
+            return future.result()
+        except Exception as e:
+            return {"error": f"Error processing the outputs: {str(e)}"}
+
+    # Listen to the execution events before queuing, so that we don't miss any
+    client_id = str(uuid.uuid4())
+    ws = open_websocket(client_id)
+
+    try:
+        # Queue the workflows
+        for index, workflow in enumerate(workflows):
+            try:
+                with metrics.phase("queue"):
+                    queued_workflow = queue_workflow(
+                        workflow_to_queue(workflow), client_id
+                    )
+                prompt_id = queued_workflow["prompt_id"]
+                metrics.prompt_queued(prompt_id, workflow)
+                prompt_indexes[prompt_id] = index
+                print(f"runpod-worker-comfy - queued workflow with ID {prompt_id}")
+            except requests.ConnectionError:
+                yield index, {"error": COMFY_UNAVAILABLE_ERROR}
+            except Exception as e:
+                yield index, {"error": f"Error queuing workflow: {str(e)}"}
+
+        # Wait for completion
+        print(f"runpod-worker-comfy - wait until image generation is complete")
+        with ThreadPoolExecutor(max_workers=BATCH_PROCESSING_MAX_WORKERS) as executor:
+            futures = {}
+            try:
+                for prompt_id, history, error_message in wait_for_completions(
+                    ws, list(prompt_indexes), metrics, deadline
+                ):
+                    metrics.prompt_done(prompt_id)
+                    index = prompt_indexes[prompt_id]
+                    finished.add(index)
+                    if error_message:
+                        yield index, {"error": error_message}
+                        continue
+                    # Get the generated images and return them as URL in an AWS bucket or as base64
+                    future = executor.submit(
+                        process_outputs, history[prompt_id].get("outputs")
+                    )
+                    futures[future] = index
+
+                    # Hand out the outputs that are done while the others are still running
+                    for future in [future for future in futures if future.done()]:
+                        yield futures.pop(future), outputs_result(future)
+            except requests.ConnectionError:
+                wait_error = COMFY_UNAVAILABLE_ERROR
+            except Exception as e:
+                wait_error = f"Error waiting for image generation: {str(e)}"
+            else:
+                wait_error = None
+
+            for future in as_completed(futures):
+                yield futures[future], outputs_result(future)
+    finally:
+        if ws is not None:
+            ws.close()
+
+    # Workflows that were still running when waiting failed
+    for index in prompt_indexes.values():
+        if index not in finished:
+            yield index, {"error": wait_error}
+
+
+def execute_workflows(job_id, workflows, metrics=None, deadline=None):
+    """
+    Run workflows in ComfyUI and return the result of each one.
+
+    Args:
+        job_id (str): The unique identifier for the job
+        workflows (list): The workflows to run
+        metrics (JobMetrics, optional): Records the timings of the job
+        deadline (float, optional): The time.monotonic() at which the job times out
+
+    Returns:
+        list: One dict per workflow, in the same order, with either the result
+              of process_output_images or an "error"
+    """
+    results = [None] * len(workflows)
+    for index, result in run_workflows(job_id, workflows, metrics, deadline):
+        results[index] = result
+    return results
+
+
+def decode_preview(message):
+    """
+    Decode a binary preview message of ComfyUI.
+
+    The message starts with the event type and the image format as 32-bit
+    big-endian integers, followed by the image itself.
+
+    Args:
+        message (bytes): The binary message
+
+    Returns:
+        dict: The "format" and the base64 encoded "image" or None if the message is not a preview
+    """
+    if len(message) < 8:
+        return None
+    event_type, image_format = struct.unpack(">II", message[:8])
+    if event_type != COMFY_PREVIEW_EVENT or image_format not in COMFY_PREVIEW_FORMATS:
+        return None
+    return {
+        "format": COMFY_PREVIEW_FORMATS[image_format],
+        "image": base64.b64encode(message[8:]).decode("utf-8"),
+    }
+
+
+def stream_workflow(job_id, workflow, previews=False, metrics=None, deadline=None):
+    """
+    Run a single workflow in ComfyUI and yield its progress while it runs.
+
+    The files of an output node are delivered as soon as ComfyUI reports that
+    the node was executed, instead of waiting for the whole workflow. Outputs
+    without an "executed" event (e.g. cached nodes or after the WebSocket was
+    lost) are delivered from the history once the workflow is done.
+
+    Args:
+        job_id (str): The unique identifier for the job
+        workflow (dict): The workflow to run
+        previews (bool): Also yield the previews of the sampler
+        metrics (JobMetrics, optional): Records the timings of the job
+        deadline (float, optional): The time.monotonic() at which the job times out
+
+    Yields:
+        dict: The "queued", "progress", "preview" and "output" events
+
+    Returns:
+        dict: The result of the workflow like process_output_images or an "error"
+    """
+    COMFY_OUTPUT_PATH = os.environ.get("COMFY_OUTPUT_PATH", "/comfyui/output")
+    use_bucket = bool(os.environ.get("BUCKET_ENDPOINT_URL", False))
+    metrics = metrics or JobMetrics(job_id)
+    # Node IDs whose outputs were delivered (or failed) already
+    handled_nodes = set()
+    delivered_outputs = {}
+    errors = []
+    inline_budget = output_transport.InlineBudget(OUTPUT_INLINE_TOTAL_MAX_BYTES)
+
+    def deliver(outputs):
+        handled_nodes.update(outputs)
+        with metrics.phase("outputs"):
+            output_files = collect_output_files(outputs, COMFY_OUTPUT_PATH)
+            grouped_outputs, delivery_errors = deliver_output_files(
+                job_id, output_files, use_bucket, inline_budget
+            )
+            clean_up_outputs(outputs)
+        delivered_outputs.update(grouped_outputs)
+        errors.extend(delivery_errors)
+        return [
+            {"type": "output", "node_id": node_id, "files": files}
+            for node_id, files in grouped_outputs.items()
+        ]
+
+    # Listen to the execution events before queuing, so that we don't miss any
+    client_id = str(uuid.uuid4())
+    ws = open_websocket(client_id)
+
+    try:
+        try:
+            with metrics.phase("queue"):
+                prompt_id = queue_workflow(workflow_to_queue(workflow), client_id)[
+                    "prompt_id"
+                ]
+        except requests.ConnectionError:
+            return {"error": COMFY_UNAVAILABLE_ERROR}
+        except Exception as e:
+            return {"error": f"Error queuing workflow: {str(e)}"}
+
+        metrics.prompt_queued(prompt_id, workflow)
+        watch = watch_prompts([prompt_id], deadline)
+
+        print(f"runpod-worker-comfy - queued workflow with ID {prompt_id}")
+        yield {"type": "queued", "prompt_id": prompt_id}
+
+        try:
+            history = None
+            last_preview = None
+            try:
+                for event in (
+                    receive_websocket_messages(ws, watch.deadline) if ws else ()
+                ):
+                    if event is None:
+                        # Check the history in case a message got lost
+                        silent_history = get_history(prompt_id)
+                        if is_prompt_finished(silent_history, prompt_id):
+                            history = silent_history
+                            break
+                    elif not isinstance(event, dict):
+                        # Binary messages contain the previews of the sampler
+                        watch.observe_event(event)
+                        now = time.monotonic()
+                        if previews and (
+                            last_preview is None
+                            or now - last_preview >= STREAM_PREVIEW_INTERVAL_MS / 1000
+                        ):
+                            preview = decode_preview(event)
+                            if preview:
+                                last_preview = now
+                                yield {"type": "preview", **preview}
+                    # Older versions of ComfyUI don't send the prompt ID with every event
+                    elif event.get("data", {}).get("prompt_id", prompt_id) == prompt_id:
+                        data = event.get("data", {})
+                        watch.observe_event(event, prompt_id)
+                        metrics.observe_event(event)
+
+                        if event["type"] == "progress":
+                            yield {
+                                "type": "progress",
+                                "node": data.get("node"),
+                                "value": data.get("value"),
+                                "max": data.get("max"),
+                            }
+                        elif (
+                            event["type"] == "executed" and data.get("node") is not None
+                        ):
+                            node_id = str(data["node"])
+                            yield from deliver({node_id: data.get("output") or {}})
+                        elif event["type"] == "executing" and data.get("node") is None:
+                            history = get_history(prompt_id)
+                            break
+                        elif event["type"] in (
+                            "execution_error",
+                            "execution_interrupted",
+                        ):
+                            return {"error": execution_error_message(event)}
+
+                    error_message = watch.error_message()
+                    if error_message:
+                        cancel_prompts([prompt_id])
+                        return {"error": error_message}
+            except (websocket.WebSocketException, OSError) as e:
+                print(f"runpod-worker-comfy - websocket connection lost: {e}")
+
+            if history is None or prompt_id not in history:
+                for _, history, error_message in poll_for_completions(
+                    [prompt_id], watch
+                ):
+                    if error_message:
+                        return {"error": error_message}
+
+            metrics.prompt_done(prompt_id)
+            outputs = history[prompt_id].get("outputs") or {}
+            yield from deliver(
+                {
+                    node_id: output
+                    for node_id, output in outputs.items()
+                    if node_id not in handled_nodes
+                }
+            )
+        except requests.ConnectionError:
+            return {"error": COMFY_UNAVAILABLE_ERROR}
+        except Exception as e:
+            return {"error": f"Error waiting for image generation: {str(e)}"}
+    finally:
+        if ws is not None:
+            ws.close()
+
+    print(f"runpod-worker-comfy - image generation is done")
+
+    if not delivered_outputs:
+        if errors:
+            return {"status": "error", "message": errors[0], "details": errors}
+        return {
+            "status": "error",
+            "message": f"the workflow did not produce any output in {COMFY_OUTPUT_PATH}",
+        }
+    return build_output_result(delivered_outputs, errors)
+
+
+def prepare_job(job, metrics):
+    """
+    Validate a job, look up its cached results and get ComfyUI ready for the others.
+
+    Workflows that don't match the node schema of ComfyUI are rejected here, a
+    single workflow as error response and the workflows of a batch as error
+    result, so they never reach the queue of ComfyUI.
+
+    Args:
+        job (dict): A dictionary containing job details and input parameters.
+        metrics (JobMetrics): Records the timings of the job
+
+    Returns:
+        tuple: (prepared_job, error_response). The prepared job contains the
+               workflows, their cache keys, the results of the cached and invalid
+               workflows (None for the others), the indexes of the workflows that still
+               have to run, the uploaded images, whether previews were
+               requested and the deadline of the job. The names of the images stay reserved until
+               release_input_names is called.
     """
     job_input = job["input"]
+    # Files newer than the oldest running job are never evicted
+    file_cleanup.job_started(job["id"])
 
     # Make sure that the input is valid
-    validated_data, error_message = validate_input(job_input)
+    with metrics.phase("validate"):
+        validated_data, error_message = validate_input(job_input, metrics)
     if error_message:
-        return {"error": error_message}
+        return None, {"error": error_message}
+    metrics.requested = validated_data.get("metrics", False)
+    # The deadline counts from the start of the job, not from queuing the workflows
+    deadline = metrics.started_at + validated_data.get("timeout", JOB_TIMEOUT_S)
 
     # Extract validated data
-    workflow = validated_data["workflow"]
+    is_batch = "workflows" in validated_data
+    workflows = (
+        validated_data["workflows"] if is_batch else [validated_data["workflow"]]
+    )
     images = validated_data.get("images")
+    template = validated_data.get("template")
 
-    # Make sure that the ComfyUI API is available
-    check_server(
-        f"http://{COMFY_HOST}",
-        COMFY_API_AVAILABLE_MAX_RETRIES,
-        COMFY_API_AVAILABLE_INTERVAL_MS,
+    # Download the images that are given by their URL, before their hash is needed
+    if any("url" in image for image in images or []):
+        with metrics.phase("download"):
+            images, error_message = download_images(images, metrics)
+        if error_message:
+            return None, {"error": error_message}
+    downloaded_images = images
+
+    try:
+        results = [None] * len(workflows)
+
+        # Return the stored result of identical workflows without touching ComfyUI
+        cache_keys = [None] * len(workflows)
+        if result_cache.enabled and validated_data.get("cache", True):
+            with metrics.phase("result_cache"):
+                for index, workflow in enumerate(workflows):
+                    if template is not None:
+                        # Cheaper than hashing the workflow and the same for the same params
+                        workflow = {
+                            "template": template.name,
+                            "sha256": template.sha256,
+                            "params": validated_data["params"],
+                        }
+                    cache_keys[index] = ResultCache.key(workflow, images)
+                    cached_result = result_cache.get_result(cache_keys[index])
+                    if cached_result is not None:
+                        print(
+                            f"runpod-worker-comfy - returning the cached result {cache_keys[index]}"
+                        )
+                        results[index] = {**cached_result, "cached": True}
+            print(
+                f"runpod-worker-comfy - result cache {json.dumps(result_cache.stats())}"
+            )
+
+        pending = [index for index, result in enumerate(results) if result is None]
+        if pending:
+            # Make sure that the ComfyUI API is available
+            with metrics.phase("comfy_check"):
+                comfy_available = ensure_comfy_available()
+            if not comfy_available:
+                return None, {"error": COMFY_UNAVAILABLE_ERROR}
+
+            # Reject invalid workflows before they are queued
+            with metrics.phase("schema"):
+                error_messages = validate_workflows(
+                    [workflows[index] for index in pending], images, template
+                )
+            for index, error_message in zip(pending, error_messages):
+                if error_message:
+                    results[index] = {"error": error_message}
+            if not is_batch and results[0] is not None:
+                return None, results[0]
+            pending = [index for index in pending if results[index] is None]
+
+        if pending:
+            # Make room for the models of the job, if the models of earlier jobs are in the way
+            with metrics.phase("models"):
+                prepare_models(
+                    job["id"], [workflows[index] for index in pending], metrics
+                )
+
+        if not pending:
+            images = None
+        else:
+            # Upload images if they exist
+            with metrics.phase("input_names"):
+                acquired = acquire_input_names(
+                    images, max(0, deadline - time.monotonic())
+                )
+            if not acquired:
+                return None, {
+                    "error": "Timed out waiting for other jobs that use input images "
+                    "with the same name but a different content"
+                }
+            try:
+                try:
+                    with metrics.phase("upload"):
+                        upload_result = upload_images(images)
+                except requests.ConnectionError:
+                    upload_result = {"error": COMFY_UNAVAILABLE_ERROR}
+
+                if images and input_cache.enabled:
+                    print(
+                        f"runpod-worker-comfy - input cache {json.dumps(input_cache.stats())}"
+                    )
+            except BaseException:
+                # The caller only releases the names of a prepared job
+                release_input_names(images)
+                raise
+
+            if upload_result.get("status") != "success":
+                release_input_names(images)
+                return None, upload_result
+
+        return {
+            "is_batch": is_batch,
+            "workflows": workflows,
+            "images": images,
+            "cache_keys": cache_keys,
+            "results": results,
+            "pending": pending,
+            "previews": validated_data.get("previews", False),
+            "deadline": deadline,
+        }, None
+    finally:
+        # The decoded and downloaded images are uploaded (or not needed) by now
+        close_images(downloaded_images)
+
+
+def finish_job(metrics, response):
+    """
+    Stop the clock of a job and report its timings.
+
+    The timings are logged as JSON (METRICS_LOG), added to the Prometheus text
+    file (METRICS_PROMETHEUS_PATH) and to the response when "metrics" is true
+    in the input of the job.
+
+    Args:
+        metrics (JobMetrics): The timings of the job
+        response (dict): The response (or last streamed event) of the job
+
+    Returns:
+        dict: The response, with the timings under "metrics" if they were requested
+    """
+    metrics.finish()
+    file_cleanup.job_finished(metrics.job_id)
+    model_residency.job_finished(metrics.job_id)
+    model_tier.job_finished(metrics.job_id)
+    timings = metrics.to_dict()
+    if "error" in response:
+        status = "error"
+    else:
+        status = response.get("status", "success")
+
+    if METRICS_LOG:
+        print(f"runpod-worker-comfy - metrics {json.dumps(timings)}")
+    if prometheus_metrics.enabled:
+        prometheus_metrics.observe(timings, status)
+        try:
+            prometheus_metrics.write()
+        except OSError as e:
+            print(f"runpod-worker-comfy - could not write the metrics: {e}")
+
+    if metrics.requested:
+        return {**response, "metrics": timings}
+    return response
+
+
+def cache_result(cache_key, result):
+    """
+    Store the result of a workflow in the result cache.
+
+    Only complete results are cached, so that a retry can fix a partial one.
+
+    Args:
+        cache_key (str): The key as returned by ResultCache.key or None if caching is off
+        result (dict): The result of the workflow
+    """
+    if cache_key and result.get("status") == "success" and not result.get("errors"):
+        result_cache.put_result(cache_key, result)
+
+
+def batch_status(results):
+    """
+    Args:
+        results (list): The results of the workflows of a batch
+
+    Returns:
+        str: "success" if all workflows succeeded, "error" if none did, "partial" otherwise
+    """
+    succeeded = sum(1 for result in results if result.get("status") == "success")
+    if succeeded == len(results):
+        return "success"
+    if succeeded == 0:
+        return "error"
+    return "partial"
+
+
+def handler(job):
+    """
+    The main function that handles a job of generating an image.
+
+    This function validates the input, sends a prompt to ComfyUI for processing,
+    waits for the result via the WebSocket events of ComfyUI (or by polling
+    as fallback), and retrieves generated images.
+
+    With "workflows" instead of "workflow" in the input, all workflows are run
+    as a batch and the result of each one is returned separately under "results".
+
+    Args:
+        job (dict): A dictionary containing job details and input parameters.
+
+    Returns:
+        dict: A dictionary containing either an error message or a success status with generated images.
+    """
+    metrics = JobMetrics(job["id"])
+    try:
+        return run_job(job, metrics)
+    except BaseException:
+        # Otherwise the job would stay registered as running, see finish_job
+        if metrics.finished_at is None:
+            finish_job(metrics, {"error": "The job failed with an exception"})
+        raise
+
+
+def run_job(job, metrics):
+    """
+    Run a job for handler.
+
+    Args:
+        job (dict): A dictionary containing job details and input parameters.
+        metrics (JobMetrics): Records the timings of the job
+
+    Returns:
+        dict: The response of the job, see handler
+    """
+    prepared_job, error_response = prepare_job(job, metrics)
+    if error_response:
+        return finish_job(metrics, error_response)
+
+    workflows = prepared_job["workflows"]
+    results = prepared_job["results"]
+    pending = prepared_job["pending"]
+    if pending:
+        try:
+            executed = execute_workflows(
+                job["id"],
+                [workflows[i] for i in pending],
+                metrics,
+                prepared_job["deadline"],
+            )
+        finally:
+            release_input_names(prepared_job["images"])
+        for index, result in zip(pending, executed):
+            results[index] = result
+            cache_result(prepared_job["cache_keys"][index], result)
+
+    if not prepared_job["is_batch"]:
+        if "error" in results[0]:
+            return finish_job(metrics, {"error": results[0]["error"]})
+        return finish_job(metrics, {**results[0], "refresh_worker": REFRESH_WORKER})
+
+    return finish_job(
+        metrics,
+        {
+            "status": batch_status(results),
+            "results": [
+                {"index": index, **result} for index, result in enumerate(results)
+            ],
+            "refresh_worker": REFRESH_WORKER,
+        },
     )
 
-    # Upload images if they exist
-    upload_result = upload_images(images)
 
-    if upload_result["status"] == "error":
-        return upload_result
+def handler_stream(job):
+    """
+    Handle a job like handler, but yield events while the workflows run.
+
+    A single workflow yields "queued", "progress", "preview" (only with
+    "previews" in the input) and "output" events, followed by a "result"
+    without the outputs that were already streamed. A batch yields a "result"
+    with the index of every workflow as soon as it is done, followed by "done"
+    with the status of the batch. Errors are yielded as an "error" event.
 
-    # Queue the workflow
+    Args:
+        job (dict): A dictionary containing job details and input parameters.
+
+    Yields:
+        dict: The events of the job
+    """
+    metrics = JobMetrics(job["id"])
     try:
-        queued_workflow = queue_workflow(workflow)
-        prompt_id = queued_workflow["prompt_id"]
-        print(f"runpod-worker-comfy - queued workflow with ID {prompt_id}")
-    except Exception as e:
-        return {"error": f"Error queuing workflow: {str(e)}"}
+        yield from stream_job(job, metrics)
+    except BaseException:
+        # Also when the events are no longer consumed, see handler
+        if metrics.finished_at is None:
+            finish_job(
+                metrics, {"type": "error", "error": "The job failed with an exception"}
+            )
+        raise
 
-    # Poll for completion
-    print(f"runpod-worker-comfy - wait until image generation is complete")
-    retries = 0
+
+def stream_job(job, metrics):
+    """
+    Run a job for handler_stream.
+
+    Args:
+        job (dict): A dictionary containing job details and input parameters.
+        metrics (JobMetrics): Records the timings of the job
+
+    Yields:
+        dict: The events of the job, see handler_stream
+    """
+    prepared_job, error_response = prepare_job(job, metrics)
+    if error_response:
+        yield finish_job(metrics, {"type": "error", **error_response})
+        return
+
+    workflows = prepared_job["workflows"]
+    results = prepared_job["results"]
+    cache_keys = prepared_job["cache_keys"]
+
+    if not prepared_job["is_batch"]:
+        result = results[0]
+        if result is None:
+            try:
+                result = yield from stream_workflow(
+                    job["id"],
+                    workflows[0],
+                    prepared_job["previews"],
+                    metrics,
+                    prepared_job["deadline"],
+                )
+            finally:
+                release_input_names(prepared_job["images"])
+            cache_result(cache_keys[0], result)
+            if result.get("status") == "success":
+                result = {
+                    key: value
+                    for key, value in result.items()
+                    if key not in ("message", "outputs")
+                }
+        if "error" in result:
+            yield finish_job(metrics, {"type": "error", "error": result["error"]})
+        else:
+            yield finish_job(metrics, {"type": "result", **result})
+        return
+
+    for index, result in enumerate(results):
+        if result is not None:
+            yield {"type": "result", "index": index, **result}
+
+    pending = prepared_job["pending"]
+    if pending:
+        try:
+            for position, result in run_workflows(
+                job["id"],
+                [workflows[i] for i in pending],
+                metrics,
+                prepared_job["deadline"],
+            ):
+                index = pending[position]
+                results[index] = result
+                cache_result(cache_keys[index], result)
+                yield {"type": "result", "index": index, **result}
+        finally:
+            release_input_names(prepared_job["images"])
+
+    yield finish_job(
+        metrics,
+        {
+            "type": "done",
+            "status": batch_status(results),
+        },
+    )
+
+
+def load_warmup_workflow(path):
+    """
+    Load the warm-up workflow and make it as cheap as possible.
+
+    The file can either be a job like test_input.json or a workflow in the API
+    format. The samplers only run WARMUP_STEPS steps, as loading the models is
+    what matters, and SaveImage nodes are replaced by PreviewImage, so the
+    warm-up doesn't leave any files in the output folder.
+
+    Args:
+        path (str): The JSON file of the warm-up workflow
+
+    Returns:
+        tuple: (validated_data, error_message) like validate_input
+    """
     try:
-        while retries < COMFY_POLLING_MAX_RETRIES:
-            history = get_history(prompt_id)
+        with open(path) as f:
+            data = json.load(f)
+    except (OSError, ValueError) as e:
+        return None, f"Could not read the warm-up workflow {path}: {e}"
+
+    job_input = data.get("input", data) if isinstance(data, dict) else None
+    if isinstance(job_input, dict) and "workflow" not in job_input:
+        if "workflows" not in job_input and "template" not in job_input:
+            job_input = {"workflow": job_input}
+
+    validated_data, error_message = validate_input(job_input)
+    if error_message:
+        return None, error_message
+
+    workflows = validated_data.pop("workflows", None) or [validated_data["workflow"]]
+    warmup_workflows = []
+    for workflow in workflows:
+        warmup_workflow = {}
+        for node_id, node in workflow.items():
+            node = {**node, "inputs": dict(node.get("inputs", {}))}
+            if WARMUP_STEPS > 0 and isinstance(node["inputs"].get("steps"), int):
+                node["inputs"]["steps"] = min(node["inputs"]["steps"], WARMUP_STEPS)
+            if node.get("class_type") == "SaveImage":
+                node["class_type"] = "PreviewImage"
+            warmup_workflow[node_id] = node
+        warmup_workflows.append(warmup_workflow)
+    validated_data["workflows"] = warmup_workflows
+    validated_data.pop("workflow", None)
+    validated_data.pop("template", None)
+    return validated_data, None
+
+
+def warm_up(path):
+    """
+    Run the warm-up workflow before the worker accepts any job.
+
+    The duration is logged as JSON and written to the Prometheus text file,
+    separately from the timings of the jobs.
+
+    Args:
+        path (str): The JSON file of the warm-up workflow
 
-            # Exit the loop if we have found the history
-            if prompt_id in history and history[prompt_id].get("outputs"):
-                break
+    Returns:
+        tuple: (duration_s, error_message)
+    """
+    print(f"runpod-worker-comfy - warm-up with {path}")
+    started_at = time.monotonic()
+    validated_data, error_message = load_warmup_workflow(path)
+
+    if not error_message:
+        images, error_message = download_images(validated_data.get("images"))
+
+    if not error_message:
+        try:
+            try:
+                upload_result = upload_images(images)
+            finally:
+                close_images(images)
+            if upload_result["status"] == "error":
+                error_message = upload_result["message"]
             else:
-                # Wait before trying again
-                time.sleep(COMFY_POLLING_INTERVAL_MS / 1000)
-                retries += 1
+                client_id = str(uuid.uuid4())
+                ws = open_websocket(client_id)
+                # The models of the warm-up stay loaded for the first jobs
+                model_residency.job_started(
+                    "warm-up",
+                    sorted(
+                        {
+                            name
+                            for workflow in validated_data["workflows"]
+                            for name in workflow_models(workflow)
+                        }
+                    ),
+                )
+                try:
+                    prompt_ids = [
+                        queue_workflow(workflow, client_id)["prompt_id"]
+                        for workflow in validated_data["workflows"]
+                    ]
+                    for _, _, prompt_error in wait_for_completions(ws, prompt_ids):
+                        error_message = error_message or prompt_error
+                finally:
+                    model_residency.job_finished("warm-up")
+                    if ws is not None:
+                        ws.close()
+        except Exception as e:
+            error_message = f"Error running the warm-up workflow: {str(e)}"
+
+    duration = time.monotonic() - started_at
+    status = "error" if error_message else "success"
+    print(
+        "runpod-worker-comfy - warm-up "
+        + json.dumps(
+            {
+                "status": status,
+                "duration_ms": round(duration * 1000, 1),
+                "error": error_message,
+            }
+        )
+    )
+    if prometheus_metrics.enabled:
+        prometheus_metrics.set_warmup(duration, status)
+        try:
+            prometheus_metrics.write()
+        except OSError as e:
+            print(f"runpod-worker-comfy - could not write the metrics: {e}")
+    return duration, error_message
+
+
+def clean_up_files_periodically():
+    """
+    Remove the files whose retention window is over and evict the oldest
+    files while the disk is above DISK_HIGH_WATER_PERCENT, every CLEANUP_INTERVAL_S.
+    """
+    while True:
+        time.sleep(CLEANUP_INTERVAL_S)
+        try:
+            removed = file_cleanup.run_once()
+        except OSError as e:
+            print(f"runpod-worker-comfy - file cleanup failed: {e}")
+            continue
+        if removed:
+            print(
+                f"runpod-worker-comfy - removed {removed} files, "
+                f"file cleanup {json.dumps(file_cleanup.stats())}"
+            )
+
+
+def get_comfy_load():
+    """
+    Get the number of prompts that wait in the queue of ComfyUI and its free VRAM.
+
+    Returns:
+        tuple: (pending, vram_free). vram_free is in bytes for the first device
+               or None if ComfyUI doesn't report any device.
+    """
+    timeout = COMFY_LIVENESS_TIMEOUT_MS / 1000
+    queue = comfy_request("GET", "/queue", timeout=timeout).json()
+    stats = comfy_request("GET", COMFY_READINESS_PATH, timeout=timeout).json()
+    devices = stats.get("devices") or []
+    vram_free = devices[0].get("vram_free") if devices else None
+    return len(queue.get("queue_pending", [])), vram_free
+
+
+def adjust_concurrency():
+    """
+    Decide how many jobs the worker should run at the same time.
+
+    While a job waits for the GPU, the next one can already upload its images
+    and a finished one can deliver its outputs. More jobs only make sense as
+    long as ComfyUI's queue is short, so the worker keeps the jobs it has when
+    CONCURRENCY_MAX_QUEUE_PENDING prompts are waiting, and runs a single job
+    when the free VRAM is below CONCURRENCY_MIN_FREE_VRAM_MB or ComfyUI can't
+    be asked. The state of ComfyUI is checked at most every
+    CONCURRENCY_CHECK_INTERVAL_MS.
+
+    Returns:
+        int: The number of jobs to run at the same time
+    """
+    # A refreshed worker stops after a job, which would kill the other jobs
+    if MAX_CONCURRENCY <= 1 or REFRESH_WORKER:
+        return 1
+
+    now = time.monotonic()
+    with concurrency_lock:
+        checked_at = concurrency_state["checked_at"]
+        if (
+            checked_at is not None
+            and now - checked_at < CONCURRENCY_CHECK_INTERVAL_MS / 1000
+        ):
+            return concurrency_state["target"]
+        concurrency_state["checked_at"] = now
+
+    try:
+        pending, vram_free = get_comfy_load()
+    except (requests.RequestException, ValueError) as e:
+        print(f"runpod-worker-comfy - could not get the load of ComfyUI: {e}")
+        target = 1
+    else:
+        if vram_free is not None and vram_free < CONCURRENCY_MIN_FREE_VRAM_MB * 1024**2:
+            target = 1
+        elif pending >= CONCURRENCY_MAX_QUEUE_PENDING:
+            target = max(1, min(concurrency_state["running"], MAX_CONCURRENCY))
         else:
-            return {"error": "Max retries reached while waiting for image generation"}
-    except Exception as e:
-        return {"error": f"Error waiting for image generation: {str(e)}"}
+            target = MAX_CONCURRENCY
 
-    # Get the generated image and return it as URL in an AWS bucket or as base64
-    images_result = process_output_images(history[prompt_id].get("outputs"), job["id"])
+    with concurrency_lock:
+        if target != concurrency_state["target"]:
+            print(f"runpod-worker-comfy - concurrency set to {target}")
+        concurrency_state["target"] = target
+    return target
 
-    result = {**images_result, "refresh_worker": REFRESH_WORKER}
 
-    return result
+def concurrency_modifier(current_concurrency):
+    """
+    Concurrency modifier for runpod, which is asked how many jobs to run at the same time.
+
+    runpod only asks for new jobs while the worker runs fewer jobs than this,
+    but then asks for up to this many at once, so a busy endpoint can hand a
+    worker up to 2 * MAX_CONCURRENCY - 1 jobs. Jobs that don't fit wait in the
+    queue of ComfyUI.
+
+    Args:
+        current_concurrency (int): The current concurrency of the worker
+
+    Returns:
+        int: The new concurrency, see adjust_concurrency
+    """
+    return adjust_concurrency()
+
+
+async def async_handler(job):
+    """
+    Run handler in a thread, so that the worker can start the next job meanwhile.
+
+    Args:
+        job (dict): A dictionary containing job details and input parameters.
+
+    Returns:
+        dict: The result of handler
+    """
+    with concurrency_lock:
+        concurrency_state["running"] += 1
+    try:
+        return await asyncio.to_thread(handler, job)
+    finally:
+        with concurrency_lock:
+            concurrency_state["running"] -= 1
+
+
+async def async_handler_stream(job):
+    """
+    Run handler_stream in a thread, so that the worker can start the next job meanwhile.
+
+    Args:
+        job (dict): A dictionary containing job details and input parameters.
+
+    Yields:
+        dict: The events of handler_stream
+    """
+    with concurrency_lock:
+        concurrency_state["running"] += 1
+    try:
+        events = handler_stream(job)
+        while True:
+            event = await asyncio.to_thread(next, events, None)
+            if event is None:
+                return
+            yield event
+    finally:
+        with concurrency_lock:
+            concurrency_state["running"] -= 1
+
+
+def serverless_config():
+    """
+    The configuration for runpod.serverless.start.
+
+    A single job at a time (MAX_CONCURRENCY of 1 or REFRESH_WORKER) uses the
+    synchronous handler without a concurrency modifier, so runpod runs one job
+    after the other.
+
+    runpod ignores "refresh_worker" in the events of a streaming handler, so
+    with STREAM_OUTPUT the worker is refreshed through the configuration,
+    which stops it after every job, also after a failed one.
+
+    Returns:
+        dict: The configuration
+    """
+    if MAX_CONCURRENCY > 1 and not REFRESH_WORKER:
+        config = {
+            "handler": async_handler_stream if STREAM_OUTPUT else async_handler,
+            "concurrency_modifier": concurrency_modifier,
+        }
+    else:
+        config = {"handler": handler_stream if STREAM_OUTPUT else handler}
+    if STREAM_OUTPUT:
+        config["return_aggregate_stream"] = True
+        if REFRESH_WORKER:
+            config["refresh_worker"] = True
+    return config
 
 
 # Start the handler only if this script is run directly
 if __name__ == "__main__":
-    runpod.serverless.start({"handler": handler})
+    if OUTPUT_IMAGE_FORMAT and (
+        output_transport.Image is None
+        or OUTPUT_IMAGE_FORMAT not in output_transport.REENCODE_FORMATS
+    ):
+        print(
+            f"runpod-worker-comfy - can't re-encode output images as {OUTPUT_IMAGE_FORMAT}, "
+            "Pillow is missing or the format is not webp or jpeg"
+        )
+
+    print(
+        f"runpod-worker-comfy - workflow templates: {', '.join(workflow_templates.names()) or 'none'}"
+    )
+    for error in workflow_templates.errors:
+        print(f"runpod-worker-comfy - can't load the workflow template {error}")
+
+    # Copy the hot models to the local disk while ComfyUI starts
+    for name in model_tier.start(MODEL_CACHE_HOT_MODELS):
+        print(
+            f"runpod-worker-comfy - the hot model {name} is not in {MODEL_CACHE_SOURCE_PATH}"
+        )
+
+    # Wait for ComfyUI once, before the worker accepts any job
+    if not wait_for_comfy_ready():
+        print(
+            "runpod-worker-comfy - ComfyUI is not ready, the first job will wait for it"
+        )
+    else:
+        if WARMUP_WORKFLOW:
+            # Load the models before the first job, a failed warm-up doesn't stop the worker
+            warm_up(WARMUP_WORKFLOW)
+        if WORKFLOW_VALIDATION:
+            # Fetch the node schema now, so that the first job doesn't wait for it
+            try:
+                workflow_schema.load()
+                # Jobs with a valid template only validate their parameters
+                for name in workflow_templates.names():
+                    template = workflow_templates.get(name)
+                    template.validate(workflow_schema, template.workflow)
+                    if not template.valid:
+                        print(
+                            f"runpod-worker-comfy - template {name} doesn't match the node schema"
+                        )
+            except (requests.RequestException, ValueError) as e:
+                print(f"runpod-worker-comfy - can't fetch the node schema: {e}")
+
+    # Remove old files in the background, so that warm workers never fill their disk
+    if CLEANUP_RETENTION_S or DISK_HIGH_WATER_PERCENT:
+        threading.Thread(target=clean_up_files_periodically, daemon=True).start()
+
+    runpod.serverless.start(serverless_config())
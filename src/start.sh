@@ -4,6 +4,18 @@
 TCMALLOC="$(ldconfig -p | grep -Po "libtcmalloc.so.\d" | head -n 1)"
 export LD_PRELOAD="${TCMALLOC}"
 
+# Run a warm-up workflow (e.g. /test_input.json) before the first job, so that the models are loaded
+if [ -n "$WARMUP_WORKFLOW" ] && [ ! -f "$WARMUP_WORKFLOW" ]; then
+    echo "runpod-worker-comfy: Warm-up workflow $WARMUP_WORKFLOW not found, skipping the warm-up"
+    unset WARMUP_WORKFLOW
+fi
+
+# Copy the models of the network volume to the local disk, ComfyUI prefers the copies once they exist
+if [ -n "$MODEL_CACHE_PATH" ]; then
+    echo "runpod-worker-comfy: Using the model cache $MODEL_CACHE_PATH"
+    python3 /model_tier.py /comfyui/extra_model_paths.yaml
+fi
+
 # Serve the API and don't shutdown the container
 if [ "$SERVE_API_LOCALLY" == "true" ]; then
     echo "runpod-worker-comfy: Starting ComfyUI"
@@ -0,0 +1,187 @@
+import hashlib
+import json
+import os
+import tempfile
+import time
+from urllib.parse import parse_qsl, urlencode, urlparse, urlunparse
+
+from disk_cache import DiskCache
+
+# Query parameters of presigned AWS S3 URLs that change every time a URL is signed
+PRESIGNED_PARAMETERS = ("x-amz-", "signature", "expires", "awsaccesskeyid")
+# Size of the parts in which a download is read and written
+DOWNLOAD_CHUNK_BYTES = 1024 * 1024
+
+
+class UrlCache(DiskCache):
+    """
+    Input images that were downloaded from a URL, on the local disk of the worker.
+
+    Every download is stored by the SHA-256 of its URL, next to a small JSON
+    file with its ETag, Last-Modified and SHA-256. A cached download is
+    revalidated with If-None-Match (or If-Modified-Since), so a repeated URL
+    is only downloaded again when the image changed. The signature of
+    presigned AWS S3 URLs is not part of the key, as it changes every time the
+    URL is signed.
+
+    Downloads are streamed to disk, never held in memory. They are returned
+    as open files, which stay readable even when the download is evicted (or
+    never stored, when the cache is disabled) in the meantime. The temporary
+    files of interrupted downloads are removed when the cache is loaded.
+
+    Args:
+        path (str): The folder of the cache
+        max_bytes (int): The maximum size of all downloads, 0 disables the cache
+    """
+
+    @staticmethod
+    def key(url):
+        """
+        Args:
+            url (str): The URL of an image
+
+        Returns:
+            str: The SHA-256 of the URL without the signature of presigned URLs
+        """
+        parts = urlparse(url)
+        query = [
+            (name, value)
+            for name, value in parse_qsl(parts.query, keep_blank_values=True)
+            if not name.lower().startswith(PRESIGNED_PARAMETERS)
+        ]
+        normalized = urlunparse(parts._replace(query=urlencode(query), fragment=""))
+        return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+    def _meta_file(self, key):
+        return f"{self._file(key)}.json"
+
+    def _remove(self, key):
+        super()._remove(key)
+        try:
+            os.remove(self._meta_file(key))
+        except OSError:
+            pass
+
+    def _open_cached(self, key):
+        """
+        Returns:
+            tuple: (file, metadata) of the cached download or (None, None)
+        """
+        if not self.enabled:
+            return None, None
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or self._expired(entry[1]):
+                return None, None
+            self.entries.move_to_end(key)
+        try:
+            with open(self._meta_file(key)) as f:
+                metadata = json.load(f)
+            cached_file = open(self._file(key), "rb")
+            # The atime is the last use, so that the order survives a restart
+            os.utime(self._file(key), (time.time(), entry[1]))
+            return cached_file, metadata
+        except (OSError, ValueError):
+            with self.lock:
+                self._remove(key)
+            return None, None
+
+    def _store(self, key, temporary_file, size, metadata):
+        """Keep a finished download, the open file stays valid either way"""
+        if not self.enabled or size > self.max_bytes:
+            os.remove(temporary_file)
+            return
+        # The metadata comes first, a download without it is never used
+        # Ends with ".tmp" as well, so that it is removed on load after a crash
+        temporary_meta_file = f"{temporary_file[: -len('.tmp')]}.json.tmp"
+        with open(temporary_meta_file, "w") as f:
+            json.dump(metadata, f)
+        os.replace(temporary_meta_file, self._meta_file(key))
+        self.put_file(key, temporary_file)
+
+    def open(self, url, session, max_bytes, timeout_s):
+        """
+        Open an image by its URL, from the cache or downloaded.
+
+        Args:
+            url (str): The http(s) URL of the image
+            session (requests.Session): The session for the download
+            max_bytes (int): The maximum size of the image
+            timeout_s (float): The maximum time of the download
+
+        Returns:
+            tuple: (file, sha256, cached) with the image as an open binary file,
+                   its SHA-256 and whether the cached download was still valid
+
+        Raises:
+            requests.RequestException: When the request fails or times out
+            ValueError: When the image is bigger than max_bytes or the download took too long
+        """
+        key = self.key(url)
+        cached_file, metadata = self._open_cached(key)
+        headers = {}
+        if metadata:
+            if metadata.get("etag"):
+                headers["If-None-Match"] = metadata["etag"]
+            elif metadata.get("last_modified"):
+                headers["If-Modified-Since"] = metadata["last_modified"]
+
+        deadline = time.monotonic() + timeout_s
+        try:
+            response = session.get(
+                url,
+                headers=headers,
+                stream=True,
+                timeout=(min(10, timeout_s), timeout_s),
+            )
+        except BaseException:
+            if cached_file is not None:
+                cached_file.close()
+            raise
+        with response:
+            if cached_file is not None and response.status_code == 304:
+                with self.lock:
+                    self.hits += 1
+                return cached_file, metadata["sha256"], True
+            if cached_file is not None:
+                cached_file.close()
+            response.raise_for_status()
+
+            length = response.headers.get("Content-Length")
+            if length and length.isdigit() and int(length) > max_bytes:
+                raise ValueError(f"the image is bigger than {max_bytes} bytes")
+
+            os.makedirs(self.path, exist_ok=True)
+            descriptor, temporary_file = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+            f = os.fdopen(descriptor, "w+b")
+            try:
+                sha256 = hashlib.sha256()
+                size = 0
+                for chunk in response.iter_content(DOWNLOAD_CHUNK_BYTES):
+                    size += len(chunk)
+                    if size > max_bytes:
+                        raise ValueError(f"the image is bigger than {max_bytes} bytes")
+                    if time.monotonic() > deadline:
+                        raise ValueError(
+                            f"the download took longer than {timeout_s:g} seconds"
+                        )
+                    sha256.update(chunk)
+                    f.write(chunk)
+                f.flush()
+                metadata = {
+                    "url": url,
+                    "etag": response.headers.get("ETag"),
+                    "last_modified": response.headers.get("Last-Modified"),
+                    "sha256": sha256.hexdigest(),
+                }
+                self._store(key, temporary_file, size, metadata)
+            except BaseException:
+                f.close()
+                if os.path.exists(temporary_file):
+                    os.remove(temporary_file)
+                raise
+
+        with self.lock:
+            self.misses += 1
+        f.seek(0)
+        return f, metadata["sha256"], False
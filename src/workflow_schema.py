@@ -0,0 +1,256 @@
+import threading
+import time
+
+
+def _types(type_name):
+    """ComfyUI allows several types separated by commas, "*" matches any type"""
+    return {name.strip() for name in str(type_name).split(",")}
+
+
+def _types_match(expected, received):
+    expected, received = _types(expected), _types(received)
+    return "*" in expected or "*" in received or bool(expected & received)
+
+
+def is_link(value):
+    """A value that links to an output of another node: [node_id, output_index]"""
+    return (
+        isinstance(value, list)
+        and len(value) == 2
+        and isinstance(value[0], str)
+        and isinstance(value[1], int)
+    )
+
+
+class WorkflowSchema:
+    """
+    Validates workflows against the node schema of ComfyUI (/object_info).
+
+    The schema is fetched once and reused for every job. As ComfyUI lists the
+    models on disk in the schema, it is fetched again when a workflow uses an
+    unknown value or node, but at most every min_refresh_interval_s.
+
+    Args:
+        fetch (callable): Returns the parsed response of /object_info
+        min_refresh_interval_s (float): Minimum time between two fetches
+    """
+
+    def __init__(self, fetch, min_refresh_interval_s=5):
+        self.fetch = fetch
+        self.min_refresh_interval_s = min_refresh_interval_s
+        self.lock = threading.Lock()
+        self.nodes = None
+        self.fetched_at = None
+
+    @property
+    def available(self):
+        """False until a non-empty schema was fetched"""
+        return bool(self.nodes)
+
+    def _compile(self, object_info):
+        """Keep only what is needed to validate a workflow, per node class"""
+        nodes = {}
+        for class_type, info in object_info.items():
+            inputs = {}
+            required = set()
+            for section in ("required", "optional"):
+                for name, spec in (info.get("input") or {}).get(section, {}).items():
+                    inputs[name] = spec
+                    if section == "required":
+                        required.add(name)
+            nodes[class_type] = {
+                "inputs": inputs,
+                "required": required,
+                "outputs": list(info.get("output") or []),
+                "output_node": bool(info.get("output_node")),
+            }
+        return nodes
+
+    def load(self, refresh=False):
+        """
+        Fetch the schema, unless it is there already.
+
+        Args:
+            refresh (bool): Fetch it again if the last fetch is older than min_refresh_interval_s
+
+        Returns:
+            bool: True if the schema was fetched
+        """
+        with self.lock:
+            if self.nodes is not None:
+                if not refresh:
+                    return False
+                if time.monotonic() - self.fetched_at < self.min_refresh_interval_s:
+                    return False
+            nodes = self._compile(self.fetch())
+            self.nodes = nodes
+            self.fetched_at = time.monotonic()
+            return True
+
+    def validate(self, workflow, input_names=(), inputs=None):
+        """
+        Validate a workflow in the API format.
+
+        Args:
+            workflow (dict): The workflow
+            input_names (iterable): Names of the images that are uploaded with the job
+            inputs (list, optional): Only validate these (node_id, input name),
+                                     when the rest of the workflow is known to be valid
+
+        Returns:
+            list: The errors, empty if the workflow is valid
+        """
+        self.load()
+        if not self.available:
+            return []
+        input_names = set(input_names)
+
+        def validate():
+            if inputs is None:
+                return self._validate(workflow, input_names)
+            return self._validate_inputs(workflow, input_names, inputs)
+
+        errors, schema_misses = validate()
+        # The schema may be outdated, e.g. a model was added to the network volume
+        if schema_misses and self.load(refresh=True):
+            errors, _ = validate()
+        return errors
+
+    def _validate_inputs(self, workflow, input_names, inputs):
+        errors = []
+        schema_misses = False
+        for node_id, name in inputs:
+            node = workflow[node_id]
+            schema = self.nodes.get(node["class_type"])
+            spec = schema["inputs"].get(name) if schema else None
+            if spec is None:
+                continue
+            error, miss = self._validate_input(
+                workflow, spec, node["inputs"][name], input_names
+            )
+            if error:
+                errors.append(
+                    f"Node {node_id} ({node['class_type']}): input '{name}' {error}"
+                )
+                schema_misses = schema_misses or miss
+        return errors, schema_misses
+
+    def _validate(self, workflow, input_names):
+        nodes = self.nodes
+        errors = []
+        schema_misses = False
+
+        if not isinstance(workflow, dict) or not workflow:
+            return ["The workflow must be a non-empty object of nodes"], False
+
+        has_output = False
+        for node_id, node in workflow.items():
+            if not isinstance(node, dict) or "class_type" not in node:
+                errors.append(f"Node {node_id}: missing 'class_type'")
+                continue
+
+            class_type = node["class_type"]
+            schema = nodes.get(class_type)
+            if schema is None:
+                errors.append(
+                    f"Node {node_id}: unknown node type '{class_type}', "
+                    "is the custom node installed?"
+                )
+                schema_misses = True
+                continue
+            has_output = has_output or schema["output_node"]
+
+            inputs = node.get("inputs") or {}
+            if not isinstance(inputs, dict):
+                errors.append(
+                    f"Node {node_id} ({class_type}): 'inputs' must be an object"
+                )
+                continue
+
+            for name in sorted(schema["required"] - set(inputs)):
+                errors.append(
+                    f"Node {node_id} ({class_type}): missing required input '{name}'"
+                )
+
+            for name, value in inputs.items():
+                spec = schema["inputs"].get(name)
+                # Unknown inputs are ignored by ComfyUI
+                if spec is None:
+                    continue
+                error, miss = self._validate_input(workflow, spec, value, input_names)
+                if error:
+                    errors.append(
+                        f"Node {node_id} ({class_type}): input '{name}' {error}"
+                    )
+                    schema_misses = schema_misses or miss
+
+        if not errors and not has_output:
+            errors.append("The workflow has no output node, e.g. SaveImage")
+        return errors, schema_misses
+
+    def _validate_input(self, workflow, spec, value, input_names):
+        """
+        Returns:
+            tuple: (error, schema_miss) where error is None if the value is valid
+        """
+        input_type = spec[0] if spec else None
+        options = spec[1] if len(spec) > 1 and isinstance(spec[1], dict) else {}
+        # Newer versions of ComfyUI describe enums as "COMBO" with the options
+        if input_type == "COMBO":
+            input_type = options.get("options", [])
+
+        if is_link(value):
+            source_id, output_index = value
+            source = workflow.get(source_id)
+            if not isinstance(source, dict):
+                return f"is linked to node {source_id}, which doesn't exist", False
+            source_schema = self.nodes.get(source.get("class_type"))
+            if source_schema is None:
+                # Reported for the source node itself
+                return None, False
+            outputs = source_schema["outputs"]
+            if not 0 <= output_index < len(outputs):
+                return (
+                    f"is linked to output {output_index} of node {source_id}, "
+                    f"which has {len(outputs)} outputs",
+                    False,
+                )
+            if isinstance(input_type, str) and not _types_match(
+                input_type, outputs[output_index]
+            ):
+                return (
+                    f"expects {input_type}, but node {source_id} returns "
+                    f"{outputs[output_index]}",
+                    False,
+                )
+            return None, False
+
+        if isinstance(input_type, list):
+            # Images can be uploaded by the job itself
+            if options.get("image_upload") or value in input_names:
+                return None, False
+            if value not in input_type:
+                return (
+                    f"has the value '{value}', which is not one of the "
+                    f"{len(input_type)} values that ComfyUI knows",
+                    True,
+                )
+            return None, False
+
+        if input_type in ("INT", "FLOAT"):
+            # ComfyUI converts the value the same way, e.g. "42" or "7.5"
+            try:
+                value = int(value) if input_type == "INT" else float(value)
+            except (TypeError, ValueError, OverflowError):
+                return f"must be a number, got '{value}'", False
+            if "min" in options and value < options["min"]:
+                return (
+                    f"is {value}, which is less than the minimum {options['min']}",
+                    False,
+                )
+            if "max" in options and value > options["max"]:
+                return (
+                    f"is {value}, which is more than the maximum {options['max']}",
+                    False,
+                )
+        return None, False
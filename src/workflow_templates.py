@@ -0,0 +1,237 @@
+import hashlib
+import json
+import os
+
+from workflow_schema import is_link
+
+
+def parse_pointer(pointer):
+    """
+    Args:
+        pointer (str): A JSON Pointer (RFC 6901), e.g. "/6/inputs/text"
+
+    Returns:
+        list: The keys of the pointer, e.g. ["6", "inputs", "text"]
+    """
+    if not isinstance(pointer, str) or not pointer.startswith("/"):
+        raise ValueError(f"'{pointer}' is not a JSON Pointer like '/6/inputs/text'")
+    return [
+        part.replace("~1", "/").replace("~0", "~") for part in pointer[1:].split("/")
+    ]
+
+
+def _same_type(default, value):
+    """Numbers can replace numbers, everything else needs the type of the default"""
+    if isinstance(default, bool) or isinstance(value, bool):
+        return isinstance(default, bool) and isinstance(value, bool)
+    if isinstance(default, (int, float)):
+        return isinstance(value, (int, float))
+    return isinstance(value, type(default))
+
+
+class WorkflowTemplate:
+    """
+    A workflow that is stored on the worker, with parameters that jobs can set.
+
+    The parameters are declared as JSON Pointers into the workflow, e.g.
+    {"prompt": "/6/inputs/text", "seed": ["/3/inputs/seed", "/9/inputs/seed"]}.
+    The value in the workflow is the default of a parameter, and values of a
+    job must have the same type.
+
+    Args:
+        name (str): The name of the template
+        workflow (dict): The workflow in the API format
+        params (dict): Parameter name => JSON Pointer or list of JSON Pointers
+
+    Raises:
+        ValueError: When a pointer doesn't point to a value in the workflow
+    """
+
+    def __init__(self, name, workflow, params):
+        if not isinstance(workflow, dict) or not workflow:
+            raise ValueError("'workflow' must be a workflow in the API format")
+        if not isinstance(params, dict):
+            raise ValueError("'params' must be an object of JSON Pointers")
+        self.name = name
+        self.workflow = workflow
+        # name => list of paths, the keys of lists are ints
+        self.params = {}
+        self.defaults = {}
+        for param, pointers in params.items():
+            if isinstance(pointers, str):
+                pointers = [pointers]
+            if not isinstance(pointers, list) or not pointers:
+                raise ValueError(f"Parameter '{param}' must have a JSON Pointer")
+            self.params[param] = [self._resolve(param, p) for p in pointers]
+            self.defaults[param] = self._get(self.params[param][0])
+        # Identifies the content of the template, e.g. for the result cache
+        self.sha256 = hashlib.sha256(
+            json.dumps(
+                {"workflow": workflow, "params": params},
+                sort_keys=True,
+                separators=(",", ":"),
+            ).encode("utf-8")
+        ).hexdigest()
+        # The schema that the workflow was last validated with and the result
+        self.validated_with = None
+        self.valid = False
+
+    def _get(self, path):
+        value = self.workflow
+        for key in path:
+            value = value[key]
+        return value
+
+    def _resolve(self, param, pointer):
+        """Turn a pointer into the keys of the path, checking that the value exists"""
+        path = []
+        value = self.workflow
+        for key in parse_pointer(pointer):
+            if isinstance(value, list) and key.isdigit() and int(key) < len(value):
+                key = int(key)
+            elif not isinstance(value, dict) or key not in value:
+                raise ValueError(
+                    f"Parameter '{param}': {pointer} doesn't exist in the workflow"
+                )
+            path.append(key)
+            value = value[key]
+        if isinstance(value, (dict, list)) and not is_link(value):
+            raise ValueError(f"Parameter '{param}': {pointer} is not a value")
+        if len(path) < 2:
+            raise ValueError(f"Parameter '{param}': {pointer} must point into a node")
+        return path
+
+    @property
+    def inputs(self):
+        """
+        Returns:
+            list: The (node_id, input name) of every parameter
+        """
+        return sorted(
+            {
+                (path[0], path[2])
+                for paths in self.params.values()
+                for path in paths
+                if len(path) == 3 and path[1] == "inputs"
+            }
+        )
+
+    def render(self, params):
+        """
+        Build the workflow of a job.
+
+        The workflow of the template is never changed. Only the nodes (and
+        their inputs) that get a parameter are copied, all other nodes are
+        shared with the template.
+
+        Args:
+            params (dict): Parameter name => value
+
+        Returns:
+            tuple: (workflow, error_message)
+        """
+        if not isinstance(params, dict):
+            return None, "'params' must be an object"
+        unknown = sorted(set(params) - set(self.params))
+        if unknown:
+            return None, (
+                f"Template '{self.name}' has no parameter {', '.join(unknown)}, "
+                f"it has {', '.join(sorted(self.params)) or 'none'}"
+            )
+        for param, value in params.items():
+            default = self.defaults[param]
+            if not _same_type(default, value):
+                return None, (
+                    f"Parameter '{param}' of template '{self.name}' must be of "
+                    f"type {type(default).__name__}"
+                )
+
+        workflow = dict(self.workflow)
+        copied = {id(workflow)}
+        for param, value in params.items():
+            for path in self.params[param]:
+                container = workflow
+                for key in path[:-1]:
+                    child = container[key]
+                    if id(child) not in copied:
+                        child = dict(child) if isinstance(child, dict) else list(child)
+                        container[key] = child
+                        copied.add(id(child))
+                    container = child
+                container[path[-1]] = value
+        return workflow, None
+
+    def validate(self, schema, workflow, input_names=()):
+        """
+        Validate a workflow that was rendered from the template.
+
+        The workflow of the template is validated once per schema. As long as
+        it is valid, only the inputs that are set by parameters are validated
+        for each job.
+
+        Args:
+            schema (WorkflowSchema): The node schema of ComfyUI
+            workflow (dict): The rendered workflow, see render
+            input_names (iterable): Names of the images that are uploaded with the job
+
+        Returns:
+            list: The errors, empty if the workflow is valid
+        """
+        schema.load()
+        if self.validated_with is not schema.nodes:
+            self.valid = not schema.validate(self.workflow)
+            self.validated_with = schema.nodes
+        if not self.valid:
+            return schema.validate(workflow, input_names)
+        return schema.validate(workflow, input_names, inputs=self.inputs)
+
+
+class WorkflowTemplates:
+    """
+    The workflow templates of the worker, loaded once from JSON files.
+
+    Every file <name>.json in one of the folders is a template with the
+    "workflow" in the API format and its "params", see WorkflowTemplate. A
+    template in an earlier folder wins over one with the same name in a later
+    folder.
+
+    Args:
+        paths (list): The folders with the templates, missing folders are skipped
+    """
+
+    def __init__(self, paths):
+        self.paths = paths
+        self.templates = {}
+        # Error messages of the files that could not be loaded
+        self.errors = []
+        self._load()
+
+    def _load(self):
+        for path in self.paths:
+            if not os.path.isdir(path):
+                continue
+            for file_name in sorted(os.listdir(path)):
+                name, extension = os.path.splitext(file_name)
+                if extension != ".json" or name in self.templates:
+                    continue
+                file_path = os.path.join(path, file_name)
+                try:
+                    with open(file_path) as f:
+                        data = json.load(f)
+                    if not isinstance(data, dict):
+                        raise ValueError("the file must contain an object")
+                    self.templates[name] = WorkflowTemplate(
+                        name, data.get("workflow"), data.get("params", {})
+                    )
+                except (OSError, ValueError) as e:
+                    self.errors.append(f"{file_path}: {e}")
+
+    def get(self, name):
+        """
+        Returns:
+            WorkflowTemplate: The template or None if there is none with the name
+        """
+        return self.templates.get(name)
+
+    def names(self):
+        return sorted(self.templates)
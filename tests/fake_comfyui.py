@@ -0,0 +1,644 @@
+"""
+A tiny fake ComfyUI server that is used by the tests.
+
+It speaks just enough HTTP and WebSocket to stand in for ComfyUI: workflows
+can be queued via /prompt, the result can be fetched via /history and the
+execution events are sent to every client that is connected to /ws. Images
+can be uploaded via /upload/image and, when the folders are given, the output
+nodes write real PNG files like ComfyUI does, so it is also used to benchmark
+the handler (benchmarks/bench_load.py).
+"""
+
+import base64
+import hashlib
+import json
+import os
+import queue
+import socket
+import struct
+import threading
+import time
+import uuid
+import zlib
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# Magic string that is used for the WebSocket handshake (RFC 6455)
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+# Nodes that send a progress event and a preview for every step
+SAMPLER_NODES = ("KSampler", "KSamplerAdvanced", "SamplerCustomAdvanced")
+
+# Output nodes and the folder ("type") they write their images to
+OUTPUT_NODES = {"SaveImage": "output", "Image Save": "output", "PreviewImage": "temp"}
+
+# A small node schema in the format of /object_info, for the nodes the fake executes
+OBJECT_INFO = {
+    "CheckpointLoaderSimple": {
+        "input": {"required": {"ckpt_name": [["sd_xl_base_1.0.safetensors"]]}},
+        "output": ["MODEL", "CLIP", "VAE"],
+        "output_node": False,
+    },
+    "CLIPTextEncode": {
+        "input": {
+            "required": {"text": ["STRING", {"multiline": True}], "clip": ["CLIP"]}
+        },
+        "output": ["CONDITIONING"],
+        "output_node": False,
+    },
+    "EmptyLatentImage": {
+        "input": {
+            "required": {
+                "width": ["INT", {"default": 512, "min": 16, "max": 16384}],
+                "height": ["INT", {"default": 512, "min": 16, "max": 16384}],
+            }
+        },
+        "output": ["LATENT"],
+        "output_node": False,
+    },
+    "LoadImage": {
+        "input": {"required": {"image": [["example.png"], {"image_upload": True}]}},
+        "output": ["IMAGE", "MASK"],
+        "output_node": False,
+    },
+    "KSampler": {
+        "input": {
+            "required": {
+                "model": ["MODEL"],
+                "positive": ["CONDITIONING"],
+                "latent_image": ["LATENT"],
+                "steps": ["INT", {"default": 20, "min": 1, "max": 10000}],
+                "sampler_name": ["COMBO", {"options": ["euler", "dpmpp_2m"]}],
+            }
+        },
+        "output": ["LATENT"],
+        "output_node": False,
+    },
+    "VAEDecode": {
+        "input": {"required": {"samples": ["LATENT"], "vae": ["VAE"]}},
+        "output": ["IMAGE"],
+        "output_node": False,
+    },
+    "SaveImage": {
+        "input": {
+            "required": {
+                "images": ["IMAGE"],
+                "filename_prefix": ["STRING", {"default": "ComfyUI"}],
+            }
+        },
+        "output": [],
+        "output_node": True,
+    },
+}
+
+# A text-to-image workflow that is valid according to OBJECT_INFO
+WORKFLOW = {
+    "4": {
+        "inputs": {"ckpt_name": "sd_xl_base_1.0.safetensors"},
+        "class_type": "CheckpointLoaderSimple",
+    },
+    "5": {"inputs": {"width": 1024, "height": 1024}, "class_type": "EmptyLatentImage"},
+    "6": {
+        "inputs": {"text": "a cat", "clip": ["4", 1]},
+        "class_type": "CLIPTextEncode",
+    },
+    "3": {
+        "inputs": {
+            "model": ["4", 0],
+            "positive": ["6", 0],
+            "latent_image": ["5", 0],
+            "steps": 20,
+            "sampler_name": "euler",
+        },
+        "class_type": "KSampler",
+    },
+    "8": {"inputs": {"samples": ["3", 0], "vae": ["4", 2]}, "class_type": "VAEDecode"},
+    "9": {
+        "inputs": {"images": ["8", 0], "filename_prefix": "ComfyUI"},
+        "class_type": "SaveImage",
+    },
+}
+
+
+def png_image(width, height):
+    """
+    Build a valid RGB PNG with random pixels, which compresses about as badly as a photo.
+
+    Args:
+        width (int): The width in pixels
+        height (int): The height in pixels
+
+    Returns:
+        bytes: The encoded PNG
+    """
+
+    def chunk(kind, data):
+        return (
+            struct.pack("!I", len(data))
+            + kind
+            + data
+            + struct.pack("!I", zlib.crc32(kind + data))
+        )
+
+    # Every row starts with the filter type 0 (none)
+    rows = b"".join(b"\x00" + os.urandom(width * 3) for _ in range(height))
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", struct.pack("!IIBBBBB", width, height, 8, 2, 0, 0, 0))
+        + chunk(b"IDAT", zlib.compress(rows, 1))
+        + chunk(b"IEND", b"")
+    )
+
+
+def websocket_frame(payload, opcode=0x1):
+    """
+    Build a single unmasked WebSocket frame, as it is sent by a server.
+
+    Args:
+        payload (bytes): The payload of the frame
+        opcode (int): 0x1 for text, 0x2 for binary and 0x8 for close
+
+    Returns:
+        bytes: The encoded frame
+    """
+    header = bytes([0x80 | opcode])
+    length = len(payload)
+    if length < 126:
+        header += bytes([length])
+    elif length < 65536:
+        header += bytes([126]) + struct.pack("!H", length)
+    else:
+        header += bytes([127]) + struct.pack("!Q", length)
+    return header + payload
+
+
+class FakeComfyUIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        with self.server.fake.lock:
+            self.server.fake.connections += 1
+            self.server.fake.sockets.append(self.connection)
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, data, status=200):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return self.rfile.read(length) if length else b""
+
+    def do_GET(self):
+        fake = self.server.fake
+        url = urlparse(self.path)
+        fake.record(self.command, url.path)
+
+        if url.path == "/ws":
+            return self._handle_websocket(parse_qs(url.query).get("clientId", [""])[0])
+
+        if url.path.startswith("/history/"):
+            prompt_id = url.path[len("/history/") :]
+            with fake.lock:
+                entry = fake.history.get(prompt_id)
+            return self._send_json({prompt_id: entry} if entry else {})
+
+        if url.path == "/queue":
+            with fake.lock:
+                running = [[0, fake.running, {}, {}, []]] if fake.running else []
+                pending = [
+                    [number, prompt_id, {}, {}, []]
+                    for number, prompt_id in enumerate(fake.pending, start=1)
+                ]
+            return self._send_json({"queue_running": running, "queue_pending": pending})
+
+        if url.path == "/object_info":
+            with fake.lock:
+                return self._send_json(fake.object_info or {})
+
+        if url.path == "/system_stats":
+            return self._send_json(
+                {
+                    "system": {"os": "posix"},
+                    "devices": [
+                        {
+                            "name": "cuda:0 fake",
+                            "type": "cuda",
+                            "vram_total": 24 * 1024**3,
+                            "vram_free": fake.vram_free,
+                        }
+                    ],
+                }
+            )
+
+        return self._send_json({})
+
+    def do_POST(self):
+        fake = self.server.fake
+        url = urlparse(self.path)
+        fake.record(self.command, url.path)
+        body = self._read_body()
+
+        if url.path == "/prompt":
+            data = json.loads(body)
+            prompt_id = str(uuid.uuid4())
+            fake.submit(prompt_id, data["prompt"], data.get("client_id"))
+            return self._send_json({"prompt_id": prompt_id, "number": 0})
+
+        if url.path == "/queue":
+            fake.delete(json.loads(body or b"{}").get("delete", []))
+            return self._send_json({})
+
+        if url.path == "/interrupt":
+            fake.interrupted.set()
+            return self._send_json({})
+
+        if url.path == "/upload/image":
+            return self._send_json(fake.upload(self.headers["Content-Type"], body))
+
+        return self._send_json({})
+
+    def _handle_websocket(self, client_id):
+        fake = self.server.fake
+        if fake.refuse_websocket:
+            return self._send_json({"error": "no websocket"}, status=404)
+
+        key = self.headers.get("Sec-WebSocket-Key", "")
+        accept = base64.b64encode(
+            hashlib.sha1((key + WEBSOCKET_GUID).encode("utf-8")).digest()
+        ).decode("utf-8")
+        self.send_response(101, "Switching Protocols")
+        self.send_header("Upgrade", "websocket")
+        self.send_header("Connection", "Upgrade")
+        self.send_header("Sec-WebSocket-Accept", accept)
+        self.end_headers()
+        self.wfile.flush()
+
+        messages = fake.connect_client(client_id)
+        threading.Thread(
+            target=self._read_websocket_frames, args=(messages,), daemon=True
+        ).start()
+        try:
+            self._send_websocket_message({"type": "status", "data": {"sid": client_id}})
+            while not fake.stopped.is_set():
+                try:
+                    message = messages.get(timeout=0.05)
+                except queue.Empty:
+                    continue
+                if message is None:
+                    # Simulate a dropped connection
+                    break
+                if message == "close":
+                    self.wfile.write(websocket_frame(b"", opcode=0x8))
+                    break
+                self._send_websocket_message(message)
+        except OSError:
+            pass
+        finally:
+            fake.disconnect_client(client_id, messages)
+            self.close_connection = True
+            # The reader thread still holds the socket, so close it explicitly
+            try:
+                self.connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def _read_websocket_frames(self, messages):
+        """Read the frames of the client and answer a close frame"""
+        try:
+            while True:
+                header = self.rfile.read(2)
+                if len(header) < 2:
+                    return
+                opcode = header[0] & 0x0F
+                length = header[1] & 0x7F
+                if length == 126:
+                    length = struct.unpack("!H", self.rfile.read(2))[0]
+                elif length == 127:
+                    length = struct.unpack("!Q", self.rfile.read(8))[0]
+                # Frames of a client are always masked
+                self.rfile.read(4 + length)
+                if opcode == 0x8:
+                    messages.put("close")
+                    return
+        except (OSError, ValueError):
+            return
+
+    def _send_websocket_message(self, message):
+        if isinstance(message, bytes):
+            self.wfile.write(websocket_frame(message, opcode=0x2))
+        else:
+            self.wfile.write(websocket_frame(json.dumps(message).encode("utf-8")))
+        self.wfile.flush()
+
+
+class FakeComfyUI:
+    """
+    Fake ComfyUI server running in a background thread.
+
+    Args:
+        render_time (float): Seconds it takes to "execute" a single node
+        refuse_websocket (bool): Reject every connection to /ws
+        drop_websocket (bool): Close the WebSocket as soon as execution starts
+        execution_error (bool): Report an execution_error instead of outputs.
+                                Nodes with the class_type "FakeError" always fail.
+                                Nodes with the class_type "FakeStall" run without
+                                any progress until they are interrupted.
+        vram_free (int): Free VRAM in bytes that is reported by /system_stats
+        object_info (dict): The node schema that is reported by /object_info,
+                            e.g. OBJECT_INFO. Without it, the schema is empty.
+        output_dir (str): The folder where SaveImage writes its images. Without
+                          it, no files are written and SaveImage reports the
+                          image "ComfyUI_<node ID>_.png".
+        temp_dir (str): The folder where PreviewImage writes its images
+        input_dir (str): The folder where uploaded images are stored
+        image_size (tuple): The (width, height) of the images that are written
+    """
+
+    def __init__(
+        self,
+        render_time=0.01,
+        refuse_websocket=False,
+        drop_websocket=False,
+        execution_error=False,
+        vram_free=16 * 1024**3,
+        object_info=None,
+        output_dir=None,
+        temp_dir=None,
+        input_dir=None,
+        image_size=(64, 64),
+    ):
+        self.render_time = render_time
+        self.refuse_websocket = refuse_websocket
+        self.drop_websocket = drop_websocket
+        self.execution_error = execution_error
+        self.vram_free = vram_free
+        self.object_info = object_info
+        self.folders = {"output": output_dir, "temp": temp_dir, "input": input_dir}
+        self.image_size = image_size
+        self.image = None
+        self.counter = 0
+        self.uploads = 0
+        # The prompt that is executed right now and the ones that wait for it
+        self.running = None
+        self.pending = []
+        # Prompts that were deleted from the queue before they started
+        self.deleted = set()
+        self.interrupted = threading.Event()
+        self.lock = threading.Lock()
+        self.history = {}
+        self.requests = []
+        self.connections = 0
+        self.sockets = []
+        self.clients = {}
+        self.stopped = threading.Event()
+        self.queue = queue.Queue()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), FakeComfyUIHandler)
+        self.server.daemon_threads = True
+        self.server.fake = self
+        self.thread = threading.Thread(
+            target=self.server.serve_forever,
+            kwargs={"poll_interval": 0.05},
+            daemon=True,
+        )
+
+    @property
+    def host(self):
+        """The "host:port" of the server, the same format as COMFY_HOST"""
+        return "%s:%d" % self.server.server_address
+
+    def start(self):
+        self.thread.start()
+        threading.Thread(target=self._worker, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.server.shutdown()
+        self.server.server_close()
+        # Like a crashed ComfyUI, also close the connections that are kept alive
+        with self.lock:
+            for connection in self.sockets:
+                try:
+                    connection.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def record(self, method, path):
+        with self.lock:
+            self.requests.append((method, path))
+
+    def count(self, method, prefix):
+        """Count the requests that were received for a method and path prefix"""
+        with self.lock:
+            return sum(
+                1 for m, p in self.requests if m == method and p.startswith(prefix)
+            )
+
+    def connect_client(self, client_id):
+        messages = queue.Queue()
+        with self.lock:
+            self.clients.setdefault(client_id, []).append(messages)
+        return messages
+
+    def disconnect_client(self, client_id, messages):
+        with self.lock:
+            if messages in self.clients.get(client_id, []):
+                self.clients[client_id].remove(messages)
+
+    def send(self, client_id, message):
+        with self.lock:
+            targets = list(self.clients.get(client_id, []))
+        for messages in targets:
+            messages.put(message)
+
+    def submit(self, prompt_id, workflow, client_id):
+        """Add a prompt to the queue, which is executed one prompt at a time like ComfyUI"""
+        with self.lock:
+            self.pending.append(prompt_id)
+        self.queue.put((prompt_id, workflow, client_id))
+
+    def delete(self, prompt_ids):
+        """Delete prompts from the queue, like POST /queue with "delete" """
+        with self.lock:
+            for prompt_id in prompt_ids:
+                if prompt_id in self.pending:
+                    self.pending.remove(prompt_id)
+                    self.deleted.add(prompt_id)
+
+    def upload(self, content_type, body):
+        """
+        Store an image that was uploaded as multipart/form-data, like /upload/image.
+
+        Returns:
+            dict: The name, subfolder and type of the stored image
+        """
+        message = BytesParser(policy=HTTP).parsebytes(
+            b"Content-Type: " + content_type.encode("latin-1") + b"\r\n\r\n" + body
+        )
+        fields = {
+            part.get_param("name", header="content-disposition"): part
+            for part in message.iter_parts()
+        }
+        image = fields["image"]
+        name = os.path.basename(image.get_filename())
+        with self.lock:
+            self.uploads += 1
+        if self.folders["input"]:
+            with open(os.path.join(self.folders["input"], name), "wb") as f:
+                f.write(image.get_payload(decode=True))
+        return {"name": name, "subfolder": "", "type": "input"}
+
+    def _write_image(self, node_id, node):
+        """
+        Returns:
+            dict: The image of an output node, as it is listed in the history
+        """
+        folder_type = OUTPUT_NODES[node["class_type"]]
+        folder = self.folders[folder_type]
+        if folder is None:
+            return {
+                "filename": f"ComfyUI_{node_id}_.png",
+                "subfolder": "",
+                "type": folder_type,
+            }
+
+        prefix = str(node.get("inputs", {}).get("filename_prefix", "ComfyUI"))
+        with self.lock:
+            self.counter += 1
+            filename = f"{prefix.replace('/', '_')}_{self.counter:05}_.png"
+            if self.image is None:
+                self.image = png_image(*self.image_size)
+        with open(os.path.join(folder, filename), "wb") as f:
+            f.write(self.image)
+        return {"filename": filename, "subfolder": "", "type": folder_type}
+
+    def _worker(self):
+        while not self.stopped.is_set():
+            try:
+                item = self.queue.get(timeout=0.05)
+            except queue.Empty:
+                continue
+            with self.lock:
+                if item[0] in self.deleted:
+                    continue
+                self.pending.remove(item[0])
+                self.running = item[0]
+            self.interrupted.clear()
+            self._execute(*item)
+            with self.lock:
+                self.running = None
+
+    def _sample(self, prompt_id, node_id, node, client_id):
+        """Send a progress event and a PNG preview for every step of a sampler"""
+        steps = int(node.get("inputs", {}).get("steps", 1))
+        for step in range(1, steps + 1):
+            time.sleep(self.render_time / steps)
+            self.send(
+                client_id,
+                {
+                    "type": "progress",
+                    "data": {
+                        "value": step,
+                        "max": steps,
+                        "prompt_id": prompt_id,
+                        "node": node_id,
+                    },
+                },
+            )
+            self.send(
+                client_id, struct.pack(">II", 1, 2) + f"preview {step}".encode("utf-8")
+            )
+
+    def _execute(self, prompt_id, workflow, client_id):
+        self.send(
+            client_id, {"type": "execution_start", "data": {"prompt_id": prompt_id}}
+        )
+        self.send(
+            client_id,
+            {"type": "execution_cached", "data": {"nodes": [], "prompt_id": prompt_id}},
+        )
+        if self.drop_websocket:
+            self.send(client_id, None)
+
+        outputs = {}
+        status = {"status_str": "success", "completed": True, "messages": []}
+        for node_id, node in workflow.items():
+            self.send(
+                client_id,
+                {
+                    "type": "executing",
+                    "data": {"node": node_id, "prompt_id": prompt_id},
+                },
+            )
+            if node.get("class_type") in SAMPLER_NODES:
+                self._sample(prompt_id, node_id, node, client_id)
+            elif node.get("class_type") == "FakeStall":
+                while not (self.interrupted.is_set() or self.stopped.is_set()):
+                    self.interrupted.wait(0.01)
+            else:
+                time.sleep(self.render_time)
+
+            if self.interrupted.is_set():
+                status = {"status_str": "error", "completed": False, "messages": []}
+                self.send(
+                    client_id,
+                    {
+                        "type": "execution_interrupted",
+                        "data": {"prompt_id": prompt_id, "node_id": node_id},
+                    },
+                )
+                break
+
+            if self.execution_error or node.get("class_type") == "FakeError":
+                error = {
+                    "prompt_id": prompt_id,
+                    "node_id": node_id,
+                    "node_type": node.get("class_type"),
+                    "exception_message": "fake failure",
+                }
+                status = {"status_str": "error", "completed": False, "messages": []}
+                self.send(client_id, {"type": "execution_error", "data": error})
+                break
+
+            if node.get("class_type") in OUTPUT_NODES:
+                output = {"images": [self._write_image(node_id, node)]}
+                outputs[node_id] = output
+                self.send(
+                    client_id,
+                    {
+                        "type": "executed",
+                        "data": {
+                            "node": node_id,
+                            "output": output,
+                            "prompt_id": prompt_id,
+                        },
+                    },
+                )
+
+        with self.lock:
+            self.history[prompt_id] = {
+                "prompt": [0, prompt_id, workflow, {}, []],
+                "outputs": outputs,
+                "status": status,
+            }
+        self.send(
+            client_id,
+            {"type": "executing", "data": {"node": None, "prompt_id": prompt_id}},
+        )
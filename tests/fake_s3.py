@@ -0,0 +1,184 @@
+"""
+A tiny S3-compatible server that is used by the tests.
+
+It supports just enough of the S3 API for boto3 to upload files with
+put_object, upload_file and upload_fileobj, including multipart uploads, with
+path-style addressing. Signatures are not checked. Objects can be downloaded
+with GET, which answers If-None-Match with 304 Not Modified.
+"""
+
+import hashlib
+import threading
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+
+class FakeS3Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status=200, body=b"", headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self):
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            body = self._read_chunks()
+        else:
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+        # Newer versions of botocore send the body with a checksum trailer
+        if "aws-chunked" in self.headers.get("Content-Encoding", ""):
+            body = self._decode_aws_chunked(body)
+        return body
+
+    def _read_chunks(self):
+        body = b""
+        while True:
+            size = int(self.rfile.readline().split(b";")[0].strip(), 16)
+            if size == 0:
+                # Trailers until the empty line
+                while self.rfile.readline().strip():
+                    pass
+                return body
+            body += self.rfile.read(size)
+            self.rfile.readline()
+
+    def _decode_aws_chunked(self, body):
+        data = b""
+        while body:
+            header, _, body = body.partition(b"\r\n")
+            size = int(header.split(b";")[0], 16)
+            if size == 0:
+                return data
+            data += body[:size]
+            body = body[size + 2 :]
+        return data
+
+    def _key(self, url):
+        bucket, _, key = unquote(url.path).lstrip("/").partition("/")
+        return bucket, key
+
+    def do_PUT(self):
+        fake = self.server.fake
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        bucket, key = self._key(url)
+        body = self._read_body()
+
+        with fake.lock:
+            if "uploadId" in query:
+                upload = fake.uploads[query["uploadId"][0]]
+                upload["parts"][int(query["partNumber"][0])] = body
+                fake.part_sizes.append(len(body))
+            elif key:
+                fake.objects[(bucket, key)] = {
+                    "body": body,
+                    "content_type": self.headers.get("Content-Type"),
+                }
+                fake.put_sizes.append(len(body))
+        self._send(headers={"ETag": f'"{hashlib.md5(body).hexdigest()}"'})
+
+    def do_POST(self):
+        fake = self.server.fake
+        url = urlparse(self.path)
+        query = parse_qs(url.query, keep_blank_values=True)
+        bucket, key = self._key(url)
+        self._read_body()
+
+        with fake.lock:
+            if "uploads" in query:
+                upload_id = str(uuid.uuid4())
+                fake.uploads[upload_id] = {
+                    "parts": {},
+                    "content_type": self.headers.get("Content-Type"),
+                }
+                body = (
+                    "<InitiateMultipartUploadResult>"
+                    f"<Bucket>{bucket}</Bucket><Key>{key}</Key>"
+                    f"<UploadId>{upload_id}</UploadId>"
+                    "</InitiateMultipartUploadResult>"
+                )
+            else:
+                upload = fake.uploads.pop(query["uploadId"][0])
+                fake.objects[(bucket, key)] = {
+                    "body": b"".join(
+                        upload["parts"][number] for number in sorted(upload["parts"])
+                    ),
+                    "content_type": upload["content_type"],
+                }
+                body = (
+                    "<CompleteMultipartUploadResult>"
+                    f"<Bucket>{bucket}</Bucket><Key>{key}</Key>"
+                    '<ETag>"multipart"</ETag>'
+                    "</CompleteMultipartUploadResult>"
+                )
+        self._send(
+            body=body.encode("utf-8"), headers={"Content-Type": "application/xml"}
+        )
+
+    def do_GET(self):
+        fake = self.server.fake
+        with fake.lock:
+            entry = fake.objects.get(self._key(urlparse(self.path)))
+        if entry is None:
+            fake.gets.append(404)
+            return self._send(404)
+        etag = f'"{hashlib.md5(entry["body"]).hexdigest()}"'
+        if self.headers.get("If-None-Match") == etag:
+            fake.gets.append(304)
+            return self._send(304, headers={"ETag": etag})
+        fake.gets.append(200)
+        self._send(body=entry["body"], headers={"ETag": etag})
+
+
+class FakeS3:
+    """
+    Fake S3 server running in a background thread.
+
+    The uploaded objects are kept in memory under (bucket, key).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.objects = {}
+        self.uploads = {}
+        # Sizes of the bodies of single uploads and of the parts of multipart uploads
+        self.put_sizes = []
+        self.part_sizes = []
+        # Status codes of the downloads
+        self.gets = []
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), FakeS3Handler)
+        self.server.daemon_threads = True
+        self.server.fake = self
+        self.thread = threading.Thread(
+            target=self.server.serve_forever,
+            kwargs={"poll_interval": 0.05},
+            daemon=True,
+        )
+
+    @property
+    def endpoint_url(self):
+        return "http://%s:%d" % self.server.server_address
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
@@ -0,0 +1,87 @@
+import unittest
+import os
+import sys
+import tempfile
+import time
+from unittest.mock import patch
+
+# Make sure that "src" is known and can be used to import disk_cache.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+from src.disk_cache import DiskCache
+
+KEY_A = "a" * 64
+KEY_B = "b" * 64
+KEY_C = "c" * 64
+
+
+class TestDiskCache(unittest.TestCase):
+    def setUp(self):
+        self.temporary_directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temporary_directory.cleanup)
+        self.path = self.temporary_directory.name
+
+    def test_put_and_get(self):
+        cache = DiskCache(self.path, 1024)
+        cache.put(KEY_A, b"value")
+
+        self.assertEqual(cache.get(KEY_A), b"value")
+        self.assertIsNone(cache.get(KEY_B))
+        self.assertEqual(
+            cache.stats(),
+            {"hits": 1, "misses": 1, "evictions": 0, "entries": 1, "bytes": 5},
+        )
+
+    def test_evicts_least_recently_used_by_bytes(self):
+        cache = DiskCache(self.path, 10)
+        cache.put(KEY_A, b"aaaa")
+        cache.put(KEY_B, b"bbbb")
+        # Use the first value, so that the second one is the oldest
+        cache.get(KEY_A)
+        cache.put(KEY_C, b"cccc")
+
+        self.assertIsNotNone(cache.get(KEY_A))
+        self.assertIsNone(cache.get(KEY_B))
+        self.assertFalse(os.path.exists(os.path.join(self.path, KEY_B)))
+        self.assertEqual(cache.stats()["evictions"], 1)
+        self.assertEqual(cache.stats()["bytes"], 8)
+
+    def test_values_expire_after_ttl(self):
+        cache = DiskCache(self.path, 1024, ttl_s=60)
+        cache.put(KEY_A, b"value")
+
+        self.assertEqual(cache.get(KEY_A), b"value")
+        with patch("time.time", return_value=time.time() + 61):
+            self.assertIsNone(cache.get(KEY_A))
+        self.assertEqual(cache.stats()["entries"], 0)
+        self.assertFalse(os.path.exists(os.path.join(self.path, KEY_A)))
+
+    def test_values_bigger_than_the_cache_are_not_stored(self):
+        cache = DiskCache(self.path, 4)
+        cache.put(KEY_A, b"too big")
+
+        self.assertIsNone(cache.get(KEY_A))
+        self.assertEqual(os.listdir(self.path), [])
+
+    def test_disabled_cache(self):
+        cache = DiskCache(self.path, 0)
+        cache.put(KEY_A, b"value")
+
+        self.assertFalse(cache.enabled)
+        self.assertIsNone(cache.get(KEY_A))
+
+    def test_rejects_keys_that_are_not_hex_digests(self):
+        cache = DiskCache(self.path, 1024)
+
+        with self.assertRaises(ValueError):
+            cache.put("../outside", b"value")
+
+    def test_loads_existing_values_in_order_of_use(self):
+        cache = DiskCache(self.path, 1024)
+        cache.put(KEY_A, b"aaaa")
+        cache.put(KEY_B, b"bbbb")
+        os.utime(os.path.join(self.path, KEY_A), (time.time() + 10, time.time()))
+
+        cache = DiskCache(self.path, 4)
+
+        self.assertEqual(cache.get(KEY_A), b"aaaa")
+        self.assertIsNone(cache.get(KEY_B))
@@ -0,0 +1,132 @@
+import unittest
+import os
+import sys
+import tempfile
+import time
+from collections import namedtuple
+from unittest.mock import patch
+
+# Make sure that "src" is known and can be used to import file_cleanup.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+from src.file_cleanup import FileCleanup
+
+# Like the result of shutil.disk_usage
+DiskUsage = namedtuple("DiskUsage", "total used free")
+
+
+class TestFileCleanup(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def write(self, name, size=10, age_s=0):
+        path = os.path.join(self.folder.name, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(b"x" * size)
+        if age_s:
+            mtime = time.time() - age_s
+            os.utime(path, (mtime, mtime))
+        return path
+
+    def cleanup(self, retention_s=0, high_water_percent=90):
+        return FileCleanup([self.folder.name], retention_s, high_water_percent, 80)
+
+    def test_files_are_removed_after_delivery(self):
+        cleanup = self.cleanup()
+        delivered = self.write("ComfyUI_00001_.png")
+        protected = self.write("input.png")
+        cleanup.register([delivered, protected])
+        cleanup.protect([protected])
+
+        cleanup.remove([delivered, protected, "/missing/file.png"])
+
+        self.assertFalse(os.path.exists(delivered))
+        self.assertTrue(os.path.exists(protected))
+        self.assertEqual(cleanup.stats()["removed_files"], 1)
+
+        cleanup.unprotect([protected])
+        cleanup.remove([protected])
+        self.assertFalse(os.path.exists(protected))
+
+    def test_retention_window(self):
+        cleanup = self.cleanup(retention_s=0.05)
+        delivered = self.write("ComfyUI_00001_.png")
+        rewritten = self.write("input.png")
+        cleanup.register([delivered, rewritten])
+        cleanup.remove([delivered, rewritten])
+
+        self.assertEqual(cleanup.run_once(), 0)
+        self.assertTrue(os.path.exists(delivered))
+
+        # A later job uploaded the same name again
+        time.sleep(0.06)
+        self.write("input.png", size=20)
+        self.assertEqual(cleanup.run_once(), 1)
+        self.assertFalse(os.path.exists(delivered))
+        self.assertTrue(os.path.exists(rewritten))
+        self.assertEqual(cleanup.stats()["scheduled"], 0)
+
+    def test_eviction_above_the_high_water_mark(self):
+        cleanup = self.cleanup()
+        oldest = self.write("sub/oldest.png", size=100, age_s=300)
+        protected = self.write("protected.png", size=100, age_s=200)
+        older = self.write("older.png", size=100, age_s=100)
+        newest = self.write("newest.png", size=100, age_s=10)
+        cleanup.register([oldest, protected, older, newest])
+        cleanup.protect([protected])
+
+        # 95 % full, 80 % is reached after removing 150 bytes
+        usage = DiskUsage(1000, 950, 50)
+        with patch("shutil.disk_usage", return_value=usage):
+            self.assertEqual(cleanup.run_once(), 2)
+
+        self.assertFalse(os.path.exists(oldest))
+        self.assertTrue(os.path.exists(protected))
+        self.assertFalse(os.path.exists(older))
+        self.assertTrue(os.path.exists(newest))
+
+    def test_no_eviction_below_the_high_water_mark_or_for_running_jobs(self):
+        cleanup = self.cleanup()
+        old = self.write("old.png", age_s=100)
+        cleanup.register([old])
+
+        usage = DiskUsage(1000, 850, 150)
+        with patch("shutil.disk_usage", return_value=usage):
+            self.assertEqual(cleanup.evict(), 0)
+
+        # The job started before the file was written
+        cleanup.job_started("123")
+        cleanup.jobs["123"] -= 200
+        usage = DiskUsage(1000, 950, 50)
+        with patch("shutil.disk_usage", return_value=usage):
+            self.assertEqual(cleanup.evict(), 0)
+
+        cleanup.job_finished("123")
+        with patch("shutil.disk_usage", return_value=usage):
+            self.assertEqual(cleanup.evict(), 1)
+        self.assertFalse(os.path.exists(old))
+
+    def test_eviction_can_be_disabled(self):
+        cleanup = self.cleanup(high_water_percent=0)
+        self.write("old.png", age_s=100)
+        usage = DiskUsage(1000, 1000, 0)
+        with patch("shutil.disk_usage", return_value=usage):
+            self.assertEqual(cleanup.evict(), 0)
+
+    def test_files_that_the_worker_did_not_write_are_kept(self):
+        cleanup = self.cleanup()
+        asset = self.write("mask.png", size=100, age_s=300)
+        written = self.write("ComfyUI_00001_.png", size=100, age_s=200)
+        cleanup.register([written])
+
+        usage = DiskUsage(1000, 950, 50)
+        with patch("shutil.disk_usage", return_value=usage):
+            self.assertEqual(cleanup.evict(), 1)
+        cleanup.remove([asset])
+
+        self.assertTrue(os.path.exists(asset))
+        self.assertFalse(os.path.exists(written))
+        self.assertEqual(cleanup.written, set())
@@ -0,0 +1,55 @@
+import unittest
+import base64
+import binascii
+import hashlib
+import os
+import sys
+import tempfile
+import time
+
+# Make sure that "src" is known and can be used to import input_cache.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+from src.input_cache import InputCache
+
+
+class TestInputCache(unittest.TestCase):
+    def test_images_are_stored_by_sha256(self):
+        with tempfile.TemporaryDirectory() as path:
+            cache = InputCache(path, 1024)
+            sha256 = cache.add(b"image")
+
+            self.assertEqual(sha256, hashlib.sha256(b"image").hexdigest())
+            self.assertEqual(cache.get(sha256), b"image")
+            self.assertEqual(cache.get(sha256.upper()), b"image")
+            self.assertEqual(os.listdir(path), [sha256])
+
+    def test_base64_images_are_decoded_into_the_store(self):
+        with tempfile.TemporaryDirectory() as path:
+            cache = InputCache(path, 1024)
+            f, sha256 = cache.add_base64(base64.b64encode(b"image").decode())
+            with f:
+                self.assertEqual(f.read(), b"image")
+
+            self.assertEqual(sha256, hashlib.sha256(b"image").hexdigest())
+            self.assertEqual(cache.get(sha256), b"image")
+            self.assertEqual(os.listdir(path), [sha256])
+
+    def test_invalid_base64_images_leave_nothing_behind(self):
+        with tempfile.TemporaryDirectory() as path:
+            cache = InputCache(path, 1024)
+            with self.assertRaises(binascii.Error):
+                cache.add_base64("not base64!")
+
+            self.assertEqual(os.listdir(path), [])
+
+    def test_stale_temporary_files_are_removed_on_load(self):
+        with tempfile.TemporaryDirectory() as path:
+            # Left over from a crash in add_base64 and from a write in progress
+            stale = os.path.join(path, "crashed.tmp")
+            open(stale, "wb").close()
+            os.utime(stale, (time.time() - 7200, time.time() - 7200))
+            open(os.path.join(path, "writing.tmp"), "wb").close()
+
+            InputCache(path, 1024)
+
+            self.assertEqual(os.listdir(path), ["writing.tmp"])
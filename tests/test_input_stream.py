@@ -0,0 +1,91 @@
+import unittest
+import base64
+import email.parser
+import hashlib
+import io
+import os
+import sys
+import tempfile
+from unittest.mock import patch
+
+# Make sure that "src" is known and can be used to import input_stream.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+from src import input_stream
+from src.input_stream import MultipartFile, base64_size, decode_base64_to_file
+
+
+class TestDecodeBase64(unittest.TestCase):
+    def test_images_are_decoded_a_part_at_a_time(self):
+        image = os.urandom(1000)
+        f = io.BytesIO()
+        with patch.object(input_stream, "DECODE_CHUNK_CHARS", 16):
+            size, sha256 = decode_base64_to_file(
+                "data:image/png;base64," + base64.b64encode(image).decode(), f
+            )
+
+        self.assertEqual(f.getvalue(), image)
+        self.assertEqual(size, 1000)
+        self.assertEqual(sha256, hashlib.sha256(image).hexdigest())
+        self.assertGreaterEqual(base64_size(base64.b64encode(image).decode()), 1000)
+
+    def test_line_wrapped_images_are_decoded(self):
+        image = os.urandom(1000)
+        f = io.BytesIO()
+        with patch.object(input_stream, "DECODE_CHUNK_CHARS", 10):
+            size, _ = decode_base64_to_file(
+                base64.encodebytes(image).decode().replace("\n", "\r\n"), f
+            )
+
+        self.assertEqual(f.getvalue(), image)
+        self.assertEqual(size, 1000)
+
+    def test_invalid_data_is_rejected(self):
+        with self.assertRaises(ValueError):
+            decode_base64_to_file("not base64!", io.BytesIO())
+        with self.assertRaises(ValueError):
+            decode_base64_to_file("abcde", io.BytesIO())
+        with self.assertRaises(TypeError):
+            decode_base64_to_file(42, io.BytesIO())
+
+
+class TestMultipartFile(unittest.TestCase):
+    def parse(self, body):
+        data = body.read()
+        self.assertEqual(len(data), len(body))
+        message = email.parser.BytesParser().parsebytes(
+            f"Content-Type: {body.content_type}\r\n\r\n".encode() + data
+        )
+        return {
+            part.get_param("name", header="content-disposition"): part
+            for part in message.get_payload()
+        }
+
+    def test_file_and_fields_are_sent_from_the_disk(self):
+        with tempfile.TemporaryFile() as f:
+            f.write(b"image" * 1000)
+            f.seek(0)
+            body = MultipartFile(
+                "image", 'input "1".png', f, "image/png", {"overwrite": "true"}
+            )
+            parts = self.parse(body)
+
+        self.assertEqual(parts["overwrite"].get_payload(), "true")
+        self.assertEqual(parts["image"].get_filename(), "input %221%22.png")
+        self.assertEqual(parts["image"].get_content_type(), "image/png")
+        self.assertEqual(parts["image"].get_payload(decode=True), b"image" * 1000)
+
+    def test_body_can_be_rewound_for_retries(self):
+        with tempfile.TemporaryFile() as f:
+            f.write(b"image")
+            f.seek(0)
+            body = MultipartFile("image", "input.png", f, "image/png")
+            first = b"".join(iter(lambda: body.read(3), b""))
+            body.seek(0)
+            second = body.read()
+
+        self.assertEqual(first, second)
+        self.assertEqual(body.tell(), len(body))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,156 @@
+import unittest
+import os
+import sys
+import tempfile
+import time
+
+# Make sure that "src" is known and can be used to import job_metrics.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+from src.job_metrics import JobMetrics, PrometheusTextFile
+
+
+class TestJobMetrics(unittest.TestCase):
+    def test_phases_are_added_up(self):
+        metrics = JobMetrics("123")
+        with metrics.phase("outputs"):
+            time.sleep(0.01)
+        with metrics.phase("outputs"):
+            time.sleep(0.01)
+        metrics.finish()
+
+        timings = metrics.to_dict()
+        self.assertEqual(timings["job_id"], "123")
+        self.assertGreaterEqual(timings["phases"]["outputs"], 20)
+        self.assertGreaterEqual(timings["total_ms"], timings["phases"]["outputs"])
+
+    def test_prompt_and_node_times_from_events(self):
+        metrics = JobMetrics("123")
+        workflow = {
+            "3": {"class_type": "KSampler"},
+            "4": {"class_type": "CheckpointLoaderSimple"},
+        }
+        metrics.prompt_queued("p", workflow)
+
+        def event(event_type, **data):
+            metrics.observe_event(
+                {"type": event_type, "data": {"prompt_id": "p", **data}}
+            )
+
+        event("execution_start")
+        event("execution_cached", nodes=["4"])
+        event("executing", node="3")
+        time.sleep(0.02)
+        event("executing", node=None)
+        metrics.prompt_done("p")
+        # Events of other prompts are ignored
+        metrics.observe_event({"type": "execution_start", "data": {"prompt_id": "x"}})
+
+        prompt = metrics.to_dict()["prompts"]["p"]
+        self.assertIn("queue_wait_ms", prompt)
+        self.assertGreaterEqual(prompt["execution_ms"], 20)
+        self.assertGreaterEqual(prompt["wait_ms"], prompt["execution_ms"])
+        self.assertEqual(prompt["nodes"]["3"]["class_type"], "KSampler")
+        self.assertGreaterEqual(prompt["nodes"]["3"]["ms"], 20)
+        self.assertTrue(prompt["nodes"]["4"]["cached"])
+
+    def test_prompt_without_events(self):
+        metrics = JobMetrics("123")
+        metrics.prompt_queued("p", {})
+        metrics.prompt_done("p")
+
+        self.assertEqual(list(metrics.to_dict()["prompts"]["p"]), ["wait_ms", "nodes"])
+
+
+class TestPrometheusTextFile(unittest.TestCase):
+    timings = {
+        "job_id": "123",
+        "total_ms": 1500,
+        "phases": {"upload": 20, "outputs": 300},
+        "prompts": {
+            "p": {
+                "queue_wait_ms": 5,
+                "execution_ms": 1000,
+                "wait_ms": 1010,
+                "nodes": {"3": {"class_type": "KSampler", "ms": 900}},
+            }
+        },
+    }
+
+    def test_histograms_are_cumulative(self):
+        metrics = PrometheusTextFile("")
+        metrics.observe(self.timings, "success")
+        metrics.observe(self.timings, "error")
+        text = metrics.render()
+
+        self.assertIn('runpod_worker_comfy_jobs_total{status="success"} 1', text)
+        self.assertIn("# TYPE runpod_worker_comfy_phase_seconds histogram", text)
+        self.assertIn(
+            'runpod_worker_comfy_phase_seconds_bucket{phase="upload",le="0.01"} 0', text
+        )
+        self.assertIn(
+            'runpod_worker_comfy_phase_seconds_bucket{phase="upload",le="0.025"} 2',
+            text,
+        )
+        self.assertIn(
+            'runpod_worker_comfy_phase_seconds_bucket{phase="upload",le="+Inf"} 2', text
+        )
+        self.assertIn('runpod_worker_comfy_phase_seconds_count{phase="upload"} 2', text)
+        self.assertIn(
+            'runpod_worker_comfy_node_seconds_count{class_type="KSampler"} 2', text
+        )
+        self.assertIn("runpod_worker_comfy_job_seconds_sum 3.0", text)
+
+    def test_model_residency_is_counted(self):
+        metrics = PrometheusTextFile("")
+        for resident, freed in ((["a.safetensors"], False), ([], False), ([], True)):
+            models = {
+                "required": ["a.safetensors"],
+                "resident": resident,
+                "freed": freed,
+            }
+            metrics.observe({**self.timings, "models": models}, "success")
+        text = metrics.render()
+
+        for result in ("hit", "miss", "free"):
+            self.assertIn(
+                f'runpod_worker_comfy_model_residency_total{{result="{result}"}} 1',
+                text,
+            )
+
+    def test_cache_lookups_are_counted(self):
+        job_metrics = JobMetrics("1")
+        job_metrics.cache_lookup("input_cache", True)
+        job_metrics.cache_lookup("input_cache", True)
+        job_metrics.cache_lookup("url_cache", False)
+        timings = job_metrics.to_dict()
+        self.assertEqual(
+            timings["caches"],
+            {
+                "input_cache": {"hits": 2, "misses": 0},
+                "url_cache": {"hits": 0, "misses": 1},
+            },
+        )
+
+        metrics = PrometheusTextFile("")
+        metrics.observe(timings, "success")
+        metrics.observe(timings, "success")
+        text = metrics.render()
+
+        self.assertIn(
+            'runpod_worker_comfy_cache_lookups_total{cache="input_cache",result="hit"} 4',
+            text,
+        )
+        self.assertIn(
+            'runpod_worker_comfy_cache_lookups_total{cache="url_cache",result="miss"} 2',
+            text,
+        )
+
+    def test_write_replaces_the_file(self):
+        with tempfile.TemporaryDirectory() as path:
+            metrics = PrometheusTextFile(os.path.join(path, "metrics", "comfy.prom"))
+            metrics.observe(self.timings, "success")
+            metrics.write()
+
+            with open(metrics.path) as f:
+                self.assertEqual(f.read(), metrics.render())
+            self.assertEqual(os.listdir(os.path.dirname(metrics.path)), ["comfy.prom"])
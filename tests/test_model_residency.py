@@ -0,0 +1,103 @@
+import unittest
+import os
+import sys
+import tempfile
+
+# Make sure that "src" is known and can be used to import model_residency.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+from src.model_residency import ModelResidency, workflow_models
+from tests.fake_comfyui import WORKFLOW
+
+GB = 1024**3
+
+
+class TestModelResidency(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.residency = ModelResidency([self.folder.name], 0, 0)
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def add_model(self, name, size):
+        path = os.path.join(self.folder.name, "checkpoints", name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.truncate(size)
+
+    def test_workflow_models(self):
+        workflow = {
+            **WORKFLOW,
+            "10": {
+                "inputs": {"lora_name": "sdxl/detail.safetensors", "strength": 1.0},
+                "class_type": "LoraLoader",
+            },
+        }
+        self.assertEqual(
+            workflow_models(workflow),
+            ["sd_xl_base_1.0.safetensors", "sdxl/detail.safetensors"],
+        )
+
+    def test_size_of_models_in_subfolders(self):
+        self.add_model("sdxl/base.safetensors", 1000)
+        self.assertEqual(self.residency.size("sdxl/base.safetensors"), 1000)
+        self.assertEqual(self.residency.size("unknown.safetensors"), 0)
+
+    def test_models_are_indexed_without_holding_the_lock(self):
+        self.add_model("sdxl.safetensors", 6000)
+        self.add_model("flux.safetensors", 12000)
+        index = self.residency._index
+        locked = []
+
+        def checked_index():
+            locked.append(self.residency.lock.locked())
+            return index()
+
+        self.residency._index = checked_index
+        self.residency.job_started("1", ["sdxl.safetensors"])
+        self.residency.job_finished("1")
+        self.residency.indexed_at = None
+        self.assertTrue(self.residency.needs_free(["flux.safetensors"], lambda: 10000))
+
+        self.assertEqual(locked, [False, False])
+
+    def test_free_only_when_the_new_models_do_not_fit(self):
+        self.add_model("sdxl.safetensors", 6000)
+        self.add_model("flux.safetensors", 12000)
+        self.residency.job_started("1", ["sdxl.safetensors"])
+        self.residency.job_finished("1")
+
+        # The resident model is needed again
+        self.assertFalse(self.residency.needs_free(["sdxl.safetensors"], lambda: 0))
+        # Enough memory for both
+        self.assertFalse(self.residency.needs_free(["flux.safetensors"], lambda: 20000))
+        self.assertTrue(self.residency.needs_free(["flux.safetensors"], lambda: 10000))
+        # Without the free memory, ComfyUI manages its memory on its own
+        self.assertFalse(self.residency.needs_free(["flux.safetensors"], lambda: None))
+
+        self.residency.freed()
+        self.residency.job_started("2", ["flux.safetensors"])
+        self.assertEqual(self.residency.resident_models(), ["flux.safetensors"])
+        self.assertEqual(self.residency.stats()["frees"], 1)
+
+    def test_no_free_while_other_jobs_run(self):
+        self.residency.max_models = 1
+        self.residency.job_started("1", ["sdxl.safetensors"])
+        self.assertFalse(
+            self.residency.needs_free(["flux.safetensors"], lambda: 0, job_id="2")
+        )
+        self.residency.job_finished("1")
+        self.assertTrue(
+            self.residency.needs_free(["flux.safetensors"], lambda: 0, job_id="2")
+        )
+
+    def test_least_recently_used_first(self):
+        self.residency.job_started("1", ["a.safetensors", "b.safetensors"])
+        self.residency.job_started("2", ["a.safetensors"])
+        self.assertEqual(
+            self.residency.resident_models(), ["b.safetensors", "a.safetensors"]
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,139 @@
+import unittest
+import os
+import sys
+import tempfile
+
+# Make sure that "src" is known and can be used to import model_tier.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+from src.model_tier import ModelTier, extra_model_paths
+
+
+class TestModelTier(unittest.TestCase):
+    def setUp(self):
+        # The network volume and the local disk
+        self.folder = tempfile.TemporaryDirectory()
+        self.volume = os.path.join(self.folder.name, "volume")
+        self.local = os.path.join(self.folder.name, "local")
+        self.add_model("unet/flux.safetensors", 400)
+        self.add_model("vae/ae.safetensors", 200)
+        self.add_model("loras/style/anime.safetensors", 300)
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def add_model(self, path, size, content=b"m"):
+        path = os.path.join(self.volume, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(content * size)
+
+    def tier(self, max_bytes=1000, verify="mtime"):
+        return ModelTier(self.volume, self.local, max_bytes, verify)
+
+    def run_job(self, tier, job_id, models):
+        cached = tier.job_started(job_id, models)
+        tier.wait()
+        tier.job_finished(job_id)
+        return cached
+
+    def test_models_of_a_job_are_copied_for_the_next_jobs(self):
+        tier = self.tier()
+
+        first = self.run_job(tier, "1", ["flux.safetensors", "style/anime.safetensors"])
+        second = self.run_job(tier, "2", ["flux.safetensors", "missing.safetensors"])
+
+        self.assertEqual(first, [])
+        self.assertEqual(second, ["flux.safetensors"])
+        with open(os.path.join(self.local, "unet/flux.safetensors"), "rb") as f:
+            self.assertEqual(f.read(), b"m" * 400)
+        self.assertTrue(
+            os.path.isfile(os.path.join(self.local, "loras/style/anime.safetensors"))
+        )
+        self.assertEqual(tier.stats()["copies"], 2)
+        self.assertEqual(tier.stats()["bytes"], 700)
+
+    def test_least_recently_used_copies_are_evicted(self):
+        tier = self.tier(max_bytes=700)
+        self.run_job(tier, "1", ["flux.safetensors"])
+        self.run_job(tier, "2", ["ae.safetensors"])
+        self.run_job(tier, "3", ["flux.safetensors"])
+
+        self.run_job(tier, "4", ["style/anime.safetensors"])
+
+        self.assertEqual(
+            list(tier.entries),
+            ["unet/flux.safetensors", "loras/style/anime.safetensors"],
+        )
+        self.assertFalse(os.path.exists(os.path.join(self.local, "vae/ae.safetensors")))
+        self.assertEqual(tier.stats()["evictions"], 1)
+
+    def test_models_of_running_jobs_are_never_evicted(self):
+        tier = self.tier(max_bytes=600)
+        self.run_job(tier, "1", ["flux.safetensors"])
+
+        tier.job_started("2", ["flux.safetensors"])
+        self.run_job(tier, "3", ["style/anime.safetensors"])
+
+        self.assertEqual(list(tier.entries), ["unet/flux.safetensors"])
+        self.assertEqual(tier.stats()["copies"], 1)
+
+    def test_changed_models_are_copied_again(self):
+        tier = self.tier()
+        self.run_job(tier, "1", ["ae.safetensors"])
+        self.add_model("vae/ae.safetensors", 250, b"n")
+
+        cached = self.run_job(tier, "2", ["ae.safetensors"])
+
+        self.assertEqual(cached, [])
+        with open(os.path.join(self.local, "vae/ae.safetensors"), "rb") as f:
+            self.assertEqual(f.read(), b"n" * 250)
+        self.assertEqual(tier.stats()["bytes"], 250)
+
+    def test_copies_survive_a_restart_and_are_verified(self):
+        tier = self.tier(verify="sha256")
+        self.run_job(tier, "1", ["flux.safetensors", "ae.safetensors"])
+        # A copy that was damaged on the local disk
+        with open(os.path.join(self.local, "vae/ae.safetensors"), "r+b") as f:
+            f.write(b"x")
+
+        tier = self.tier(verify="sha256")
+        self.assertEqual(tier.start(["missing.safetensors"]), ["missing.safetensors"])
+        tier.wait()
+
+        self.assertEqual(list(tier.entries), ["unet/flux.safetensors"])
+        self.assertEqual(
+            self.run_job(tier, "2", ["flux.safetensors"]), ["flux.safetensors"]
+        )
+
+    def test_hot_models_are_copied_on_start(self):
+        tier = self.tier()
+
+        tier.start(["ae.safetensors"])
+        tier.wait()
+
+        self.assertEqual(list(tier.entries), ["vae/ae.safetensors"])
+
+    def test_disabled_without_cache_path(self):
+        tier = ModelTier(self.volume, "", 1000)
+
+        self.assertEqual(self.run_job(tier, "1", ["flux.safetensors"]), [])
+        self.assertFalse(os.path.exists(self.local))
+
+    def test_extra_model_paths_prefer_the_copies(self):
+        config = extra_model_paths("/runpod-volume/models", "/models", ["unet", "vae"])
+
+        self.assertEqual(
+            config,
+            "runpod_worker_comfy_cache:\n"
+            "  base_path: /models\n"
+            "  unet: unet/\n"
+            "  vae: vae/\n"
+            "runpod_worker_comfy:\n"
+            "  base_path: /runpod-volume/models\n"
+            "  unet: unet/\n"
+            "  vae: vae/\n",
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,69 @@
+import unittest
+import os
+import sys
+import time
+
+# Make sure that "src" is known and can be used to import prompt_watch.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+from src.prompt_watch import PromptWatch
+
+
+class TestPromptWatch(unittest.TestCase):
+    def watch(self, deadline_s=60, stall_timeout_s=0.05):
+        return PromptWatch(
+            ["1", "2"], time.monotonic() + deadline_s, stall_timeout_s, 0.05, 0.4
+        )
+
+    def test_poll_interval_grows_while_a_prompt_runs(self):
+        watch = self.watch()
+        watch.observe_queue({"1"}, ["2"])
+        self.assertEqual(
+            [watch.next_interval() for _ in range(5)], [0.05, 0.1, 0.2, 0.4, 0.4]
+        )
+
+        # The next prompt starts, it might be a fast one
+        watch.done("1")
+        watch.observe_queue({"2"}, [])
+        self.assertEqual(watch.next_interval(), 0.05)
+
+    def test_prompts_behind_others_are_polled_slowly(self):
+        watch = self.watch()
+        watch.observe_queue({"other"}, ["1", "2"])
+        self.assertEqual(watch.next_interval(), 0.4)
+
+    def test_poll_interval_ends_at_the_deadline(self):
+        watch = self.watch(deadline_s=0.01)
+        watch.observe_queue({"other"}, ["1", "2"])
+        self.assertLessEqual(watch.next_interval(), 0.01)
+
+    def test_only_running_prompts_stall(self):
+        watch = self.watch()
+        time.sleep(0.06)
+        # Waiting in the queue is no stall
+        self.assertIsNone(watch.error_message())
+
+        watch.observe_event({"type": "execution_start", "data": {"prompt_id": "1"}})
+        self.assertIsNone(watch.error_message())
+        time.sleep(0.06)
+        self.assertIn("stalled", watch.error_message())
+        self.assertIsNone(watch.error_message(check_stall=False))
+
+        # A preview is progress as well
+        watch.observe_event(b"preview")
+        self.assertIsNone(watch.error_message())
+
+    def test_events_of_other_prompts_are_no_progress(self):
+        watch = self.watch()
+        watch.observe_event({"type": "execution_start", "data": {"prompt_id": "1"}})
+        time.sleep(0.06)
+        watch.observe_event({"type": "progress", "data": {"prompt_id": "other"}})
+        self.assertIn("stalled", watch.error_message())
+
+        watch.observe_event(
+            {"type": "executing", "data": {"prompt_id": "1", "node": None}}
+        )
+        self.assertIsNone(watch.error_message())
+
+    def test_deadline(self):
+        watch = self.watch(deadline_s=0)
+        self.assertIn("deadline", watch.error_message())
@@ -0,0 +1,326 @@
+import unittest
+from unittest.mock import patch
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import zipfile
+
+# Make sure that "src" is known and can be used to import restore_snapshot.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+from src.restore_snapshot import (
+    RestoreError,
+    install_requirements,
+    mirror_path,
+    restore_node,
+    restore_registry_node,
+    restore_snapshot,
+    snapshot_pips,
+)
+
+
+def git(*args, cwd=None):
+    return subprocess.run(
+        ["git", "-c", "user.name=test", "-c", "user.email=test@example.com", *args],
+        cwd=cwd,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout.strip()
+
+
+class TestRestoreSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.workspace = os.path.join(self.folder.name, "comfyui")
+        self.git_cache = os.path.join(self.folder.name, "cache", "git")
+        self.wheel_cache = os.path.join(self.folder.name, "cache", "wheels")
+
+        # A custom node with two commits
+        self.origin = os.path.join(self.folder.name, "origin", "ComfyUI-Fake-Node")
+        os.makedirs(self.origin)
+        git("init", "--quiet", cwd=self.origin)
+        with open(os.path.join(self.origin, "requirements.txt"), "w") as f:
+            f.write("# comment\nfake-package>=1.0  # inline\n\n")
+        git("add", "requirements.txt", cwd=self.origin)
+        git("commit", "--quiet", "-m", "first", cwd=self.origin)
+        self.first = git("rev-parse", "HEAD", cwd=self.origin)
+        git("commit", "--quiet", "--allow-empty", "-m", "second", cwd=self.origin)
+        self.url = f"file://{self.origin}"
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def snapshot(self, **spec):
+        return {
+            "git_custom_nodes": {self.url: {"hash": self.first, **spec}},
+            "file_custom_nodes": [],
+            "pips": {},
+        }
+
+    def restore(self, snapshot, workspace=None, offline=False):
+        with patch("src.restore_snapshot.install_requirements") as mock_install:
+            errors = restore_snapshot(
+                snapshot,
+                workspace or self.workspace,
+                self.git_cache,
+                self.wheel_cache,
+                offline,
+                jobs=2,
+            )
+        # Nothing is installed if the restore failed early
+        return errors, mock_install.call_args and mock_install.call_args[0][0]
+
+    def test_node_is_cloned_at_the_commit_and_skipped_later(self):
+        errors, requirements = self.restore(self.snapshot())
+
+        self.assertEqual(errors, [])
+        node_path = os.path.join(self.workspace, "custom_nodes", "ComfyUI-Fake-Node")
+        self.assertEqual(git("rev-parse", "HEAD", cwd=node_path), self.first)
+        self.assertEqual(git("remote", "get-url", "origin", cwd=node_path), self.url)
+        self.assertEqual(requirements, ["fake-package>=1.0"])
+
+        custom_nodes_path = os.path.join(self.workspace, "custom_nodes")
+        status = restore_node(
+            self.url, {"hash": self.first}, custom_nodes_path, "", False
+        )
+        self.assertEqual(status, "skipped")
+
+    def test_restore_works_offline_with_the_git_cache(self):
+        errors, _ = self.restore(self.snapshot())
+        self.assertEqual(errors, [])
+        shutil.rmtree(self.origin)
+
+        workspace = os.path.join(self.folder.name, "other")
+        errors, _ = self.restore(self.snapshot(), workspace=workspace, offline=True)
+
+        self.assertEqual(errors, [])
+        node_path = os.path.join(workspace, "custom_nodes", "ComfyUI-Fake-Node")
+        self.assertEqual(git("rev-parse", "HEAD", cwd=node_path), self.first)
+
+    def test_submodules_are_restored_offline_from_the_git_cache(self):
+        library = os.path.join(self.folder.name, "origin", "fake-library")
+        os.makedirs(library)
+        git("init", "--quiet", cwd=library)
+        with open(os.path.join(library, "library.py"), "w") as f:
+            f.write("VALUE = 1\n")
+        git("add", "library.py", cwd=library)
+        git("commit", "--quiet", "-m", "library", cwd=library)
+        git("checkout", "--quiet", self.first, cwd=self.origin)
+        git(
+            "-c",
+            "protocol.file.allow=always",
+            "submodule",
+            "add",
+            "--quiet",
+            f"file://{library}",
+            "lib",
+            cwd=self.origin,
+        )
+        git("commit", "--quiet", "-m", "submodule", cwd=self.origin)
+        self.first = git("rev-parse", "HEAD", cwd=self.origin)
+
+        errors, _ = self.restore(self.snapshot())
+        self.assertEqual(errors, [])
+        shutil.rmtree(self.origin)
+        shutil.rmtree(library)
+
+        workspace = os.path.join(self.folder.name, "other")
+        errors, _ = self.restore(self.snapshot(), workspace=workspace, offline=True)
+
+        self.assertEqual(errors, [])
+        lib_path = os.path.join(workspace, "custom_nodes", "ComfyUI-Fake-Node", "lib")
+        self.assertTrue(os.path.isfile(os.path.join(lib_path, "library.py")))
+        self.assertEqual(
+            git("remote", "get-url", "origin", cwd=lib_path), f"file://{library}"
+        )
+
+    def test_offline_restore_fails_for_missing_submodules(self):
+        os.makedirs(self.git_cache)
+        with open(os.path.join(self.origin, ".gitmodules"), "w") as f:
+            f.write('[submodule "lib"]\n\tpath = lib\n\turl = ../missing.git\n')
+        git("add", ".gitmodules", cwd=self.origin)
+        # Any commit will do, the submodule is never fetched
+        git(
+            "update-index",
+            "--add",
+            "--cacheinfo",
+            f"160000,{self.first},lib",
+            cwd=self.origin,
+        )
+        git("commit", "--quiet", "-m", "submodule", cwd=self.origin)
+        self.first = git("rev-parse", "HEAD", cwd=self.origin)
+        custom_nodes_path = os.path.join(self.workspace, "custom_nodes")
+        os.makedirs(custom_nodes_path)
+        # Only the node itself is in the git cache
+        mirror = mirror_path(self.git_cache, self.url)
+        git("clone", "--quiet", "--mirror", self.url, mirror)
+
+        with self.assertRaisesRegex(RestoreError, "missing.git at .* is not in the"):
+            restore_node(
+                self.url, {"hash": self.first}, custom_nodes_path, self.git_cache, True
+            )
+
+    def test_offline_restore_fails_for_missing_commits(self):
+        errors, _ = self.restore(self.snapshot(), offline=True)
+
+        self.assertEqual(len(errors), 1)
+        self.assertIn("is not in the git cache", errors[0])
+
+    def test_disabled_nodes_are_not_installed(self):
+        errors, requirements = self.restore(self.snapshot(disabled=True))
+
+        self.assertEqual(errors, [])
+        self.assertEqual(requirements, [])
+        node_path = os.path.join(self.workspace, "custom_nodes", "ComfyUI-Fake-Node")
+        self.assertFalse(os.path.exists(node_path))
+
+    def test_comfyui_is_checked_out_at_the_commit(self):
+        # ComfyUI is a clone with a newer commit, its requirements are installed
+        git("clone", "--quiet", self.url, self.workspace)
+        snapshot = {**self.snapshot(), "comfyui": self.first}
+        snapshot["git_custom_nodes"] = {}
+
+        errors, requirements = self.restore(snapshot)
+
+        self.assertEqual(errors, [])
+        self.assertEqual(git("rev-parse", "HEAD", cwd=self.workspace), self.first)
+        self.assertEqual(requirements, ["fake-package>=1.0"])
+
+    def test_comfyui_must_be_a_git_repository(self):
+        snapshot = {**self.snapshot(), "comfyui": self.first}
+
+        errors, requirements = self.restore(snapshot)
+
+        self.assertEqual(len(errors), 1)
+        self.assertIn("is not a git repository", errors[0])
+        self.assertIsNone(requirements)
+
+    def test_unknown_sections_fail_the_restore(self):
+        snapshot = {**self.snapshot(), "other_custom_nodes": {"node": "1.0"}}
+
+        errors, requirements = self.restore(snapshot)
+
+        self.assertIsNone(requirements)
+        self.assertEqual(
+            errors,
+            ["the section 'other_custom_nodes' of the snapshot is not supported"],
+        )
+        self.assertFalse(os.path.exists(self.workspace))
+
+    def registry_urlopen(self, url, timeout=None):
+        self.urls.append(url)
+        if "/install?" in url:
+            return io.BytesIO(json.dumps({"downloadUrl": self.archive}).encode())
+        return open(url, "rb")
+
+    def test_registry_nodes_are_installed_at_the_version(self):
+        self.urls = []
+        self.archive = os.path.join(self.folder.name, "node.zip")
+        with zipfile.ZipFile(self.archive, "w") as zip_file:
+            zip_file.writestr("pyproject.toml", 'version = "1.2.0"\n')
+            zip_file.writestr("requirements.txt", "registry-package\n")
+            zip_file.writestr("nodes/__init__.py", "")
+        snapshot = {**self.snapshot(), "cnr_custom_nodes": {"fake-node": "1.2.0"}}
+
+        with patch(
+            "src.restore_snapshot.urllib.request.urlopen",
+            side_effect=self.registry_urlopen,
+        ):
+            errors, requirements = self.restore(snapshot)
+
+        self.assertEqual(errors, [])
+        self.assertIn("registry-package", requirements)
+        self.assertIn("nodes/fake-node/install?version=1.2.0", self.urls[0])
+        node_path = os.path.join(self.workspace, "custom_nodes", "fake-node")
+        self.assertTrue(os.path.isfile(os.path.join(node_path, "nodes", "__init__.py")))
+        with open(os.path.join(node_path, ".tracking")) as f:
+            self.assertIn("nodes/__init__.py", f.read().split())
+
+        # The version is installed already, the cache works offline
+        custom_nodes_path = os.path.join(self.workspace, "custom_nodes")
+        status = restore_registry_node(
+            "fake-node", "1.2.0", custom_nodes_path, self.git_cache, True
+        )
+        self.assertEqual(status, "skipped")
+        other = os.path.join(self.folder.name, "other", "custom_nodes")
+        os.makedirs(other)
+        status = restore_registry_node(
+            "fake-node", "1.2.0", other, self.git_cache, True
+        )
+        self.assertEqual(status, "installed")
+
+    def test_registry_nodes_replace_no_git_clones(self):
+        custom_nodes_path = os.path.join(self.workspace, "custom_nodes")
+        git("clone", "--quiet", self.url, os.path.join(custom_nodes_path, "fake-node"))
+
+        with self.assertRaisesRegex(RestoreError, "is not a registry node"):
+            restore_registry_node(
+                "fake-node", "1.2.0", custom_nodes_path, self.git_cache, True
+            )
+
+    def test_offline_restore_fails_for_missing_registry_nodes(self):
+        snapshot = {**self.snapshot(), "cnr_custom_nodes": {"fake-node": "1.2.0"}}
+        errors, _ = self.restore(snapshot, offline=True)
+
+        self.assertIn("fake-node: fake-node 1.2.0 is not in the git cache", errors)
+
+    def test_snapshot_pips(self):
+        pips = {
+            "requests==0.0.1": "",
+            "not-an-installed-package==1.0": "",
+            "git+https://github.com/example/package": "",
+        }
+        # Installed packages keep their version
+        self.assertEqual(snapshot_pips(pips), ["not-an-installed-package==1.0"])
+
+
+class TestInstallRequirements(unittest.TestCase):
+    def setUp(self):
+        self.wheel_cache = tempfile.TemporaryDirectory()
+        open(
+            os.path.join(self.wheel_cache.name, "cached_pkg-1.0-py3-none-any.whl"), "w"
+        ).close()
+        self.commands = []
+
+    def tearDown(self):
+        self.wheel_cache.cleanup()
+
+    def run_pip(self, command, cwd=None):
+        self.commands.append(command[3:])
+        if "--report" in command:
+            report = {
+                "install": [
+                    {"metadata": {"name": "Cached-Pkg", "version": "1.0"}},
+                    {"metadata": {"name": "new-pkg", "version": "2.0"}},
+                ]
+            }
+            with open(command[command.index("--report") + 1], "w") as f:
+                json.dump(report, f)
+        return ""
+
+    def test_only_missing_wheels_are_added_to_the_cache(self):
+        with patch("src.restore_snapshot.run", side_effect=self.run_pip):
+            install_requirements(
+                ["cached-pkg", "new-pkg"], self.wheel_cache.name, False
+            )
+
+        dry_run, wheel, install = self.commands
+        self.assertIn("--dry-run", dry_run)
+        self.assertEqual(wheel[0], "wheel")
+        self.assertEqual(wheel[-1:], ["new-pkg==2.0"])
+        self.assertIn("--no-index", install)
+
+    def test_offline_installs_from_the_wheel_cache_only(self):
+        with patch("src.restore_snapshot.run", side_effect=self.run_pip):
+            install_requirements(["cached-pkg"], self.wheel_cache.name, True)
+
+        self.assertEqual(len(self.commands), 1)
+        self.assertEqual(self.commands[0][:3], ["install", "--quiet", "--no-index"])
+
+
+if __name__ == "__main__":
+    unittest.main()
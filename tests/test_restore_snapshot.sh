@@ -15,48 +15,55 @@ chmod +x "$SCRIPT_TO_TEST"
 
 # Create test directory
 TEST_DIR=$(mktemp -d)
+trap 'rm -rf "$TEST_DIR"' EXIT
 cd "$TEST_DIR"
 
-# Create a minimal mock snapshot file
-cat > test_restore_snapshot_temporary.json << 'EOF'
+git_test() {
+    git -c user.name=test -c user.email=test@example.com "$@"
+}
+
+# Create a local custom node, so that the restore doesn't need the network
+NODE_ORIGIN="$TEST_DIR/origin/ComfyUI-Fake-Node"
+mkdir -p "$NODE_ORIGIN"
+git_test -C "$NODE_ORIGIN" init --quiet
+echo "NODE_CLASS_MAPPINGS = {}" > "$NODE_ORIGIN/__init__.py"
+git_test -C "$NODE_ORIGIN" add __init__.py
+git_test -C "$NODE_ORIGIN" commit --quiet -m "first"
+COMMIT=$(git -C "$NODE_ORIGIN" rev-parse HEAD)
+git_test -C "$NODE_ORIGIN" commit --quiet --allow-empty -m "second"
+
+# Create a snapshot with the custom node at its first commit
+cat > test_restore_snapshot_temporary.json << SNAPSHOT
 {
-  "comfyui": "test-hash",
-  "git_custom_nodes": {},
+  "git_custom_nodes": {
+    "file://$NODE_ORIGIN": {"hash": "$COMMIT", "disabled": false}
+  },
   "file_custom_nodes": [],
   "pips": {}
 }
-EOF
-
-# Create a mock comfy command that simulates the real comfy behavior
-cat > comfy << 'EOF'
-#!/bin/bash
-if [[ "$1" == "--workspace" && "$3" == "restore-snapshot" ]]; then
-    # Verify the snapshot file exists
-    if [[ ! -f "$4" ]]; then
-        echo "Error: Snapshot file not found"
+SNAPSHOT
+
+export SNAPSHOT_GIT_CACHE="$TEST_DIR/cache/git"
+export SNAPSHOT_WHEEL_CACHE="$TEST_DIR/cache/wheels"
+
+check_restored() {
+    local node_path="$1/custom_nodes/ComfyUI-Fake-Node"
+    if [ "$(git -C "$node_path" rev-parse HEAD 2>/dev/null)" != "$COMMIT" ]; then
+        echo "❌ Test failed: $node_path is not at the commit of the snapshot"
         exit 1
     fi
-    echo "Mock: Restored snapshot from $4"
-    exit 0
-fi
-EOF
-
-chmod +x comfy
-export PATH="$TEST_DIR:$PATH"
+}
 
 # Run the actual restore_snapshot script
 echo "Testing snapshot restoration..."
 echo "Script location: $SCRIPT_TO_TEST"
-"$SCRIPT_TO_TEST"
+COMFYUI_PATH="$TEST_DIR/comfyui" "$SCRIPT_TO_TEST" test_restore_snapshot_temporary.json
+check_restored "$TEST_DIR/comfyui"
 
-# Verify the script executed successfully
-if [ $? -eq 0 ]; then
-    echo "✅ Test passed: Snapshot restoration script executed successfully"
-else
-    echo "❌ Test failed: Snapshot restoration script failed"
-    exit 1
-fi
+# Restore again without the origin, only from the git cache
+rm -rf "$TEST_DIR/origin"
+COMFYUI_PATH="$TEST_DIR/offline" SNAPSHOT_OFFLINE=true \
+    "$SCRIPT_TO_TEST" test_restore_snapshot_temporary.json
+check_restored "$TEST_DIR/offline"
 
-# Clean up
-rm -rf "$TEST_DIR"
-  
\ No newline at end of file
+echo "✅ Test passed: Snapshot restoration script executed successfully"
@@ -0,0 +1,45 @@
+import unittest
+import os
+import sys
+import tempfile
+
+# Make sure that "src" is known and can be used to import result_cache.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+from src.result_cache import ResultCache
+
+
+class TestResultCache(unittest.TestCase):
+    def test_key_ignores_the_order_of_keys_and_images(self):
+        images = [
+            {"name": "a.png", "sha256": "1" * 64},
+            {"name": "b.png", "sha256": "2" * 64},
+        ]
+        key = ResultCache.key({"3": {"inputs": {"seed": 1, "steps": 20}}}, images)
+
+        self.assertEqual(
+            key,
+            ResultCache.key(
+                {"3": {"inputs": {"steps": 20, "seed": 1}}}, list(reversed(images))
+            ),
+        )
+        self.assertNotEqual(
+            key, ResultCache.key({"3": {"inputs": {"seed": 2, "steps": 20}}}, images)
+        )
+        self.assertNotEqual(
+            key,
+            ResultCache.key(
+                {"3": {"inputs": {"seed": 1, "steps": 20}}},
+                [{"name": "a.png", "sha256": "3" * 64}],
+            ),
+        )
+
+    def test_put_and_get_result(self):
+        with tempfile.TemporaryDirectory() as path:
+            cache = ResultCache(path, 1024, ttl_s=60)
+            key = ResultCache.key({"3": {}})
+            cache.put_result(key, {"status": "success", "message": "image"})
+
+            self.assertEqual(
+                cache.get_result(key), {"status": "success", "message": "image"}
+            )
+            self.assertIsNone(cache.get_result(ResultCache.key({"4": {}})))
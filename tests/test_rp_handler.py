@@ -1,13 +1,33 @@
 import unittest
-from unittest.mock import patch, MagicMock, mock_open, Mock
+from unittest.mock import patch, ANY, MagicMock, mock_open
 import sys
 import os
+import hashlib
 import json
+import tempfile
 import base64
+import threading
+import time
+import asyncio
+import copy
+import io
+import requests
+from collections import OrderedDict
 
 # Make sure that "src" is known and can be used to import rp_handler.py
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
 from src import rp_handler
+from tests.fake_comfyui import FakeComfyUI, OBJECT_INFO, WORKFLOW, png_image
+from tests.fake_s3 import FakeS3
+from input_cache import InputCache
+from result_cache import ResultCache
+from job_metrics import JobMetrics, PrometheusTextFile
+from workflow_schema import WorkflowSchema
+from workflow_templates import WorkflowTemplates
+from file_cleanup import FileCleanup
+from model_residency import ModelResidency
+from model_tier import ModelTier
+from url_cache import UrlCache
 
 # Local folder for test resources
 RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES = "./test_resources/images"
@@ -27,7 +47,56 @@ class TestRunpodWorkerComfy(unittest.TestCase):
         }
         validated_data, error = rp_handler.validate_input(input_data)
         self.assertIsNone(error)
-        self.assertEqual(validated_data, input_data)
+        images = validated_data.pop("images")
+        self.addCleanup(rp_handler.close_images, images)
+        self.assertEqual(validated_data, {"workflow": {"key": "value"}})
+        self.assertEqual(len(images), 1)
+        self.assertEqual(images[0]["name"], "image1.png")
+        self.assertEqual(images[0]["file"].read(), base64.b64decode("base64string"))
+        self.assertEqual(
+            images[0]["sha256"],
+            hashlib.sha256(base64.b64decode("base64string")).hexdigest(),
+        )
+        # The payload is released once it is decoded
+        self.assertNotIn("image", input_data["images"][0])
+
+    def test_input_with_invalid_base64_image(self):
+        input_data = {
+            "workflow": {"key": "value"},
+            "images": [{"name": "image1.png", "image": "not base64!"}],
+        }
+        validated_data, error = rp_handler.validate_input(input_data)
+        self.assertIsNone(validated_data)
+        self.assertEqual(error, "Invalid base64 data for image 'image1.png'")
+
+    def test_input_with_data_uri_image(self):
+        input_data = {
+            "workflow": {"key": "value"},
+            "images": [
+                {
+                    "name": "image1.png",
+                    "image": "data:image/png;base64,"
+                    + base64.b64encode(b"Test Image Data").decode("utf-8"),
+                }
+            ],
+        }
+        validated_data, error = rp_handler.validate_input(input_data)
+        self.assertIsNone(error)
+        self.addCleanup(rp_handler.close_images, validated_data["images"])
+        self.assertEqual(validated_data["images"][0]["file"].read(), b"Test Image Data")
+
+    def test_input_with_line_wrapped_base64_image(self):
+        blob = os.urandom(200)
+        input_data = {
+            "workflow": {"key": "value"},
+            "images": [
+                {"name": "image1.png", "image": base64.encodebytes(blob).decode()}
+            ],
+        }
+        validated_data, error = rp_handler.validate_input(input_data)
+        self.assertIsNone(error)
+        self.addCleanup(rp_handler.close_images, validated_data["images"])
+        self.assertEqual(validated_data["images"][0]["file"].read(), blob)
 
     def test_input_missing_workflow(self):
         input_data = {"images": [{"name": "image1.png", "image": "base64string"}]}
@@ -43,7 +112,58 @@ class TestRunpodWorkerComfy(unittest.TestCase):
         validated_data, error = rp_handler.validate_input(input_data)
         self.assertIsNotNone(error)
         self.assertEqual(
-            error, "'images' must be a list of objects with 'name' and 'image' keys"
+            error,
+            "'images' must be a list of objects with 'name' and either 'image', 'sha256' or 'url' keys",
+        )
+
+    def test_input_with_sha256_reference(self):
+        blob = b"Cached Image Data"
+        with tempfile.TemporaryDirectory() as cache_path, patch.object(
+            rp_handler, "input_cache", InputCache(cache_path, 1024)
+        ):
+            # The first job sends the image, the second one only its hash
+            validated_data, _ = rp_handler.validate_input(
+                {
+                    "workflow": {"key": "value"},
+                    "images": [
+                        {"name": "mask.png", "image": base64.b64encode(blob).decode()}
+                    ],
+                }
+            )
+            rp_handler.close_images(validated_data["images"])
+            sha256 = hashlib.sha256(blob).hexdigest()
+            metrics = JobMetrics("2")
+            validated_data, error = rp_handler.validate_input(
+                {
+                    "workflow": {"key": "value"},
+                    "images": [{"name": "mask.png", "sha256": sha256}],
+                },
+                metrics,
+            )
+            self.assertIsNone(error)
+            with validated_data["images"][0]["file"] as f:
+                self.assertEqual(f.read(), blob)
+        self.assertEqual(
+            metrics.to_dict()["caches"], {"input_cache": {"hits": 1, "misses": 0}}
+        )
+
+    def test_input_with_unknown_sha256_reference(self):
+        with tempfile.TemporaryDirectory() as cache_path, patch.object(
+            rp_handler, "input_cache", InputCache(cache_path, 1024)
+        ):
+            metrics = JobMetrics("1")
+            validated_data, error = rp_handler.validate_input(
+                {
+                    "workflow": {"key": "value"},
+                    "images": [{"name": "mask.png", "sha256": "0" * 64}],
+                },
+                metrics,
+            )
+
+        self.assertIsNone(validated_data)
+        self.assertIn("is not cached on this worker", error)
+        self.assertEqual(
+            metrics.to_dict()["caches"], {"input_cache": {"hits": 0, "misses": 1}}
         )
 
     def test_invalid_json_string_input(self):
@@ -64,55 +184,59 @@ class TestRunpodWorkerComfy(unittest.TestCase):
         self.assertIsNotNone(error)
         self.assertEqual(error, "Please provide input")
 
-    @patch("rp_handler.requests.get")
-    def test_check_server_server_up(self, mock_requests):
+    @patch.object(rp_handler.comfy_session, "get")
+    def test_check_server_server_up(self, mock_get):
         mock_response = MagicMock()
         mock_response.status_code = 200
-        mock_requests.return_value = mock_response
+        mock_get.return_value = mock_response
 
         result = rp_handler.check_server("http://127.0.0.1:8188", 1, 50)
         self.assertTrue(result)
 
-    @patch("rp_handler.requests.get")
-    def test_check_server_server_down(self, mock_requests):
-        mock_requests.get.side_effect = rp_handler.requests.RequestException()
+    @patch.object(rp_handler.comfy_session, "get")
+    def test_check_server_server_down(self, mock_get):
+        mock_get.side_effect = rp_handler.requests.RequestException()
         result = rp_handler.check_server("http://127.0.0.1:8188", 1, 50)
         self.assertFalse(result)
 
-    @patch("rp_handler.urllib.request.urlopen")
-    def test_queue_prompt(self, mock_urlopen):
+    @patch.object(rp_handler.comfy_session, "request")
+    def test_queue_prompt(self, mock_request):
         mock_response = MagicMock()
-        mock_response.read.return_value = json.dumps({"prompt_id": "123"}).encode()
-        mock_urlopen.return_value = mock_response
+        mock_response.status_code = 200
+        mock_response.json.return_value = {"prompt_id": "123"}
+        mock_request.return_value = mock_response
         result = rp_handler.queue_workflow({"prompt": "test"})
         self.assertEqual(result, {"prompt_id": "123"})
 
-    @patch("rp_handler.urllib.request.urlopen")
-    def test_get_history(self, mock_urlopen):
-        # Mock response data as a JSON string
-        mock_response_data = json.dumps({"key": "value"}).encode("utf-8")
-
-        # Define a mock response function for `read`
-        def mock_read():
-            return mock_response_data
+    @patch.object(rp_handler.comfy_session, "request")
+    def test_queue_prompt_error(self, mock_request):
+        mock_response = MagicMock()
+        mock_response.status_code = 400
+        mock_response.text = "invalid prompt"
+        mock_request.return_value = mock_response
+        with self.assertRaisesRegex(RuntimeError, "invalid prompt"):
+            rp_handler.queue_workflow({"prompt": "test"})
 
+    @patch.object(rp_handler.comfy_session, "request")
+    def test_get_history(self, mock_request):
         # Create a mock response object
-        mock_response = Mock()
-        mock_response.read = mock_read
-
-        # Mock the __enter__ and __exit__ methods to support the context manager
-        mock_response.__enter__ = lambda s: s
-        mock_response.__exit__ = Mock()
-
-        # Set the return value of the urlopen mock
-        mock_urlopen.return_value = mock_response
+        mock_response = MagicMock()
+        mock_response.json.return_value = {"key": "value"}
+        mock_request.return_value = mock_response
 
         # Call the function under test
         result = rp_handler.get_history("123")
 
         # Assertions
         self.assertEqual(result, {"key": "value"})
-        mock_urlopen.assert_called_with("http://127.0.0.1:8188/history/123")
+        mock_request.assert_called_with(
+            "GET",
+            "http://127.0.0.1:8188/history/123",
+            timeout=(
+                rp_handler.COMFY_CONNECT_TIMEOUT_MS / 1000,
+                rp_handler.COMFY_READ_TIMEOUT_MS / 1000,
+            ),
+        )
 
     @patch("builtins.open", new_callable=mock_open, read_data=b"test")
     def test_base64_encode(self, mock_file):
@@ -157,7 +281,11 @@ class TestRunpodWorkerComfy(unittest.TestCase):
         mock_upload_image.return_value = "http://example.com/uploaded/image.png"
 
         # Define the outputs and job_id for the test
-        outputs = {"node_id": {"images": [{"filename": "ComfyUI_00001_.png", "subfolder": "test"}]}}
+        outputs = {
+            "node_id": {
+                "images": [{"filename": "ComfyUI_00001_.png", "subfolder": "test"}]
+            }
+        }
         job_id = "123"
 
         # Call the function under test
@@ -201,7 +329,7 @@ class TestRunpodWorkerComfy(unittest.TestCase):
         self.assertIn("simulated_uploaded", result["message"])
         self.assertEqual(result["status"], "success")
 
-    @patch("rp_handler.requests.post")
+    @patch.object(rp_handler.comfy_session, "request")
     def test_upload_images_successful(self, mock_post):
         mock_response = unittest.mock.Mock()
         mock_response.status_code = 200
@@ -217,7 +345,7 @@ class TestRunpodWorkerComfy(unittest.TestCase):
         self.assertEqual(len(responses), 3)
         self.assertEqual(responses["status"], "success")
 
-    @patch("rp_handler.requests.post")
+    @patch.object(rp_handler.comfy_session, "request")
     def test_upload_images_failed(self, mock_post):
         mock_response = unittest.mock.Mock()
         mock_response.status_code = 400
@@ -232,3 +360,1655 @@ class TestRunpodWorkerComfy(unittest.TestCase):
 
         self.assertEqual(len(responses), 3)
         self.assertEqual(responses["status"], "error")
+
+
+class TestWaitForCompletion(unittest.TestCase):
+    workflow = {
+        "3": {"inputs": {}, "class_type": "KSampler"},
+        "9": {"inputs": {}, "class_type": "SaveImage"},
+    }
+
+    def run_handler(self, fake):
+        with patch.object(rp_handler, "COMFY_HOST", fake.host), patch.object(
+            rp_handler, "COMFY_POLLING_INTERVAL_MS", 10
+        ), patch.object(
+            rp_handler, "process_output_images", return_value={"status": "success"}
+        ) as mock_process:
+            result = rp_handler.handler(
+                {"id": "123", "input": {"workflow": self.workflow}}
+            )
+        return result, mock_process
+
+    def test_handler_waits_for_websocket_events(self):
+        with FakeComfyUI() as fake:
+            result, mock_process = self.run_handler(fake)
+
+        self.assertEqual(result["status"], "success")
+        mock_process.assert_called_once_with(
+            {
+                "9": {
+                    "images": [
+                        {
+                            "filename": "ComfyUI_9_.png",
+                            "subfolder": "",
+                            "type": "output",
+                        }
+                    ]
+                }
+            },
+            "123",
+            ANY,
+        )
+        # The history is only fetched once, after the prompt is finished
+        self.assertEqual(fake.count("GET", "/history/"), 1)
+        self.assertEqual(fake.count("GET", "/ws"), 1)
+
+    def test_handler_falls_back_to_polling_without_websocket(self):
+        with FakeComfyUI(refuse_websocket=True) as fake:
+            result, mock_process = self.run_handler(fake)
+
+        self.assertEqual(result["status"], "success")
+        mock_process.assert_called_once()
+        self.assertGreaterEqual(fake.count("GET", "/history/"), 1)
+
+    def test_handler_falls_back_to_polling_when_websocket_drops(self):
+        with FakeComfyUI(drop_websocket=True, render_time=0.05) as fake:
+            result, mock_process = self.run_handler(fake)
+
+        self.assertEqual(result["status"], "success")
+        mock_process.assert_called_once()
+        # The queue is polled and the history is only fetched once the prompt is done
+        self.assertGreater(fake.count("GET", "/queue"), 1)
+        self.assertEqual(fake.count("GET", "/history/"), 1)
+
+    def test_handler_returns_execution_error(self):
+        with FakeComfyUI(execution_error=True) as fake:
+            result, mock_process = self.run_handler(fake)
+
+        self.assertIn("fake failure", result["error"])
+        mock_process.assert_not_called()
+
+    def test_websocket_checks_history_when_silent(self):
+        ws = MagicMock()
+        ws.recv.side_effect = rp_handler.websocket.WebSocketTimeoutException()
+        with patch.object(
+            rp_handler,
+            "get_history",
+            return_value={"123": {"outputs": {"9": {}}, "status": {"completed": True}}},
+        ):
+            prompt_id, error = rp_handler.next_websocket_completion(
+                ws, {"123"}, rp_handler.watch_prompts(["123"], time.monotonic() + 1)
+            )
+
+        self.assertEqual(prompt_id, "123")
+        self.assertIsNone(error)
+
+
+class TestBatch(unittest.TestCase):
+    def workflow(self, class_type="SaveImage", seed=1):
+        return {"9": {"inputs": {"seed": seed}, "class_type": class_type}}
+
+    def run_handler(self, fake, job_input):
+        def process_output_images(outputs, job_id, inline_budget=None):
+            return {"status": "success", "message": list(outputs)[0]}
+
+        with patch.object(rp_handler, "COMFY_HOST", fake.host), patch.object(
+            rp_handler, "process_output_images", side_effect=process_output_images
+        ) as mock_process:
+            result = rp_handler.handler({"id": "123", "input": job_input})
+        return result, mock_process
+
+    def test_all_workflows_are_queued_up_front(self):
+        with FakeComfyUI(render_time=0.05) as fake:
+            result, mock_process = self.run_handler(
+                fake, {"workflows": [self.workflow(seed=i) for i in range(3)]}
+            )
+
+        self.assertEqual(result["status"], "success")
+        self.assertEqual([r["index"] for r in result["results"]], [0, 1, 2])
+        self.assertTrue(all(r["status"] == "success" for r in result["results"]))
+        self.assertEqual(mock_process.call_count, 3)
+        # Every workflow was queued before the first one was finished
+        prompt_requests = [
+            i for i, (m, p) in enumerate(fake.requests) if p == "/prompt"
+        ]
+        first_history = next(
+            i for i, (m, p) in enumerate(fake.requests) if p.startswith("/history/")
+        )
+        self.assertEqual(len(prompt_requests), 3)
+        self.assertLess(max(prompt_requests), first_history)
+
+    def test_failed_workflow_does_not_sink_the_batch(self):
+        with FakeComfyUI() as fake:
+            result, _ = self.run_handler(
+                fake,
+                {
+                    "workflows": [
+                        self.workflow(seed=1),
+                        self.workflow("FakeError"),
+                        self.workflow(seed=2),
+                    ]
+                },
+            )
+
+        self.assertEqual(result["status"], "partial")
+        self.assertNotIn("error", result)
+        statuses = [r.get("status") for r in result["results"]]
+        self.assertEqual(statuses, ["success", None, "success"])
+        self.assertIn("fake failure", result["results"][1]["error"])
+
+    def test_failed_output_processing_is_a_workflow_error(self):
+        def process_output_images(outputs, job_id, inline_budget=None):
+            raise KeyError("filename")
+
+        for workflows in ([self.workflow()], [self.workflow(seed=1), self.workflow()]):
+            with self.subTest(
+                workflows=len(workflows)
+            ), FakeComfyUI() as fake, patch.object(
+                rp_handler, "COMFY_HOST", fake.host
+            ), patch.object(
+                rp_handler, "process_output_images", side_effect=process_output_images
+            ):
+                job_input = (
+                    {"workflow": workflows[0]}
+                    if len(workflows) == 1
+                    else {"workflows": workflows}
+                )
+                result = rp_handler.handler({"id": "123", "input": job_input})
+
+                if len(workflows) == 1:
+                    self.assertIn("Error processing the outputs", result["error"])
+                else:
+                    self.assertEqual(result["status"], "error")
+                    for workflow_result in result["results"]:
+                        self.assertIn("'filename'", workflow_result["error"])
+
+    def test_batch_without_websocket(self):
+        with FakeComfyUI(refuse_websocket=True) as fake, patch.object(
+            rp_handler, "COMFY_POLLING_INTERVAL_MS", 10
+        ):
+            result, _ = self.run_handler(
+                fake, {"workflows": [self.workflow(seed=i) for i in range(2)]}
+            )
+
+        self.assertEqual(result["status"], "success")
+        self.assertEqual(len(result["results"]), 2)
+
+    def test_invalid_workflows(self):
+        _, error = rp_handler.validate_input({"workflows": []})
+        self.assertEqual(error, "'workflows' must be a non-empty list of workflows")
+
+        _, error = rp_handler.validate_input(
+            {"workflow": {"key": "value"}, "workflows": [{"key": "value"}]}
+        )
+        self.assertEqual(error, "Provide either 'workflow' or 'workflows', not both")
+
+
+class TestProcessOutputImages(unittest.TestCase):
+    outputs = {
+        "9": {
+            "images": [
+                {"filename": "ComfyUI_00001_.png", "subfolder": "", "type": "output"},
+                {
+                    "filename": "ComfyUI_00001_.png",
+                    "subfolder": "test",
+                    "type": "output",
+                },
+            ]
+        },
+        "10": {
+            "images": [{"filename": "preview.png", "subfolder": "", "type": "temp"}],
+        },
+        "12": {
+            "gifs": [
+                {"filename": "ComfyUI_00001_.png", "subfolder": "", "type": "output"}
+            ]
+        },
+    }
+
+    @patch.dict(
+        os.environ, {"COMFY_OUTPUT_PATH": RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES}
+    )
+    def test_returns_every_output_per_node(self):
+        result = rp_handler.process_output_images(self.outputs, "123")
+
+        with open(
+            f"{RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES}/ComfyUI_00001_.png", "rb"
+        ) as f:
+            expected = base64.b64encode(f.read()).decode("utf-8")
+
+        self.assertEqual(result["status"], "success")
+        self.assertEqual(result["message"], expected)
+        self.assertEqual(list(result["outputs"].keys()), ["9", "12"])
+        self.assertEqual(
+            [(o["subfolder"], o["type"], o["kind"]) for o in result["outputs"]["9"]],
+            [("", "base64", "images"), ("test", "base64", "images")],
+        )
+        self.assertEqual(result["outputs"]["12"][0]["kind"], "gifs")
+        self.assertNotIn("errors", result)
+
+    @patch.dict(
+        os.environ, {"COMFY_OUTPUT_PATH": RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES}
+    )
+    def test_reports_missing_files_next_to_the_others(self):
+        outputs = {
+            "9": {
+                "images": [
+                    {"filename": "ComfyUI_00001_.png", "subfolder": ""},
+                    {"filename": "missing.png", "subfolder": ""},
+                ]
+            }
+        }
+        result = rp_handler.process_output_images(outputs, "123")
+
+        self.assertEqual(result["status"], "success")
+        self.assertEqual(len(result["outputs"]["9"]), 1)
+        self.assertEqual(len(result["errors"]), 1)
+        self.assertIn("missing.png", result["errors"][0])
+
+    @patch.dict(
+        os.environ, {"COMFY_OUTPUT_PATH": RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES}
+    )
+    def test_error_without_outputs(self):
+        result = rp_handler.process_output_images({"9": {"images": []}}, "123")
+
+        self.assertEqual(result["status"], "error")
+
+    @patch("rp_handler.rp_upload.upload_image")
+    @patch.dict(
+        os.environ,
+        {
+            "COMFY_OUTPUT_PATH": RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES,
+            "BUCKET_ENDPOINT_URL": "http://example.com",
+        },
+    )
+    def test_uploads_run_concurrently(self, mock_upload_image):
+        def slow_upload(job_id, path):
+            time.sleep(0.2)
+            return f"http://example.com/{path}"
+
+        mock_upload_image.side_effect = slow_upload
+        outputs = {
+            "9": {
+                "images": [
+                    {"filename": "ComfyUI_00001_.png", "subfolder": ""}
+                    for _ in range(8)
+                ]
+            }
+        }
+
+        start = time.monotonic()
+        result = rp_handler.process_output_images(outputs, "123")
+        duration = time.monotonic() - start
+
+        self.assertEqual(len(result["outputs"]["9"]), 8)
+        self.assertEqual(result["outputs"]["9"][0]["type"], "s3_url")
+        self.assertEqual(mock_upload_image.call_count, 8)
+        self.assertLess(duration, 0.2 * 4)
+
+
+class TestComfySession(unittest.TestCase):
+    def test_connections_are_reused_between_requests(self):
+        with FakeComfyUI() as fake, patch.object(rp_handler, "COMFY_HOST", fake.host):
+            for _ in range(5):
+                rp_handler.get_history("123")
+            connections = fake.connections
+
+        self.assertEqual(connections, 1)
+
+    def test_retries_when_connection_fails(self):
+        with FakeComfyUI() as fake:
+            host = fake.host
+        # The server is stopped, so every connection attempt is refused
+        with patch.object(rp_handler, "COMFY_HOST", host), patch(
+            "urllib3.util.retry.Retry.sleep"
+        ) as mock_sleep:
+            with self.assertRaises(rp_handler.requests.ConnectionError):
+                rp_handler.get_history("123")
+
+        self.assertEqual(mock_sleep.call_count, rp_handler.COMFY_HTTP_RETRIES)
+
+
+class TestComfyReadiness(unittest.TestCase):
+    def setUp(self):
+        patcher = patch.dict(rp_handler.comfy_state, {"last_healthy": None})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_waits_for_comfy_when_it_was_never_ready(self):
+        with FakeComfyUI() as fake, patch.object(rp_handler, "COMFY_HOST", fake.host):
+            self.assertTrue(rp_handler.ensure_comfy_available())
+            self.assertEqual(fake.count("GET", "/system_stats"), 1)
+
+    def test_no_request_when_comfy_was_healthy_recently(self):
+        rp_handler.comfy_state["last_healthy"] = time.monotonic()
+        with FakeComfyUI() as fake, patch.object(rp_handler, "COMFY_HOST", fake.host):
+            self.assertTrue(rp_handler.ensure_comfy_available())
+            self.assertEqual(fake.requests, [])
+
+    def test_liveness_check_when_stale(self):
+        rp_handler.comfy_state["last_healthy"] = 0
+        with FakeComfyUI() as fake, patch.object(rp_handler, "COMFY_HOST", fake.host):
+            self.assertTrue(rp_handler.ensure_comfy_available())
+            self.assertEqual(fake.count("GET", "/system_stats"), 1)
+        self.assertGreater(rp_handler.comfy_state["last_healthy"], 0)
+
+    @patch("urllib3.util.retry.Retry.sleep")
+    def test_stale_and_unreachable_comfy_fails_fast(self, mock_sleep):
+        rp_handler.comfy_state["last_healthy"] = 0
+        with FakeComfyUI() as fake:
+            host = fake.host
+        with patch.object(rp_handler, "COMFY_HOST", host):
+            result = rp_handler.handler(
+                {"id": "123", "input": {"workflow": {"9": {"inputs": {}}}}}
+            )
+        self.assertEqual(result, {"error": rp_handler.COMFY_UNAVAILABLE_ERROR})
+
+    def test_comfy_dies_during_the_job(self):
+        fake = FakeComfyUI(render_time=0.2).start()
+        rp_handler.comfy_state["last_healthy"] = time.monotonic()
+        threading.Timer(0.1, fake.stop).start()
+        with patch.object(rp_handler, "COMFY_HOST", fake.host), patch(
+            "urllib3.util.retry.Retry.sleep"
+        ):
+            result = rp_handler.handler(
+                {
+                    "id": "123",
+                    "input": {
+                        "workflow": {"9": {"inputs": {}, "class_type": "SaveImage"}}
+                    },
+                }
+            )
+        self.assertEqual(result, {"error": rp_handler.COMFY_UNAVAILABLE_ERROR})
+        self.assertEqual(rp_handler.comfy_state["last_healthy"], 0)
+
+
+class TestUploadImages(unittest.TestCase):
+    def test_detect_mime_type(self):
+        with open(
+            f"{RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES}/ComfyUI_00001_.png", "rb"
+        ) as f:
+            self.assertEqual(rp_handler.detect_mime_type(f.read()), "image/png")
+        self.assertEqual(rp_handler.detect_mime_type(b"\xff\xd8\xff\xe0"), "image/jpeg")
+        self.assertEqual(
+            rp_handler.detect_mime_type(b"RIFF\x00\x00\x00\x00WEBPVP8 "), "image/webp"
+        )
+        self.assertEqual(
+            rp_handler.detect_mime_type(b"unknown"), "application/octet-stream"
+        )
+
+    @patch.object(rp_handler.comfy_session, "request")
+    def test_uploads_run_concurrently_with_detected_mime_type(self, mock_request):
+        def slow_upload(method, url, files, timeout):
+            time.sleep(0.2)
+            return MagicMock(status_code=200)
+
+        mock_request.side_effect = slow_upload
+        images = [
+            {"name": f"image{i}.jpg", "blob": b"\xff\xd8\xff\xe0" + bytes([i])}
+            for i in range(4)
+        ]
+
+        start = time.monotonic()
+        with patch.object(rp_handler, "INPUT_UPLOAD_MAX_WORKERS", 4):
+            result = rp_handler.upload_images(images)
+        duration = time.monotonic() - start
+
+        self.assertEqual(result["status"], "success")
+        self.assertEqual(mock_request.call_count, 4)
+        self.assertLess(duration, 0.2 * 2)
+        name, _, mime_type = mock_request.call_args.kwargs["files"]["image"]
+        self.assertEqual(mime_type, "image/jpeg")
+
+    @patch.object(rp_handler.comfy_session, "request")
+    def test_skips_images_that_comfy_already_has(self, mock_request):
+        mock_request.return_value = MagicMock(status_code=200)
+        with tempfile.TemporaryDirectory() as input_path, patch.dict(
+            os.environ, {"COMFY_INPUT_PATH": input_path}
+        ):
+            with open(os.path.join(input_path, "same.png"), "wb") as f:
+                f.write(b"same content")
+            with open(os.path.join(input_path, "changed.png"), "wb") as f:
+                f.write(b"old content")
+
+            result = rp_handler.upload_images(
+                [
+                    {"name": "same.png", "blob": b"same content"},
+                    {"name": "changed.png", "blob": b"new content"},
+                    {"name": "new.png", "blob": b"new content"},
+                ]
+            )
+
+        self.assertEqual(result["status"], "success")
+        self.assertIn("Skipped same.png, it is already uploaded", result["details"])
+        uploaded = [c.kwargs["files"]["image"][0] for c in mock_request.call_args_list]
+        self.assertEqual(sorted(uploaded), ["changed.png", "new.png"])
+
+
+class TestResultCache(unittest.TestCase):
+    workflow = {"9": {"inputs": {"seed": 1}, "class_type": "SaveImage"}}
+
+    def run_handler(self, fake, job_input):
+        with patch.object(rp_handler, "COMFY_HOST", fake.host), patch.object(
+            rp_handler,
+            "process_output_images",
+            return_value={"status": "success", "message": "image"},
+        ) as mock_process:
+            result = rp_handler.handler({"id": "123", "input": job_input})
+        return result, mock_process
+
+    def test_identical_job_returns_cached_result_without_comfy(self):
+        with tempfile.TemporaryDirectory() as path, patch.object(
+            rp_handler, "result_cache", ResultCache(path, 1024**2, 60)
+        ), FakeComfyUI() as fake:
+            first, _ = self.run_handler(fake, {"workflow": self.workflow})
+            requests_after_first_job = len(fake.requests)
+            second, mock_process = self.run_handler(fake, {"workflow": self.workflow})
+
+            self.assertNotIn("cached", first)
+            self.assertEqual(second["message"], "image")
+            self.assertTrue(second["cached"])
+            mock_process.assert_not_called()
+            self.assertEqual(len(fake.requests), requests_after_first_job)
+
+    def test_cache_can_be_skipped_per_job(self):
+        with tempfile.TemporaryDirectory() as path, patch.object(
+            rp_handler, "result_cache", ResultCache(path, 1024**2, 60)
+        ), FakeComfyUI() as fake:
+            self.run_handler(fake, {"workflow": self.workflow})
+            result, mock_process = self.run_handler(
+                fake, {"workflow": self.workflow, "cache": False}
+            )
+
+            self.assertNotIn("cached", result)
+            mock_process.assert_called_once()
+
+
+class TestStreaming(unittest.TestCase):
+    workflow = {
+        "3": {"inputs": {"steps": 4}, "class_type": "KSampler"},
+        "9": {"inputs": {}, "class_type": "SaveImage"},
+        "10": {"inputs": {}, "class_type": "SaveImage"},
+    }
+
+    def setUp(self):
+        self.output_path = tempfile.TemporaryDirectory()
+        for node_id in ("9", "10"):
+            with open(f"{self.output_path.name}/ComfyUI_{node_id}_.png", "wb") as f:
+                f.write(b"image " + node_id.encode("utf-8"))
+
+    def tearDown(self):
+        self.output_path.cleanup()
+
+    def stream(self, fake, job_input):
+        with patch.object(rp_handler, "COMFY_HOST", fake.host), patch.dict(
+            os.environ, {"COMFY_OUTPUT_PATH": self.output_path.name}
+        ):
+            return list(rp_handler.handler_stream({"id": "123", "input": job_input}))
+
+    def test_yields_progress_and_outputs_while_running(self):
+        with FakeComfyUI(render_time=0.05) as fake:
+            events = self.stream(fake, {"workflow": self.workflow})
+
+        types = [event["type"] for event in events]
+        self.assertEqual(types[0], "queued")
+        self.assertEqual(types.count("progress"), 4)
+        self.assertNotIn("preview", types)
+        self.assertEqual(
+            [event["value"] for event in events if event["type"] == "progress"],
+            [1, 2, 3, 4],
+        )
+        outputs = [event for event in events if event["type"] == "output"]
+        self.assertEqual([event["node_id"] for event in outputs], ["9", "10"])
+        self.assertEqual(base64.b64decode(outputs[0]["files"][0]["data"]), b"image 9")
+        # The outputs are not sent a second time with the result
+        self.assertEqual(events[-1]["type"], "result")
+        self.assertEqual(events[-1]["status"], "success")
+        self.assertNotIn("outputs", events[-1])
+
+    def test_previews_are_optional_and_throttled(self):
+        with FakeComfyUI(render_time=0.05) as fake, patch.object(
+            rp_handler, "STREAM_PREVIEW_INTERVAL_MS", 0
+        ):
+            events = self.stream(fake, {"workflow": self.workflow, "previews": True})
+
+        previews = [event for event in events if event["type"] == "preview"]
+        self.assertEqual(len(previews), 4)
+        self.assertEqual(previews[0]["format"], "png")
+        self.assertEqual(base64.b64decode(previews[0]["image"]), b"preview 1")
+
+        with FakeComfyUI(render_time=0.05) as fake, patch.object(
+            rp_handler, "STREAM_PREVIEW_INTERVAL_MS", 60000
+        ):
+            events = self.stream(fake, {"workflow": self.workflow, "previews": True})
+
+        previews = [event for event in events if event["type"] == "preview"]
+        self.assertEqual(len(previews), 1)
+
+    def test_outputs_are_delivered_from_history_when_websocket_drops(self):
+        with FakeComfyUI(drop_websocket=True) as fake, patch.object(
+            rp_handler, "COMFY_POLLING_INTERVAL_MS", 10
+        ):
+            events = self.stream(fake, {"workflow": self.workflow})
+
+        outputs = [event for event in events if event["type"] == "output"]
+        self.assertEqual(sorted(event["node_id"] for event in outputs), ["10", "9"])
+        self.assertEqual(events[-1]["status"], "success")
+
+    def test_execution_error(self):
+        with FakeComfyUI(execution_error=True) as fake:
+            events = self.stream(fake, {"workflow": self.workflow})
+
+        self.assertEqual(events[-1]["type"], "error")
+        self.assertIn("fake failure", events[-1]["error"])
+
+    def test_invalid_input(self):
+        events = list(rp_handler.handler_stream({"id": "123", "input": {}}))
+
+        self.assertEqual(
+            events, [{"type": "error", "error": "Missing 'workflow' parameter"}]
+        )
+
+    def test_batch_yields_every_workflow_when_done(self):
+        with FakeComfyUI() as fake:
+            events = self.stream(
+                fake,
+                {"workflows": [self.workflow, {"9": {"class_type": "FakeError"}}]},
+            )
+
+        results = {event["index"]: event for event in events[:-1]}
+        self.assertEqual(results[0]["status"], "success")
+        self.assertIn("fake failure", results[1]["error"])
+        self.assertEqual(events[-1]["type"], "done")
+        self.assertEqual(events[-1]["status"], "partial")
+
+
+class TestConcurrency(unittest.TestCase):
+    workflow = {"9": {"inputs": {}, "class_type": "SaveImage"}}
+
+    def setUp(self):
+        patcher = patch.dict(
+            rp_handler.concurrency_state,
+            {"running": 0, "target": 1, "checked_at": None},
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def adjust(self, fake):
+        rp_handler.concurrency_state["checked_at"] = None
+        with patch.object(rp_handler, "COMFY_HOST", fake.host), patch.object(
+            rp_handler, "MAX_CONCURRENCY", 3
+        ):
+            return rp_handler.adjust_concurrency()
+
+    def test_concurrency_follows_queue_depth_and_free_vram(self):
+        with FakeComfyUI() as fake:
+            self.assertEqual(self.adjust(fake), 3)
+
+            # Prompts are waiting, so keep the jobs that are running
+            fake.pending = ["a", "b"]
+            rp_handler.concurrency_state["running"] = 2
+            self.assertEqual(self.adjust(fake), 2)
+            fake.pending = []
+
+            fake.vram_free = 512 * 1024**2
+            self.assertEqual(self.adjust(fake), 1)
+
+    def test_single_job_when_comfy_is_unreachable(self):
+        with FakeComfyUI() as fake:
+            pass
+        with patch("urllib3.util.retry.Retry.sleep"):
+            self.assertEqual(self.adjust(fake), 1)
+
+    def test_state_of_comfy_is_reused_within_the_interval(self):
+        with FakeComfyUI() as fake, patch.object(
+            rp_handler, "COMFY_HOST", fake.host
+        ), patch.object(rp_handler, "MAX_CONCURRENCY", 3):
+            self.assertEqual(rp_handler.adjust_concurrency(), 3)
+            self.assertEqual(rp_handler.concurrency_modifier(1), 3)
+            self.assertEqual(fake.count("GET", "/queue"), 1)
+
+    def test_no_concurrency_with_refresh_worker(self):
+        with patch.object(rp_handler, "REFRESH_WORKER", True):
+            self.assertEqual(rp_handler.adjust_concurrency(), 1)
+
+    def test_single_jobs_run_without_concurrency_modifier(self):
+        with patch.object(rp_handler, "MAX_CONCURRENCY", 1):
+            self.assertEqual(
+                rp_handler.serverless_config(), {"handler": rp_handler.handler}
+            )
+        with patch.object(rp_handler, "MAX_CONCURRENCY", 3), patch.object(
+            rp_handler, "REFRESH_WORKER", True
+        ):
+            self.assertNotIn("concurrency_modifier", rp_handler.serverless_config())
+        with patch.object(rp_handler, "MAX_CONCURRENCY", 3):
+            config = rp_handler.serverless_config()
+        self.assertEqual(config["handler"], rp_handler.async_handler)
+        self.assertEqual(
+            config["concurrency_modifier"], rp_handler.concurrency_modifier
+        )
+
+    def test_runpod_asks_the_concurrency_modifier(self):
+        from runpod.serverless.modules.rp_scale import JobScaler
+
+        with patch.object(rp_handler, "MAX_CONCURRENCY", 3):
+            config = rp_handler.serverless_config()
+        # runpod.serverless.worker.run_worker creates the JobScaler like this
+        job_scaler = JobScaler(concurrency_modifier=config["concurrency_modifier"])
+        self.assertIs(job_scaler.concurrency_modifier, rp_handler.concurrency_modifier)
+
+    def test_streaming_refreshes_the_worker_through_the_config(self):
+        with patch.object(rp_handler, "STREAM_OUTPUT", True), patch.object(
+            rp_handler, "REFRESH_WORKER", True
+        ):
+            config = rp_handler.serverless_config()
+        self.assertEqual(
+            config,
+            {
+                "handler": rp_handler.handler_stream,
+                "return_aggregate_stream": True,
+                "refresh_worker": True,
+            },
+        )
+
+    def test_same_image_name_waits_for_the_other_job(self):
+        first = [{"name": "input.png", "sha256": "a" * 64}]
+        same = [{"name": "input.png", "sha256": "a" * 64}]
+        different = [{"name": "input.png", "sha256": "b" * 64}]
+        acquired = threading.Event()
+
+        rp_handler.acquire_input_names(first)
+        # The same image can be shared right away
+        rp_handler.acquire_input_names(same)
+        rp_handler.release_input_names(same)
+
+        def acquire_different():
+            rp_handler.acquire_input_names(different)
+            acquired.set()
+
+        thread = threading.Thread(target=acquire_different)
+        thread.start()
+        self.assertFalse(acquired.wait(0.1))
+        rp_handler.release_input_names(first)
+        self.assertTrue(acquired.wait(1))
+        rp_handler.release_input_names(different)
+        thread.join()
+        self.assertEqual(rp_handler.input_names_in_use, {})
+
+    def test_waiting_for_an_image_name_times_out(self):
+        first = [{"name": "input.png", "sha256": "a" * 64}]
+        different = [{"name": "input.png", "sha256": "b" * 64}]
+
+        rp_handler.acquire_input_names(first)
+        self.assertFalse(rp_handler.acquire_input_names(different, 0.05))
+        rp_handler.release_input_names(first)
+        self.assertEqual(rp_handler.input_names_in_use, {})
+
+    def run_failing_upload(self, request):
+        """Run a job whose upload fails and return its response or exception"""
+        workflow = {
+            "1": {"inputs": {"image": "mask.png"}, "class_type": "LoadImage"},
+            "9": {"inputs": {"images": ["1", 0]}, "class_type": "SaveImage"},
+        }
+        job_input = {
+            "workflow": workflow,
+            "images": [
+                {
+                    "name": "mask.png",
+                    "image": base64.b64encode(png_image(8, 8)).decode(),
+                }
+            ],
+        }
+        send = rp_handler.comfy_session.request
+
+        def fail_upload(method, url, **kwargs):
+            if url.endswith("/upload/image"):
+                return request()
+            return send(method, url, **kwargs)
+
+        with tempfile.TemporaryDirectory() as folder, FakeComfyUI() as fake, patch.object(
+            rp_handler, "COMFY_HOST", fake.host
+        ), patch.object(
+            rp_handler, "file_cleanup", FileCleanup([folder], 0, 0, 0)
+        ), patch.object(
+            rp_handler.comfy_session, "request", side_effect=fail_upload
+        ), patch.dict(
+            os.environ, {"COMFY_INPUT_PATH": folder}
+        ):
+            try:
+                result = rp_handler.handler({"id": "1", "input": job_input})
+            except Exception as e:
+                result = e
+            self.assertEqual(rp_handler.file_cleanup.jobs, {})
+            self.assertEqual(rp_handler.file_cleanup.protected, {})
+        self.assertEqual(rp_handler.input_names_in_use, {})
+        self.assertNotIn("1", rp_handler.model_residency.jobs)
+        return result
+
+    def test_upload_timeout_is_a_job_error(self):
+        def timeout():
+            raise requests.ReadTimeout("read timed out")
+
+        result = self.run_failing_upload(timeout)
+
+        self.assertEqual(result["status"], "error")
+        self.assertEqual(
+            result["details"], ["Error uploading mask.png: read timed out"]
+        )
+
+    def test_unexpected_upload_error_releases_the_job(self):
+        def crash():
+            raise RuntimeError("crash")
+
+        result = self.run_failing_upload(crash)
+
+        self.assertIsInstance(result, RuntimeError)
+
+    def test_outputs_are_delivered_while_the_next_job_renders(self):
+        busy_while_delivering = []
+
+        def process_output_images(outputs, job_id, inline_budget=None):
+            time.sleep(0.1)
+            with fake.lock:
+                busy_while_delivering.append(
+                    fake.running is not None or bool(fake.pending)
+                )
+            return {"status": "success", "message": job_id}
+
+        async def run_jobs():
+            return await asyncio.gather(
+                *(
+                    rp_handler.async_handler(
+                        {"id": str(i), "input": {"workflow": self.workflow}}
+                    )
+                    for i in range(2)
+                )
+            )
+
+        with FakeComfyUI(render_time=0.2) as fake, patch.object(
+            rp_handler, "COMFY_HOST", fake.host
+        ), patch.object(
+            rp_handler, "process_output_images", side_effect=process_output_images
+        ):
+            results = asyncio.run(run_jobs())
+
+        self.assertEqual([result["message"] for result in results], ["0", "1"])
+        # The first job delivered its outputs while the second one was rendering
+        self.assertIn(True, busy_while_delivering)
+        self.assertEqual(rp_handler.concurrency_state["running"], 0)
+
+
+class TestMetrics(unittest.TestCase):
+    workflow = {
+        "3": {"inputs": {"steps": 2}, "class_type": "KSampler"},
+        "9": {"inputs": {}, "class_type": "SaveImage"},
+    }
+
+    def run_handler(self, fake, job_input):
+        with patch.object(rp_handler, "COMFY_HOST", fake.host), patch.object(
+            rp_handler,
+            "process_output_images",
+            return_value={"status": "success", "message": "image"},
+        ):
+            return rp_handler.handler({"id": "123", "input": job_input})
+
+    def test_metrics_are_only_returned_when_requested(self):
+        with FakeComfyUI(render_time=0.02) as fake:
+            result = self.run_handler(fake, {"workflow": self.workflow})
+            self.assertNotIn("metrics", result)
+
+            result = self.run_handler(
+                fake, {"workflow": self.workflow, "metrics": True}
+            )
+
+        metrics = result["metrics"]
+        self.assertEqual(metrics["job_id"], "123")
+        self.assertEqual(
+            set(metrics["phases"]),
+            {
+                "validate",
+                "comfy_check",
+                "schema",
+                "models",
+                "input_names",
+                "upload",
+                "queue",
+                "outputs",
+            },
+        )
+        (prompt,) = metrics["prompts"].values()
+        # The timings depend on the load of the machine, only check that they are sane
+        self.assertGreater(prompt["execution_ms"], 0)
+        self.assertLess(prompt["execution_ms"], 10000)
+        self.assertEqual(prompt["nodes"]["3"]["class_type"], "KSampler")
+        self.assertGreater(prompt["nodes"]["3"]["ms"], 0)
+        self.assertLessEqual(prompt["nodes"]["3"]["ms"], prompt["execution_ms"])
+
+    def test_metrics_are_logged_and_written_for_prometheus(self):
+        with tempfile.TemporaryDirectory() as path, patch.object(
+            rp_handler,
+            "prometheus_metrics",
+            PrometheusTextFile(os.path.join(path, "comfy.prom")),
+        ), FakeComfyUI() as fake, patch("builtins.print") as mock_print:
+            self.run_handler(fake, {"workflow": self.workflow})
+
+            with open(os.path.join(path, "comfy.prom")) as f:
+                text = f.read()
+
+        self.assertIn('runpod_worker_comfy_jobs_total{status="success"} 1', text)
+        logged = [
+            call.args[0]
+            for call in mock_print.call_args_list
+            if call.args
+            and str(call.args[0]).startswith("runpod-worker-comfy - metrics ")
+        ]
+        self.assertEqual(len(logged), 1)
+        self.assertEqual(
+            json.loads(logged[0][len("runpod-worker-comfy - metrics ") :])["job_id"],
+            "123",
+        )
+
+    def test_streamed_result_contains_metrics(self):
+        with FakeComfyUI() as fake, patch.object(rp_handler, "COMFY_HOST", fake.host):
+            events = list(
+                rp_handler.handler_stream(
+                    {"id": "123", "input": {"workflow": {}, "metrics": True}}
+                )
+            )
+
+        # The empty workflow doesn't produce any output
+        self.assertEqual(events[-1]["status"], "error")
+        self.assertEqual(events[-1]["metrics"]["job_id"], "123")
+
+    def test_invalid_metrics(self):
+        _, error = rp_handler.validate_input({"workflow": {}, "metrics": "yes"})
+        self.assertEqual(error, "'metrics' must be a boolean")
+
+
+class TestWarmUp(unittest.TestCase):
+    def write_workflow(self, path, data):
+        with open(os.path.join(path, "warmup.json"), "w") as f:
+            json.dump(data, f)
+        return os.path.join(path, "warmup.json")
+
+    def test_runs_a_cheap_copy_of_the_workflow(self):
+        with open("test_input.json") as f:
+            job = json.load(f)
+
+        with tempfile.TemporaryDirectory() as path, FakeComfyUI() as fake, patch.object(
+            rp_handler, "COMFY_HOST", fake.host
+        ):
+            duration, error = rp_handler.warm_up(self.write_workflow(path, job))
+
+            (entry,) = fake.history.values()
+
+        self.assertIsNone(error)
+        self.assertGreater(duration, 0)
+        workflow = entry["prompt"][2]
+        self.assertEqual(workflow["3"]["inputs"]["steps"], 1)
+        self.assertEqual(workflow["9"]["class_type"], "PreviewImage")
+        # The declared workflow itself is not changed
+        self.assertEqual(job["input"]["workflow"]["3"]["inputs"]["steps"], 20)
+
+    def test_accepts_a_plain_workflow(self):
+        workflow = {"3": {"inputs": {"steps": 4}, "class_type": "KSampler"}}
+        with tempfile.TemporaryDirectory() as path, FakeComfyUI() as fake, patch.object(
+            rp_handler, "COMFY_HOST", fake.host
+        ), patch.object(rp_handler, "WARMUP_STEPS", 0):
+            _, error = rp_handler.warm_up(self.write_workflow(path, workflow))
+
+            (entry,) = fake.history.values()
+
+        self.assertIsNone(error)
+        self.assertEqual(entry["prompt"][2]["3"]["inputs"]["steps"], 4)
+
+    def test_failed_warm_up_is_reported(self):
+        _, error = rp_handler.warm_up("/does/not/exist.json")
+        self.assertIn("Could not read the warm-up workflow", error)
+
+        workflow = {"3": {"inputs": {}, "class_type": "FakeError"}}
+        with tempfile.TemporaryDirectory() as path, FakeComfyUI() as fake, patch.object(
+            rp_handler, "COMFY_HOST", fake.host
+        ), patch.object(
+            rp_handler, "prometheus_metrics", PrometheusTextFile(f"{path}/comfy.prom")
+        ):
+            _, error = rp_handler.warm_up(self.write_workflow(path, workflow))
+
+            with open(f"{path}/comfy.prom") as f:
+                text = f.read()
+
+        self.assertIn("fake failure", error)
+        self.assertIn('runpod_worker_comfy_warmup_seconds{status="error"}', text)
+
+
+class TestOutputTransport(unittest.TestCase):
+    outputs = {
+        "9": {
+            "images": [
+                {"filename": "ComfyUI_00001_.png", "subfolder": "", "type": "output"}
+            ]
+        }
+    }
+
+    @patch.dict(
+        os.environ, {"COMFY_OUTPUT_PATH": RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES}
+    )
+    def test_big_outputs_are_not_inlined(self):
+        with patch.object(rp_handler, "OUTPUT_INLINE_MAX_BYTES", 1024):
+            result = rp_handler.process_output_images(self.outputs, "123")
+
+        self.assertEqual(result["status"], "error")
+        self.assertIn("more than OUTPUT_INLINE_MAX_BYTES (1024)", result["message"])
+
+    @patch("rp_handler.output_transport.upload_file")
+    @patch.dict(
+        os.environ,
+        {
+            "COMFY_OUTPUT_PATH": RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES,
+            "BUCKET_ENDPOINT_URL": "http://example.com",
+        },
+    )
+    def test_small_outputs_are_uploaded_with_a_bucket(self, mock_upload_file):
+        mock_upload_file.return_value = "http://example.com/image.png"
+
+        with patch.object(rp_handler, "OUTPUT_INLINE_MAX_BYTES", 1024**2):
+            result = rp_handler.process_output_images(self.outputs, "123")
+
+        self.assertEqual(result["outputs"]["9"][0]["type"], "s3_url")
+        mock_upload_file.assert_called_once()
+
+    def two_outputs(self):
+        image = self.outputs["9"]["images"][0]
+        return {"9": {"images": [image, {**image, "subfolder": "test"}]}}
+
+    @patch.dict(
+        os.environ, {"COMFY_OUTPUT_PATH": RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES}
+    )
+    def test_outputs_of_a_job_are_only_inlined_up_to_the_total(self):
+        size = os.path.getsize(
+            os.path.join(
+                RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES, "ComfyUI_00001_.png"
+            )
+        )
+        inline_budget = rp_handler.output_transport.InlineBudget(size)
+
+        with patch.object(rp_handler, "OUTPUT_INLINE_TOTAL_MAX_BYTES", size):
+            result = rp_handler.process_output_images(
+                self.two_outputs(), "123", inline_budget
+            )
+
+        self.assertEqual(result["status"], "success")
+        self.assertEqual(len(result["outputs"]["9"]), 1)
+        self.assertEqual(result["outputs"]["9"][0]["type"], "base64")
+        self.assertEqual(len(result["errors"]), 1)
+        self.assertIn(
+            f"more than OUTPUT_INLINE_TOTAL_MAX_BYTES ({size})", result["errors"][0]
+        )
+
+    @patch("rp_handler.output_transport.upload_file")
+    @patch.dict(
+        os.environ,
+        {
+            "COMFY_OUTPUT_PATH": RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES,
+            "BUCKET_ENDPOINT_URL": "http://example.com",
+        },
+    )
+    def test_outputs_over_the_total_are_uploaded_with_a_bucket(self, mock_upload_file):
+        mock_upload_file.return_value = "http://example.com/image.png"
+        size = os.path.getsize(
+            os.path.join(
+                RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES, "ComfyUI_00001_.png"
+            )
+        )
+        inline_budget = rp_handler.output_transport.InlineBudget(size)
+
+        result = rp_handler.process_output_images(
+            self.two_outputs(), "123", inline_budget
+        )
+
+        types = [output["type"] for output in result["outputs"]["9"]]
+        self.assertEqual(types, ["s3_url", "s3_url"])
+        self.assertNotIn("errors", result)
+
+    @unittest.skipIf(
+        rp_handler.output_transport.Image is None, "Pillow is not installed"
+    )
+    @patch.dict(
+        os.environ, {"COMFY_OUTPUT_PATH": RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES}
+    )
+    def test_images_are_reencoded(self):
+        reencoded_paths = []
+        reencode_image = rp_handler.output_transport.reencode_image
+
+        def track_reencode_image(*args):
+            reencoded_paths.append(reencode_image(*args))
+            return reencoded_paths[-1]
+
+        with patch.object(rp_handler, "OUTPUT_IMAGE_FORMAT", "webp"), patch.object(
+            rp_handler.output_transport,
+            "reencode_image",
+            side_effect=track_reencode_image,
+        ):
+            result = rp_handler.process_output_images(self.outputs, "123")
+
+        output = result["outputs"]["9"][0]
+        self.assertEqual(output["filename"], "ComfyUI_00001_.webp")
+        self.assertEqual(base64.b64decode(output["data"])[8:12], b"WEBP")
+        # The re-encoded file is removed once it was delivered
+        self.assertFalse(os.path.exists(reencoded_paths[0]))
+
+
+class TestWorkflowValidation(unittest.TestCase):
+    def setUp(self):
+        self.workflow = copy.deepcopy(WORKFLOW)
+        self.workflow["3"]["inputs"]["steps"] = 2
+
+    def run_handler(self, fake, job_input):
+        with patch.object(rp_handler, "COMFY_HOST", fake.host), patch.object(
+            rp_handler,
+            "workflow_schema",
+            WorkflowSchema(rp_handler.get_object_info, 0),
+        ), patch.object(
+            rp_handler, "process_output_images", return_value={"status": "success"}
+        ):
+            return rp_handler.handler({"id": "123", "input": job_input})
+
+    def test_invalid_workflow_is_never_queued(self):
+        self.workflow["4"]["inputs"]["ckpt_name"] = "missing.safetensors"
+        with FakeComfyUI(object_info=OBJECT_INFO) as fake:
+            result = self.run_handler(fake, {"workflow": self.workflow})
+
+        self.assertTrue(result["error"].startswith("Invalid workflow: Node 4"))
+        self.assertEqual(fake.count("POST", "/prompt"), 0)
+        # The schema was fetched again, in case the model was just added
+        self.assertEqual(fake.count("GET", "/object_info"), 2)
+
+    def test_invalid_workflow_does_not_sink_the_batch(self):
+        invalid_workflow = copy.deepcopy(self.workflow)
+        del invalid_workflow["9"]["inputs"]["images"]
+        with FakeComfyUI(object_info=OBJECT_INFO) as fake:
+            result = self.run_handler(
+                fake, {"workflows": [self.workflow, invalid_workflow]}
+            )
+
+        self.assertEqual(result["status"], "partial")
+        self.assertEqual(result["results"][0]["status"], "success")
+        self.assertEqual(
+            result["results"][1]["error"],
+            "Invalid workflow: Node 9 (SaveImage): missing required input 'images'",
+        )
+        self.assertEqual(fake.count("POST", "/prompt"), 1)
+
+    def test_validation_is_skipped_without_schema(self):
+        with FakeComfyUI(object_info=OBJECT_INFO) as fake, patch.object(
+            rp_handler, "get_object_info", side_effect=requests.ConnectionError()
+        ):
+            result = self.run_handler(fake, {"workflow": {"9": {"class_type": "X"}}})
+
+        self.assertEqual(result["status"], "success")
+        self.assertEqual(fake.count("POST", "/prompt"), 1)
+
+
+class TestDeadline(unittest.TestCase):
+    stalling_workflow = {
+        "3": {"inputs": {"steps": 2}, "class_type": "KSampler"},
+        "5": {"inputs": {}, "class_type": "FakeStall"},
+        "9": {"inputs": {}, "class_type": "SaveImage"},
+    }
+
+    def run_handler(self, fake, job_input, stall_timeout_s=0):
+        with patch.object(rp_handler, "COMFY_HOST", fake.host), patch.object(
+            rp_handler, "COMFY_STALL_TIMEOUT_S", stall_timeout_s
+        ), patch.object(
+            rp_handler, "COMFY_WEBSOCKET_RECV_TIMEOUT_MS", 50
+        ), patch.object(
+            rp_handler, "process_output_images", return_value={"status": "success"}
+        ):
+            return rp_handler.handler({"id": "123", "input": job_input})
+
+    def wait_until_idle(self, fake):
+        deadline = time.monotonic() + 2
+        while fake.running is not None and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def test_stalled_workflow_is_interrupted(self):
+        with FakeComfyUI() as fake:
+            result = self.run_handler(
+                fake, {"workflow": self.stalling_workflow}, stall_timeout_s=0.2
+            )
+            self.wait_until_idle(fake)
+
+        self.assertEqual(
+            result["error"],
+            "Workflow stalled, ComfyUI reported no progress for 0.2 seconds",
+        )
+        self.assertEqual(fake.count("POST", "/interrupt"), 1)
+        self.assertIsNone(fake.running)
+
+    def test_deadline_cancels_running_and_waiting_workflows(self):
+        for refuse_websocket in (False, True):
+            with self.subTest(refuse_websocket=refuse_websocket), FakeComfyUI(
+                refuse_websocket=refuse_websocket
+            ) as fake:
+                started_at = time.monotonic()
+                result = self.run_handler(
+                    fake,
+                    {
+                        "workflows": [self.stalling_workflow, self.stalling_workflow],
+                        "timeout": 0.3,
+                    },
+                )
+                self.wait_until_idle(fake)
+
+                self.assertLess(time.monotonic() - started_at, 2)
+                self.assertEqual(result["status"], "error")
+                for workflow_result in result["results"]:
+                    self.assertIn("deadline", workflow_result["error"])
+                self.assertEqual(fake.count("POST", "/interrupt"), 1)
+                self.assertEqual(fake.count("POST", "/queue"), 1)
+                self.assertEqual(len(fake.deleted), 1)
+                self.assertIsNone(fake.running)
+
+    def test_polling_notices_fast_workflows_quickly(self):
+        with FakeComfyUI(refuse_websocket=True) as fake, patch.object(
+            rp_handler, "COMFY_POLLING_INTERVAL_MS", 5000
+        ):
+            started_at = time.monotonic()
+            result = self.run_handler(
+                fake, {"workflow": {"9": {"inputs": {}, "class_type": "SaveImage"}}}
+            )
+
+        self.assertEqual(result["status"], "success")
+        self.assertLess(time.monotonic() - started_at, 1)
+
+    def test_invalid_timeout(self):
+        for timeout in (0, -1, "10", True):
+            _, error = rp_handler.validate_input(
+                {"workflow": {"key": "value"}, "timeout": timeout}
+            )
+            self.assertEqual(error, "'timeout' must be a positive number of seconds")
+
+
+class TestFileCleanup(unittest.TestCase):
+    workflow = {
+        "3": {"inputs": {"steps": 1}, "class_type": "KSampler"},
+        "9": {"inputs": {"samples": ["3", 0]}, "class_type": "SaveImage"},
+    }
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.output = os.path.join(self.folder.name, "ComfyUI_9_.png")
+        with open(self.output, "wb") as f:
+            f.write(b"image")
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def run_handler(self, fake, cleanup_files):
+        with patch.object(rp_handler, "COMFY_HOST", fake.host), patch.object(
+            rp_handler, "CLEANUP_FILES", cleanup_files
+        ), patch.object(
+            rp_handler, "file_cleanup", FileCleanup([self.folder.name], 0, 0, 0)
+        ), patch.dict(
+            os.environ, {"COMFY_OUTPUT_PATH": self.folder.name}
+        ):
+            return rp_handler.handler(
+                {"id": "123", "input": {"workflow": self.workflow}}
+            )
+
+    def test_outputs_are_removed_after_delivery(self):
+        with FakeComfyUI() as fake, patch.object(
+            rp_handler, "queued_workflows", OrderedDict()
+        ):
+            result = self.run_handler(fake, cleanup_files=True)
+            # The fake doesn't write the output again, only the queued workflow matters
+            self.run_handler(fake, cleanup_files=True)
+            first_workflow, second_workflow = [
+                entry["prompt"][2] for entry in fake.history.values()
+            ]
+
+        self.assertEqual(result["status"], "success")
+        self.assertFalse(os.path.exists(self.output))
+        # The first run is queued as it is
+        self.assertEqual(first_workflow, self.workflow)
+        # Only the output node is run again when the workflow is repeated
+        self.assertIn(rp_handler.UNIQUE_RUN_INPUT, second_workflow["9"]["inputs"])
+        self.assertNotIn(rp_handler.UNIQUE_RUN_INPUT, second_workflow["3"]["inputs"])
+
+    def test_failed_job_does_not_stop_the_eviction(self):
+        old = time.time() - 100
+        os.utime(self.output, (old, old))
+        file_cleanup = FileCleanup([self.folder.name], 0, 90, 80)
+        file_cleanup.register([self.output])
+        usage = MagicMock(total=1000, used=950, free=50)
+
+        with patch.object(rp_handler, "file_cleanup", file_cleanup), patch.object(
+            rp_handler, "validate_input", side_effect=RuntimeError("crash")
+        ), patch("shutil.disk_usage", return_value=usage):
+            with self.assertRaises(RuntimeError):
+                rp_handler.handler({"id": "123", "input": {"workflow": self.workflow}})
+            # The cutoff of the eviction is not held back by the failed job
+            self.assertEqual(file_cleanup.jobs, {})
+            self.assertEqual(file_cleanup.evict(), 1)
+
+        self.assertFalse(os.path.exists(self.output))
+
+    def test_outputs_are_kept_without_cleanup(self):
+        with FakeComfyUI() as fake:
+            result = self.run_handler(fake, cleanup_files=False)
+            queued_workflow = list(fake.history.values())[0]["prompt"][2]
+
+        self.assertEqual(result["status"], "success")
+        self.assertTrue(os.path.exists(self.output))
+        self.assertEqual(queued_workflow, self.workflow)
+
+    def test_inputs_are_removed_when_no_job_uses_them(self):
+        image = {"name": "input.png", "sha256": "a" * 64}
+        path = os.path.join(self.folder.name, "input.png")
+        with open(path, "wb") as f:
+            f.write(b"image")
+
+        with patch.object(
+            rp_handler, "file_cleanup", FileCleanup([self.folder.name], 0, 0, 0)
+        ), patch.dict(os.environ, {"COMFY_INPUT_PATH": self.folder.name}):
+            # As if the image was uploaded by the worker
+            rp_handler.file_cleanup.register([path])
+            rp_handler.acquire_input_names([image])
+            rp_handler.acquire_input_names([image])
+            rp_handler.release_input_names([image])
+            self.assertTrue(os.path.exists(path))
+            rp_handler.release_input_names([image])
+            self.assertFalse(os.path.exists(path))
+
+    def test_files_written_by_comfyui_are_delivered_and_removed(self):
+        image = png_image(8, 8)
+        job_input = {
+            "workflow": self.workflow,
+            "images": [
+                {"name": "input.png", "image": base64.b64encode(image).decode("utf-8")}
+            ],
+        }
+        with FakeComfyUI(
+            output_dir=self.folder.name, input_dir=self.folder.name, image_size=(8, 8)
+        ) as fake, patch.object(rp_handler, "COMFY_HOST", fake.host), patch.object(
+            rp_handler, "file_cleanup", FileCleanup([self.folder.name], 0, 0, 0)
+        ), patch.dict(
+            os.environ,
+            {
+                "COMFY_OUTPUT_PATH": self.folder.name,
+                "COMFY_INPUT_PATH": self.folder.name,
+            },
+        ):
+            result = rp_handler.handler({"id": "123", "input": job_input})
+            uploads = fake.uploads
+
+        self.assertEqual(result["status"], "success")
+        self.assertEqual(uploads, 1)
+        delivered = base64.b64decode(result["outputs"]["9"][0]["data"])
+        self.assertTrue(delivered.startswith(b"\x89PNG"))
+        # Only the file of the setup is left
+        self.assertEqual(os.listdir(self.folder.name), ["ComfyUI_9_.png"])
+
+
+class TestModelResidency(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        os.makedirs(os.path.join(self.folder.name, "checkpoints"))
+        for name in ("sdxl.safetensors", "flux.safetensors"):
+            with open(os.path.join(self.folder.name, "checkpoints", name), "wb") as f:
+                f.truncate(1000)
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def run_handler(self, fake, job_id, ckpt_name):
+        workflow = copy.deepcopy(WORKFLOW)
+        workflow["4"]["inputs"]["ckpt_name"] = ckpt_name
+        with patch.object(rp_handler, "COMFY_HOST", fake.host), patch.object(
+            rp_handler,
+            "process_output_images",
+            return_value={"status": "success", "message": "image"},
+        ):
+            return rp_handler.handler(
+                {"id": job_id, "input": {"workflow": workflow, "metrics": True}}
+            )
+
+    def test_models_are_unloaded_when_the_next_job_needs_the_memory(self):
+        residency = ModelResidency([self.folder.name], 0, 500)
+        with FakeComfyUI(vram_free=1200) as fake, patch.object(
+            rp_handler, "model_residency", residency
+        ):
+            first = self.run_handler(fake, "1", "sdxl.safetensors")
+            again = self.run_handler(fake, "2", "sdxl.safetensors")
+            other = self.run_handler(fake, "3", "flux.safetensors")
+            frees = fake.count("POST", "/free")
+
+        self.assertEqual(first["metrics"]["models"]["resident"], [])
+        self.assertEqual(
+            again["metrics"]["models"],
+            {
+                "required": ["sdxl.safetensors"],
+                "resident": ["sdxl.safetensors"],
+                "freed": False,
+            },
+        )
+        self.assertTrue(other["metrics"]["models"]["freed"])
+        self.assertEqual(frees, 1)
+        self.assertEqual(residency.resident_models(), ["flux.safetensors"])
+
+    def test_models_stay_when_they_fit(self):
+        residency = ModelResidency([self.folder.name], 0, 500)
+        with FakeComfyUI(vram_free=10000) as fake, patch.object(
+            rp_handler, "model_residency", residency
+        ):
+            self.run_handler(fake, "1", "sdxl.safetensors")
+            self.run_handler(fake, "2", "flux.safetensors")
+            frees = fake.count("POST", "/free")
+
+        self.assertEqual(frees, 0)
+        self.assertEqual(
+            residency.resident_models(), ["sdxl.safetensors", "flux.safetensors"]
+        )
+
+    def test_models_are_copied_to_the_local_disk(self):
+        local = os.path.join(self.folder.name, "local")
+        tier = ModelTier(self.folder.name, local, 10000)
+        with FakeComfyUI() as fake, patch.object(rp_handler, "model_tier", tier):
+            first = self.run_handler(fake, "1", "sdxl.safetensors")
+            tier.wait()
+            second = self.run_handler(fake, "2", "sdxl.safetensors")
+
+        self.assertEqual(first["metrics"]["models"]["cached"], [])
+        self.assertEqual(second["metrics"]["models"]["cached"], ["sdxl.safetensors"])
+        self.assertTrue(
+            os.path.isfile(os.path.join(local, "checkpoints", "sdxl.safetensors"))
+        )
+        self.assertEqual(tier.jobs, {})
+
+
+class TestInputUrls(unittest.TestCase):
+    workflow = {
+        "1": {"inputs": {"image": "input.png"}, "class_type": "LoadImage"},
+        "9": {"inputs": {"images": ["1", 0]}, "class_type": "SaveImage"},
+    }
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.input_dir = os.path.join(self.folder.name, "input")
+        os.makedirs(self.input_dir)
+        self.image = png_image(8, 8)
+        # The fake S3 runs on 127.0.0.1
+        patcher = patch.object(rp_handler, "INPUT_DOWNLOAD_ALLOW_PRIVATE_HOSTS", True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_invalid_url_is_rejected(self):
+        _, error = rp_handler.validate_input(
+            {
+                "workflow": self.workflow,
+                "images": [{"name": "input.png", "url": "file:///etc/passwd"}],
+            }
+        )
+        self.assertEqual(error, "The url of image 'input.png' must be an http(s) URL")
+
+    def test_downloaded_image_is_uploaded_and_revalidated(self):
+        url_cache = UrlCache(os.path.join(self.folder.name, "url-cache"), 1024**2)
+        with FakeS3() as s3, FakeComfyUI(
+            output_dir=self.folder.name, input_dir=self.input_dir, image_size=(8, 8)
+        ) as fake, patch.object(rp_handler, "COMFY_HOST", fake.host), patch.object(
+            rp_handler, "url_cache", url_cache
+        ), patch.object(
+            rp_handler, "CLEANUP_FILES", False
+        ), patch.dict(
+            os.environ,
+            {"COMFY_OUTPUT_PATH": self.folder.name, "COMFY_INPUT_PATH": self.input_dir},
+        ):
+            s3.objects[("bucket", "input.png")] = {"body": self.image}
+            job_input = {
+                "workflow": self.workflow,
+                "images": [
+                    {"name": "input.png", "url": f"{s3.endpoint_url}/bucket/input.png"}
+                ],
+                "metrics": True,
+            }
+            first = rp_handler.handler({"id": "1", "input": job_input})
+            second = rp_handler.handler({"id": "2", "input": job_input})
+            gets = s3.gets
+            uploads = fake.uploads
+
+        self.assertEqual(first["status"], "success")
+        self.assertEqual(second["status"], "success")
+        with open(os.path.join(self.input_dir, "input.png"), "rb") as f:
+            self.assertEqual(f.read(), self.image)
+        # The second job revalidates its download and skips the upload
+        self.assertEqual(gets, [200, 304])
+        self.assertEqual(uploads, 1)
+        self.assertEqual(
+            first["metrics"]["caches"], {"url_cache": {"hits": 0, "misses": 1}}
+        )
+        self.assertEqual(
+            second["metrics"]["caches"], {"url_cache": {"hits": 1, "misses": 0}}
+        )
+
+    def test_failed_download_is_an_error(self):
+        with FakeS3() as s3:
+            _, error = rp_handler.download_images(
+                [{"name": "input.png", "url": f"{s3.endpoint_url}/bucket/missing.png"}]
+            )
+        self.assertTrue(error.startswith("Error downloading image 'input.png': 404"))
+
+    @patch.object(rp_handler, "INPUT_DOWNLOAD_ALLOW_PRIVATE_HOSTS", False)
+    def test_private_hosts_are_refused(self):
+        for url in (
+            "http://127.0.0.1:8188/view?filename=secret.png",
+            "http://169.254.169.254/latest/meta-data/",
+            "http://[::ffff:10.0.0.1]/image.png",
+        ):
+            with self.subTest(url=url):
+                _, error = rp_handler.download_images(
+                    [{"name": "input.png", "url": url}]
+                )
+                self.assertIn("resolves to the non-public address", error)
+
+    @patch.object(rp_handler, "INPUT_DOWNLOAD_ALLOW_PRIVATE_HOSTS", False)
+    def test_redirects_to_private_hosts_are_refused(self):
+        class RedirectAdapter(requests.adapters.BaseAdapter):
+            def __init__(self):
+                super().__init__()
+                self.urls = []
+
+            def send(self, request, **kwargs):
+                self.urls.append(request.url)
+                response = requests.Response()
+                response.status_code = 302
+                response.headers["Location"] = "http://169.254.169.254/latest/"
+                response.url = request.url
+                response.request = request
+                response.raw = io.BytesIO(b"")
+                return response
+
+            def close(self):
+                pass
+
+        adapter = RedirectAdapter()
+        session = rp_handler.create_download_session()
+        session.mount("http://", adapter)
+
+        with self.assertRaisesRegex(ValueError, "169.254.169.254"):
+            session.get("http://93.184.216.34/image.png")
+        self.assertEqual(adapter.urls, ["http://93.184.216.34/image.png"])
+
+
+class TestInputBudget(unittest.TestCase):
+    workflow = {
+        "1": {"inputs": {"image": "input.png"}, "class_type": "LoadImage"},
+        "9": {"inputs": {"images": ["1", 0]}, "class_type": "SaveImage"},
+    }
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.input_dir = os.path.join(self.folder.name, "input")
+        self.cache_path = os.path.join(self.folder.name, "input-cache")
+        os.makedirs(self.input_dir)
+        self.input_cache = InputCache(self.cache_path, 1024**2)
+        # The fake S3 runs on 127.0.0.1
+        patcher = patch.object(rp_handler, "INPUT_DOWNLOAD_ALLOW_PRIVATE_HOSTS", True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def validate(self, images):
+        with patch.object(rp_handler, "input_cache", self.input_cache):
+            return rp_handler.validate_input(
+                {"workflow": self.workflow, "images": images}
+            )
+
+    @patch.object(rp_handler, "INPUT_JOB_MAX_BYTES", 10)
+    def test_images_over_the_job_budget_are_rejected(self):
+        _, error = self.validate(
+            [
+                {"name": "a.png", "image": base64.b64encode(b"123456").decode()},
+                {"name": "b.png", "image": base64.b64encode(b"123456").decode()},
+            ]
+        )
+        self.assertEqual(
+            error, "Image 'b.png' exceeds the limit of 10 bytes for the images of a job"
+        )
+
+        # Too big to be decoded at all
+        _, error = self.validate(
+            [{"name": "c.png", "image": base64.b64encode(b"1" * 20).decode()}]
+        )
+        self.assertEqual(
+            error, "Image 'c.png' exceeds the limit of 10 bytes for the images of a job"
+        )
+        self.assertNotIn(
+            hashlib.sha256(b"1" * 20).hexdigest(), os.listdir(self.cache_path)
+        )
+
+    @patch.object(rp_handler, "INPUT_JOB_MAX_BYTES", 10)
+    def test_downloads_count_towards_the_job_budget(self):
+        url_cache = UrlCache(os.path.join(self.folder.name, "url-cache"), 1024**2)
+        with FakeS3() as s3, patch.object(rp_handler, "url_cache", url_cache):
+            s3.objects[("bucket", "b.png")] = {"body": b"12345678"}
+            validated_data, error = self.validate(
+                [
+                    {"name": "a.png", "image": base64.b64encode(b"123456").decode()},
+                    {"name": "b.png", "url": f"{s3.endpoint_url}/bucket/b.png"},
+                ]
+            )
+            self.assertIsNone(error)
+            images, error = rp_handler.download_images(validated_data["images"])
+
+        self.assertIsNone(images)
+        self.assertEqual(
+            error, "Error downloading image 'b.png': the image is bigger than 4 bytes"
+        )
+        self.assertTrue(validated_data["images"][0]["file"].closed)
+
+    def test_inline_image_is_streamed_to_comfy(self):
+        image = png_image(8, 8)
+        with FakeComfyUI(
+            output_dir=self.folder.name, input_dir=self.input_dir, image_size=(8, 8)
+        ) as fake, patch.object(rp_handler, "COMFY_HOST", fake.host), patch.object(
+            rp_handler, "input_cache", self.input_cache
+        ), patch.object(
+            rp_handler, "CLEANUP_FILES", False
+        ), patch.dict(
+            os.environ,
+            {"COMFY_OUTPUT_PATH": self.folder.name, "COMFY_INPUT_PATH": self.input_dir},
+        ):
+            result = rp_handler.handler(
+                {
+                    "id": "1",
+                    "input": {
+                        "workflow": self.workflow,
+                        "images": [
+                            {
+                                "name": "input.png",
+                                "image": base64.b64encode(image).decode(),
+                            }
+                        ],
+                    },
+                }
+            )
+            uploads = fake.uploads
+
+        self.assertEqual(result["status"], "success")
+        self.assertEqual(uploads, 1)
+        with open(os.path.join(self.input_dir, "input.png"), "rb") as f:
+            self.assertEqual(f.read(), image)
+
+
+class TestWorkflowTemplates(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        with open(os.path.join(self.folder.name, "sdxl.json"), "w") as f:
+            json.dump(
+                {
+                    "workflow": WORKFLOW,
+                    "params": {"prompt": "/6/inputs/text", "steps": "/3/inputs/steps"},
+                },
+                f,
+            )
+        self.templates = WorkflowTemplates([self.folder.name])
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def run_handler(self, fake, job_input):
+        with patch.object(rp_handler, "COMFY_HOST", fake.host), patch.object(
+            rp_handler, "workflow_templates", self.templates
+        ), patch.object(
+            rp_handler,
+            "workflow_schema",
+            WorkflowSchema(rp_handler.get_object_info, 0),
+        ), patch.object(
+            rp_handler, "process_output_images", return_value={"status": "success"}
+        ):
+            return rp_handler.handler({"id": "123", "input": job_input})
+
+    def test_params_are_injected_into_the_template(self):
+        with FakeComfyUI(object_info=OBJECT_INFO) as fake:
+            result = self.run_handler(
+                fake, {"template": "sdxl", "params": {"prompt": "a dog", "steps": 2}}
+            )
+            queued_workflow = list(fake.history.values())[0]["prompt"][2]
+
+        self.assertEqual(result["status"], "success")
+        self.assertEqual(queued_workflow["6"]["inputs"]["text"], "a dog")
+        self.assertEqual(queued_workflow["3"]["inputs"]["steps"], 2)
+        self.assertEqual(self.templates.get("sdxl").workflow, WORKFLOW)
+
+    def test_invalid_params_are_never_queued(self):
+        with FakeComfyUI(object_info=OBJECT_INFO) as fake:
+            unknown = self.run_handler(fake, {"template": "other"})
+            invalid = self.run_handler(
+                fake, {"template": "sdxl", "params": {"steps": 0}}
+            )
+
+        self.assertEqual(
+            unknown["error"], "Unknown template 'other', available templates: sdxl"
+        )
+        self.assertTrue(invalid["error"].startswith("Invalid workflow: Node 3"))
+        self.assertEqual(fake.count("POST", "/prompt"), 0)
+
+    def test_results_are_cached_by_template_and_params(self):
+        job_input = {"template": "sdxl", "params": {"prompt": "a dog", "steps": 2}}
+        with tempfile.TemporaryDirectory() as path, patch.object(
+            rp_handler, "result_cache", ResultCache(path, 1024**2, 60)
+        ), FakeComfyUI(object_info=OBJECT_INFO) as fake:
+            self.run_handler(fake, job_input)
+            cached = self.run_handler(fake, job_input)
+            other = self.run_handler(
+                fake, {"template": "sdxl", "params": {"prompt": "a cat", "steps": 2}}
+            )
+
+        self.assertTrue(cached["cached"])
+        self.assertNotIn("cached", other)
+        self.assertEqual(fake.count("POST", "/prompt"), 2)
@@ -0,0 +1,129 @@
+import unittest
+import hashlib
+import os
+import sys
+import tempfile
+import time
+from unittest.mock import patch
+
+import requests
+
+# Make sure that "src" is known and can be used to import url_cache.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+from src.url_cache import UrlCache
+from tests.fake_s3 import FakeS3
+
+
+class TestUrlCache(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.s3 = FakeS3().start()
+        self.s3.objects[("bucket", "image.png")] = {"body": b"image" * 100}
+        self.url = f"{self.s3.endpoint_url}/bucket/image.png"
+        self.session = requests.Session()
+
+    def tearDown(self):
+        self.session.close()
+        self.s3.stop()
+        self.folder.cleanup()
+
+    def open(self, cache, url=None, max_bytes=1024):
+        f, sha256, cached = cache.open(url or self.url, self.session, max_bytes, 10)
+        with f:
+            return f.read(), sha256, cached
+
+    def test_downloads_are_revalidated_with_their_etag(self):
+        cache = UrlCache(self.folder.name, 1024**2)
+
+        first = self.open(cache)
+        second = self.open(cache)
+        self.s3.objects[("bucket", "image.png")] = {"body": b"changed"}
+        third = self.open(cache)
+
+        sha256 = hashlib.sha256(b"image" * 100).hexdigest()
+        self.assertEqual(first, (b"image" * 100, sha256, False))
+        self.assertEqual(second, (b"image" * 100, sha256, True))
+        self.assertEqual(third[0], b"changed")
+        self.assertEqual(self.s3.gets, [200, 304, 200])
+        self.assertEqual(cache.stats()["entries"], 1)
+
+    def test_downloads_survive_a_restart(self):
+        self.open(UrlCache(self.folder.name, 1024**2))
+
+        _, _, cached = self.open(UrlCache(self.folder.name, 1024**2))
+
+        self.assertTrue(cached)
+        self.assertEqual(self.s3.gets, [200, 304])
+
+    def test_the_signature_of_presigned_urls_is_not_part_of_the_key(self):
+        url = "https://bucket.s3.amazonaws.com/image.png?v=1"
+        self.assertEqual(
+            UrlCache.key(f"{url}&X-Amz-Signature=a&X-Amz-Date=1"),
+            UrlCache.key(f"{url}&X-Amz-Signature=b&X-Amz-Date=2"),
+        )
+        self.assertNotEqual(UrlCache.key(url), UrlCache.key(f"{url}0"))
+
+    def test_images_over_the_limit_are_rejected(self):
+        cache = UrlCache(self.folder.name, 1024**2)
+
+        with self.assertRaises(ValueError):
+            self.open(cache, max_bytes=100)
+
+        self.assertEqual(os.listdir(self.folder.name), [])
+
+    def test_disabled_cache_downloads_every_time(self):
+        cache = UrlCache(self.folder.name, 0)
+
+        self.assertEqual(self.open(cache)[0], b"image" * 100)
+        self.assertEqual(self.open(cache)[0], b"image" * 100)
+
+        self.assertEqual(self.s3.gets, [200, 200])
+        self.assertEqual(os.listdir(self.folder.name), [])
+
+    def test_open_files_stay_readable_after_eviction(self):
+        self.s3.objects[("bucket", "other.png")] = {"body": b"other" * 100}
+        cache = UrlCache(self.folder.name, 600)
+
+        f, _, _ = cache.open(self.url, self.session, 1024, 10)
+        self.open(cache, url=f"{self.s3.endpoint_url}/bucket/other.png")
+
+        with f:
+            self.assertEqual(f.read(), b"image" * 100)
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+    def test_cached_file_is_closed_when_the_revalidation_fails(self):
+        cache = UrlCache(self.folder.name, 1024**2)
+        self.open(cache)
+        opened = []
+        open_cached = cache._open_cached
+
+        def remember_open_cached(key):
+            f, metadata = open_cached(key)
+            opened.append(f)
+            return f, metadata
+
+        with patch.object(cache, "_open_cached", remember_open_cached), patch.object(
+            self.session, "get", side_effect=requests.ConnectionError("offline")
+        ):
+            with self.assertRaises(requests.ConnectionError):
+                self.open(cache)
+
+        self.assertTrue(opened[0].closed)
+
+    def test_interrupted_downloads_are_removed_on_load(self):
+        # Left over from a worker that was killed during a download
+        for name in ("download.tmp", "download.json.tmp"):
+            path = os.path.join(self.folder.name, name)
+            open(path, "wb").close()
+            os.utime(path, (time.time() - 7200, time.time() - 7200))
+
+        cache = UrlCache(self.folder.name, 1024**2)
+        self.open(cache)
+
+        names = os.listdir(self.folder.name)
+        self.assertFalse([name for name in names if name.endswith(".tmp")])
+        self.assertEqual(cache.stats()["entries"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
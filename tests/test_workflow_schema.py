@@ -0,0 +1,156 @@
+import unittest
+import copy
+import os
+import sys
+
+# Make sure that "src" is known and can be used to import workflow_schema.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+from src.workflow_schema import WorkflowSchema
+from tests.fake_comfyui import OBJECT_INFO, WORKFLOW
+
+
+class TestWorkflowSchema(unittest.TestCase):
+    def setUp(self):
+        self.object_info = copy.deepcopy(OBJECT_INFO)
+        self.fetches = 0
+        self.schema = WorkflowSchema(self.fetch, min_refresh_interval_s=0)
+
+    def fetch(self):
+        self.fetches += 1
+        return copy.deepcopy(self.object_info)
+
+    def validate(self, change=None):
+        workflow = copy.deepcopy(WORKFLOW)
+        if change:
+            change(workflow)
+        return self.schema.validate(workflow)
+
+    def test_valid_workflow(self):
+        self.assertEqual(self.validate(), [])
+        self.assertEqual(self.validate(), [])
+        # The schema is fetched only once
+        self.assertEqual(self.fetches, 1)
+
+    def test_unknown_node(self):
+        errors = self.validate(lambda w: w["5"].update(class_type="FancyLatent"))
+        self.assertEqual(
+            errors,
+            ["Node 5: unknown node type 'FancyLatent', is the custom node installed?"],
+        )
+
+    def test_missing_required_input(self):
+        errors = self.validate(lambda w: w["3"]["inputs"].pop("steps"))
+        self.assertEqual(errors, ["Node 3 (KSampler): missing required input 'steps'"])
+
+    def test_links(self):
+        errors = self.validate(lambda w: w["8"]["inputs"].update(vae=["4", 3]))
+        self.assertEqual(
+            errors,
+            [
+                "Node 8 (VAEDecode): input 'vae' is linked to output 3 of node 4, "
+                "which has 3 outputs"
+            ],
+        )
+
+        errors = self.validate(lambda w: w["8"]["inputs"].update(vae=["7", 0]))
+        self.assertEqual(
+            errors,
+            [
+                "Node 8 (VAEDecode): input 'vae' is linked to node 7, which doesn't exist"
+            ],
+        )
+
+        errors = self.validate(lambda w: w["8"]["inputs"].update(vae=["4", 1]))
+        self.assertEqual(
+            errors,
+            ["Node 8 (VAEDecode): input 'vae' expects VAE, but node 4 returns CLIP"],
+        )
+
+    def test_enum_values(self):
+        errors = self.validate(
+            lambda w: w["4"]["inputs"].update(ckpt_name="missing.safetensors")
+        )
+        self.assertEqual(
+            errors,
+            [
+                "Node 4 (CheckpointLoaderSimple): input 'ckpt_name' has the value "
+                "'missing.safetensors', which is not one of the 1 values that ComfyUI knows"
+            ],
+        )
+
+        # The "COMBO" format of newer versions of ComfyUI
+        errors = self.validate(lambda w: w["3"]["inputs"].update(sampler_name="magic"))
+        self.assertEqual(len(errors), 1)
+        self.assertIn("'magic'", errors[0])
+
+    def test_enum_miss_fetches_the_schema_again(self):
+        self.assertEqual(self.validate(), [])
+        self.object_info["CheckpointLoaderSimple"]["input"]["required"]["ckpt_name"][
+            0
+        ].append("new.safetensors")
+
+        errors = self.validate(
+            lambda w: w["4"]["inputs"].update(ckpt_name="new.safetensors")
+        )
+        self.assertEqual(errors, [])
+        self.assertEqual(self.fetches, 2)
+
+    def test_refresh_is_rate_limited(self):
+        self.schema.min_refresh_interval_s = 60
+        self.validate(lambda w: w["5"].update(class_type="FancyLatent"))
+        self.validate(lambda w: w["5"].update(class_type="FancyLatent"))
+        self.assertEqual(self.fetches, 1)
+
+    def test_uploaded_images_are_valid_values(self):
+        workflow = {
+            "1": {"inputs": {"image": "upload.png"}, "class_type": "LoadImage"},
+            "2": {
+                "inputs": {"images": ["1", 0], "filename_prefix": "ComfyUI"},
+                "class_type": "SaveImage",
+            },
+        }
+        self.assertEqual(self.schema.validate(workflow, ["upload.png"]), [])
+
+    def test_number_range(self):
+        errors = self.validate(lambda w: w["5"]["inputs"].update(width=8))
+        self.assertEqual(
+            errors,
+            [
+                "Node 5 (EmptyLatentImage): input 'width' is 8, which is less than "
+                "the minimum 16"
+            ],
+        )
+
+        errors = self.validate(lambda w: w["3"]["inputs"].update(steps="many"))
+        self.assertEqual(
+            errors, ["Node 3 (KSampler): input 'steps' must be a number, got 'many'"]
+        )
+
+    def test_numeric_strings_are_converted_like_comfyui_does(self):
+        self.assertEqual(
+            self.validate(lambda w: w["3"]["inputs"].update(seed="42", cfg="7.5")), []
+        )
+
+        errors = self.validate(lambda w: w["5"]["inputs"].update(width="8"))
+        self.assertEqual(
+            errors,
+            [
+                "Node 5 (EmptyLatentImage): input 'width' is 8, which is less than "
+                "the minimum 16"
+            ],
+        )
+
+        # int() of ComfyUI doesn't accept fractions as string
+        errors = self.validate(lambda w: w["3"]["inputs"].update(steps="2.5"))
+        self.assertEqual(
+            errors, ["Node 3 (KSampler): input 'steps' must be a number, got '2.5'"]
+        )
+
+    def test_workflow_without_output(self):
+        errors = self.validate(lambda w: w.pop("9"))
+        self.assertEqual(errors, ["The workflow has no output node, e.g. SaveImage"])
+
+    def test_empty_schema_skips_the_validation(self):
+        self.object_info = {}
+        self.assertEqual(self.schema.validate({"1": {"class_type": "Anything"}}), [])
+        self.assertFalse(self.schema.available)
@@ -0,0 +1,97 @@
+import unittest
+import copy
+import json
+import os
+import sys
+import tempfile
+
+# Make sure that "src" is known and can be used to import workflow_templates.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+from src.workflow_schema import WorkflowSchema
+from src.workflow_templates import WorkflowTemplate, WorkflowTemplates
+from tests.fake_comfyui import OBJECT_INFO, WORKFLOW
+
+PARAMS = {
+    "prompt": "/6/inputs/text",
+    "size": ["/5/inputs/width", "/5/inputs/height"],
+    "steps": "/3/inputs/steps",
+}
+
+
+class TestWorkflowTemplate(unittest.TestCase):
+    def setUp(self):
+        self.workflow = copy.deepcopy(WORKFLOW)
+        self.template = WorkflowTemplate("sdxl", self.workflow, PARAMS)
+
+    def test_params_are_injected_copy_on_write(self):
+        workflow, error = self.template.render(
+            {"prompt": "a dog", "size": 512, "steps": 4}
+        )
+
+        self.assertIsNone(error)
+        self.assertEqual(workflow["6"]["inputs"]["text"], "a dog")
+        self.assertEqual(workflow["5"]["inputs"], {"width": 512, "height": 512})
+        self.assertEqual(workflow["3"]["inputs"]["steps"], 4)
+        # The template is unchanged and the other nodes are shared with it
+        self.assertEqual(self.workflow, WORKFLOW)
+        self.assertIs(workflow["4"], self.workflow["4"])
+        self.assertIsNot(workflow["6"], self.workflow["6"])
+        self.assertIs(
+            workflow["6"]["inputs"]["clip"], self.workflow["6"]["inputs"]["clip"]
+        )
+
+    def test_invalid_params_are_rejected(self):
+        _, error = self.template.render({"seed": 1})
+        self.assertEqual(
+            error, "Template 'sdxl' has no parameter seed, it has prompt, size, steps"
+        )
+        _, error = self.template.render({"steps": "4"})
+        self.assertEqual(
+            error, "Parameter 'steps' of template 'sdxl' must be of type int"
+        )
+        _, error = self.template.render({"steps": True})
+        self.assertIsNotNone(error)
+
+    def test_pointers_must_exist(self):
+        for pointer in ("6/inputs/text", "/6/inputs/missing", "/6/inputs", "/6"):
+            with self.subTest(pointer=pointer), self.assertRaises(ValueError):
+                WorkflowTemplate("sdxl", self.workflow, {"prompt": pointer})
+
+    def test_only_params_are_validated_once_the_template_is_valid(self):
+        schema = WorkflowSchema(lambda: copy.deepcopy(OBJECT_INFO))
+
+        workflow, _ = self.template.render({"size": 8})
+        errors = self.template.validate(schema, workflow)
+
+        self.assertTrue(self.template.valid)
+        self.assertEqual(len(errors), 2)
+        self.assertIn(
+            "input 'width' is 8, which is less than the minimum 16", errors[1]
+        )
+        self.assertEqual(self.template.validate(schema, self.template.workflow), [])
+
+
+class TestWorkflowTemplates(unittest.TestCase):
+    def test_templates_are_loaded_from_folders(self):
+        with tempfile.TemporaryDirectory() as first, tempfile.TemporaryDirectory() as second:
+            with open(os.path.join(first, "sdxl.json"), "w") as f:
+                json.dump({"workflow": WORKFLOW, "params": PARAMS}, f)
+            with open(os.path.join(second, "sdxl.json"), "w") as f:
+                json.dump({"workflow": WORKFLOW}, f)
+            with open(os.path.join(second, "broken.json"), "w") as f:
+                f.write("{")
+
+            templates = WorkflowTemplates([first, second, "/does/not/exist"])
+
+        self.assertEqual(templates.names(), ["sdxl"])
+        # The first folder wins
+        self.assertEqual(
+            sorted(templates.get("sdxl").params), ["prompt", "size", "steps"]
+        )
+        self.assertEqual(len(templates.errors), 1)
+        self.assertIn("broken.json", templates.errors[0])
+        self.assertIsNone(templates.get("missing"))
+
+
+if __name__ == "__main__":
+    unittest.main()